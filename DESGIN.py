@@ -2,11 +2,128 @@ import tkinter as tk
 from tkinter import messagebox, simpledialog, Menu
 from threading import Thread
 from P_Server import P_Server
-from P_Client import P_Client
+from P_Approval import TkApprovalPolicy
+from P_Client import P_Client, RequestFailed
+from P_Log import setup_logging
+import logging
 import socket
 import time
 import threading
 
+log = logging.getLogger("RemoteControlApp")
+
+
+class LogView:
+    """Shows new log records in a Text widget.
+
+    Polls the logging ring buffer every `interval` ms on the Tk thread and
+    appends only the lines it has not shown yet, in one insert, so a burst
+    of log records costs one widget update. Lines past `max_lines` are
+    trimmed from the top.
+    """
+
+    def __init__(self, root, text, ring, interval=200, max_lines=500):
+        self.root = root
+        self.text = text
+        self.ring = ring
+        self.interval = interval
+        self.max_lines = max_lines
+        self.last = 0
+        self.root.after(self.interval, self.refresh)
+
+    def refresh(self):
+        self.last, records = self.ring.records_since(self.last)
+        if records:
+            lines = "".join(f"{time.strftime('%H:%M:%S', time.localtime(record.created))}  {record.getMessage()}\n"
+                            for record in records[-self.max_lines:])
+            self.text.config(state=tk.NORMAL)
+            self.text.insert(tk.END, lines)
+            excess = int(self.text.index("end-1c").split(".")[0]) - 1 - self.max_lines
+            if excess > 0:
+                self.text.delete("1.0", f"{excess + 1}.0")
+            self.text.config(state=tk.DISABLED)
+            self.text.see(tk.END)
+        self.root.after(self.interval, self.refresh)
+
+
+class RemoteViewer:
+    """Window showing the remote screen received over a session channel.
+
+    Mouse and keyboard events on the window are batched by an InputBatcher
+    and sent to the controlled side, scaled back to its screen size.
+    """
+
+    MAX_WIDTH = 1280  # Wider screens are downsampled to fit
+
+    def __init__(self, root, target_code, channel, log):
+        from P_Input import InputBatcher
+        from P_Session import ScreenReceiver
+
+        self.channel = channel
+        self.log = log
+        self.window = tk.Toplevel(root)
+        self.window.title(f"Remote Control - {target_code}")
+        self.window.protocol("WM_DELETE_WINDOW", self.close)
+        self.screen = tk.Label(self.window, text="Waiting for the remote screen...", bg="black", fg="white", anchor="nw")
+        self.screen.pack(fill=tk.BOTH, expand=True)
+        self.photo = None
+        self.scale = 1  # Remote pixels per displayed pixel
+        self.input = InputBatcher(channel)
+        self.bind_input()
+        self.pending = None  # Latest frame not yet drawn, as PPM bytes
+        self.lock = threading.Lock()
+
+        self.receiver = ScreenReceiver(channel, self.on_frame)
+        Thread(target=self.receive, daemon=True).start()
+
+    def receive(self):
+        self.receiver.run()
+        self.log(f"Remote control session ended after {self.receiver.frames_received} frames")
+
+    def on_frame(self, image, rects):
+        """Called from the receiver thread; keeps only the newest frame for the next redraw."""
+        from P_Screen import to_ppm
+
+        ppm = to_ppm(image, self.MAX_WIDTH)
+        width = image.shape[1]
+        self.scale = -(-width // self.MAX_WIDTH) if width > self.MAX_WIDTH else 1
+        with self.lock:
+            schedule = self.pending is None
+            self.pending = ppm
+        if schedule:
+            self.window.after(0, self.redraw)
+
+    def redraw(self):
+        with self.lock:
+            ppm, self.pending = self.pending, None
+        if ppm is None:
+            return
+        if self.photo is None:
+            self.photo = tk.PhotoImage(data=ppm, format="PPM")
+            self.screen.config(image=self.photo, text="")
+        else:
+            self.photo.configure(data=ppm, format="PPM")
+
+    def bind_input(self):
+        self.screen.bind("<Motion>", lambda e: self.input.move(e.x * self.scale, e.y * self.scale))
+        self.screen.bind("<ButtonPress>", lambda e: self.on_button(e, True))
+        self.screen.bind("<ButtonRelease>", lambda e: self.on_button(e, False))
+        self.screen.bind("<MouseWheel>", lambda e: self.input.wheel(e.delta // 120 or (1 if e.delta > 0 else -1)))
+        self.window.bind("<KeyPress>", lambda e: self.input.key(True, e.keysym_num))
+        self.window.bind("<KeyRelease>", lambda e: self.input.key(False, e.keysym_num))
+
+    def on_button(self, event, pressed):
+        if event.num in (4, 5):  # X11 reports the wheel as buttons 4 and 5
+            if pressed:
+                self.input.wheel(1 if event.num == 4 else -1)
+            return
+        self.input.button(pressed, event.num, event.x * self.scale, event.y * self.scale)
+
+    def close(self):
+        self.input.close()
+        self.channel.close()
+        self.window.destroy()
+
 
 class RemoteControlApp:
     def __init__(self, root):
@@ -22,7 +139,8 @@ class RemoteControlApp:
         self.entered_code = tk.StringVar()
         self.connection_status = tk.StringVar(value="No active connection")
         self.recent_connections = []
-        self.log_messages = []
+        self.requested_codes = set()  # Codes we asked to control; we view their screen
+        self.log_pipeline = setup_logging()
 
         # UI Components
         self.build_menu()
@@ -113,21 +231,12 @@ class RemoteControlApp:
 
         # Disable text editing
         self.log_text.config(state=tk.DISABLED)
+        # Server and client log records reach the widget through the logging ring buffer
+        self.log_view = LogView(self.root, self.log_text, self.log_pipeline.ring)
 
     def log_message(self, message):
-        """Add a message to the log area in the UI"""
-        self.log_messages.append(message)
-        # Use after method to update UI from any thread
-        self.root.after(0, self._update_log_display)
-
-    def _update_log_display(self):
-        """Update the log text area with all messages"""
-        self.log_text.config(state=tk.NORMAL)
-        self.log_text.delete(1.0, tk.END)
-        for msg in self.log_messages[-10:]:  # Show last 10 messages
-            self.log_text.insert(tk.END, f"{msg}\n")
-        self.log_text.config(state=tk.DISABLED)
-        self.log_text.see(tk.END)  # Scroll to the end
+        """Add a message to the log area in the UI; safe from any thread"""
+        log.info("%s", message)
 
     def start_server(self):
         """Start the server and set up the server code."""
@@ -139,17 +248,6 @@ class RemoteControlApp:
             self.log_message(f"Server started on {local_ip}:12345")
             self.log_message(f"Your connection code: {generated_code}")
 
-            # Override the P_Server's print functionality
-            original_print = print
-
-            def custom_print(*args, **kwargs):
-                message = " ".join(map(str, args))
-                self.log_message(message)
-                original_print(*args, **kwargs)
-
-            import builtins
-            builtins.print = custom_print
-
             self.server.start()
         except Exception as e:
             self.log_message(f"Server error: {str(e)}")
@@ -168,43 +266,90 @@ class RemoteControlApp:
 
         self.connection_status.set("Sending request...")
         self.log_message(f"Sending connection request to {entered_code}")
+        self.requested_codes.add(entered_code)
 
-        def request_approval():
-            try:
-                self.client.send_request(entered_code)
-                self.root.after(0, lambda: self.connection_status.set("Waiting for response..."))
-                self.log_message(f"Waiting for approval from {entered_code}")
-
-                if self.client.approval_event.wait(timeout=60):
-                    if self.client.approval_result == "yes":
-                        self.root.after(0, lambda: self.connection_status.set(f"Connected to: {entered_code}"))
-                        self.log_message(f"Connection approved by {entered_code}")
-                        self.recent_connections.append(entered_code)
-
-                        # Here you would start the actual screen sharing/remote control
-                        self.start_remote_control(entered_code)
-
-                    elif self.client.approval_result == "no":
-                        self.root.after(0, lambda: self.connection_status.set("Connection request rejected."))
-                        self.log_message(f"Connection rejected by {entered_code}")
-                    else:
-                        self.root.after(0, lambda: self.connection_status.set("Code not found or not connected."))
-                        self.log_message(f"Error: Code not found or not connected")
-                else:
-                    self.root.after(0, lambda: self.connection_status.set("Connection request timed out."))
-                    self.log_message("Connection request timed out")
-            except Exception as e:
-                self.root.after(0, lambda: self.connection_status.set(f"Error: {str(e)}"))
-                self.log_message(f"Connection error: {str(e)}")
-
-        Thread(target=request_approval, daemon=True).start()
+        future = self.client.send_request(entered_code) if self.client else None
+        if future is None:
+            self.requested_codes.discard(entered_code)
+            self.connection_status.set("Not connected to server.")
+            self.log_message(f"Could not send a request to {entered_code}")
+            return
+        self.connection_status.set("Waiting for response...")
+        self.log_message(f"Waiting for approval from {entered_code}")
+        # No thread waits on the answer; the client resolves the future
+        future.add_done_callback(lambda f: self.root.after(0, self.on_request_done, entered_code, f))
+
+    def on_request_done(self, entered_code, future):
+        """Show the outcome of a connection request (runs on the Tk thread)."""
+        try:
+            decision = future.result()
+        except RequestFailed as e:
+            self.requested_codes.discard(entered_code)
+            self.connection_status.set(f"Connection request failed: {e}")
+            self.log_message(f"Request to {entered_code} failed: {e}")
+            return
+
+        if decision == "yes":
+            self.connection_status.set(f"Connected to: {entered_code}")
+            self.log_message(f"Connection approved by {entered_code}")
+            self.recent_connections.append(entered_code)
+            Thread(target=self.start_remote_control, args=(entered_code,), daemon=True).start()
+        else:
+            self.requested_codes.discard(entered_code)
+            self.connection_status.set("Connection request rejected.")
+            self.log_message(f"Connection rejected by {entered_code}")
 
     def start_remote_control(self, target_code):
         """Start the remote control functionality after connection is established"""
-        # This is where you would implement the actual screen sharing and remote control
         self.log_message(f"Starting remote control session with {target_code}")
-        # For now, just a placeholder
-        messagebox.showinfo("Remote Control", f"Remote control session with {target_code} would start here.")
+        try:
+            from P_Session import SessionChannel
+
+            sock = self.client.open_session(target_code)
+        except ImportError as e:
+            self.log_message(f"Remote control unavailable: {e}")
+            return
+        except OSError as e:
+            self.log_message(f"Could not open the session: {e}")
+            return
+        if sock is None:
+            self.log_message(f"No session from the server for {target_code}")
+            return
+        codec = self.client.session_codec(target_code)
+        self.log_message(f"Session with {target_code} connected via {self.client.session_paths.get(target_code)}, "
+                         f"compressed with {codec.name}")
+        channel = SessionChannel(sock, codec)
+        self.root.after(0, lambda: RemoteViewer(self.root, target_code, channel, self.log_message))
+
+    def on_session(self, peer_code, token):
+        """The server opened a session; share our screen if the peer asked to control us."""
+        if peer_code in self.requested_codes:
+            self.requested_codes.discard(peer_code)
+            return  # We are the viewer; start_remote_control opens it
+        Thread(target=self.share_screen, args=(peer_code,), daemon=True).start()
+
+    def share_screen(self, peer_code):
+        """Send this machine's screen to an approved peer until it disconnects."""
+        try:
+            from P_Input import InputReplayer
+            from P_Screen import screen_source
+            from P_Session import ScreenSender, SessionChannel
+
+            sock = self.client.open_session(peer_code)
+        except ImportError as e:
+            self.log_message(f"Screen sharing unavailable: {e}")
+            return
+        except OSError as e:
+            self.log_message(f"Could not open the session: {e}")
+            return
+        if sock is None:
+            return
+        self.log_message(f"Sharing screen with {peer_code}")
+        replayer = InputReplayer()
+        sender = ScreenSender(SessionChannel(sock, self.client.session_codec(peer_code)), screen_source(),
+                              on_input=replayer.apply)
+        sender.run()
+        self.log_message(f"Stopped sharing screen with {peer_code} ({sender.frames_sent} frames, {sender.bytes_sent} bytes, {replayer.events_applied} input events)")
 
     def show_recent_connections(self):
         connections = "\n".join(self.recent_connections) if self.recent_connections else "No recent connections."
@@ -217,20 +362,10 @@ class RemoteControlApp:
         """Initialize and connect the client after the server is running."""
         try:
             time.sleep(1)  # Ensure server has started before client connects
-            self.client = P_Client(self.server_ip, 12345)
+            self.client = P_Client(self.server_ip, 12345, approval=TkApprovalPolicy(self.root))
+            self.client.on_session = self.on_session
             self.log_message(f"Connecting to server at {self.server_ip}:12345")
 
-            # Override the P_Client's print functionality
-            original_print = print
-
-            def custom_print(*args, **kwargs):
-                message = " ".join(map(str, args))
-                self.log_message(message)
-                original_print(*args, **kwargs)
-
-            import builtins
-            builtins.print = custom_print
-
             self.client.connect_to_server()
             self.log_message("Connected to server successfully")
 
@@ -0,0 +1,173 @@
+import threading
+import time
+from collections import deque
+
+
+TARGET_LATENCY = 0.15  # Seconds from capture to the viewer's acknowledgement
+ADJUST_INTERVAL = 0.5
+RTT_SAMPLES = 256
+RATE_WINDOW = 2.0  # Seconds of delivery-rate samples the bandwidth estimate is the max of
+
+
+class AdaptiveController:
+    """Chooses frame rate, compression level and frame skipping for a screen session.
+
+    The sender reports every frame it sends (`on_send`) and every
+    acknowledgement it gets back (`on_ack`). From those it tracks the
+    round-trip time (EWMA and minimum) and the delivery rate: bytes
+    acknowledged between a frame's send and its ack over the time that
+    took. The bandwidth estimate is the highest rate seen over the last
+    few seconds, so idle periods (a static desktop) do not drag it down.
+
+    Before capturing, `should_send` skips the frame if the oldest frame in
+    flight is already over the latency target, or if the bytes in flight
+    would take longer than that to drain, which keeps queues from
+    building up on slow links. Every `adjust_interval`
+    `adjust` cuts the frame rate and raises compression when latency is
+    over target (or the encoder is saturating the CPU), and probes back up
+    when there is headroom. `metrics()` exposes the current decisions.
+    """
+
+    def __init__(self, target_latency=TARGET_LATENCY, fps=10, min_fps=2, max_fps=30,
+                 level=1, min_level=1, max_level=9, adjust_interval=ADJUST_INTERVAL):
+        self.target_latency = target_latency
+        self.fps = float(fps)
+        self.min_fps = min_fps
+        self.max_fps = max_fps
+        self.level = level
+        self.min_level = min_level
+        self.max_level = max_level
+        self.adjust_interval = adjust_interval
+
+        self.inflight = {}  # {seq: (sent_ns, size, delivered, delivered_ns)}, oldest first
+        self.inflight_bytes = 0
+        self.delivered = 0  # Bytes acknowledged so far
+        self.delivered_ns = 0  # When the last acknowledgement arrived
+        self.rate_samples = deque()  # (monotonic_ns, bytes per second)
+        self.rtt = None  # EWMA, seconds
+        self.min_rtt = None
+        self.throughput = None  # EWMA, bytes per second
+        self.rtt_samples = deque(maxlen=RTT_SAMPLES)
+        self.encode_seconds = 0.0  # Since the last adjustment
+        self.encoded_frames = 0
+        self.next_adjust = time.monotonic() + adjust_interval
+        self.lock = threading.Lock()  # Acks arrive on the session's reader thread
+
+        self.frames_sent = 0
+        self.frames_acked = 0
+        self.frames_skipped = 0
+        self.bytes_sent = 0
+        self.last_decision = "start"
+
+    def on_send(self, seq, size, sent_ns):
+        with self.lock:
+            self.inflight[seq] = (sent_ns, size, self.delivered, self.delivered_ns or sent_ns)
+            self.inflight_bytes += size
+        self.frames_sent += 1
+        self.bytes_sent += size
+
+    def on_ack(self, seq, now_ns=None):
+        now_ns = now_ns or time.monotonic_ns()
+        with self.lock:
+            entry = self.inflight.pop(seq, None)
+            if entry is None:
+                return
+            sent_ns, size, delivered_before, delivered_ns_before = entry
+            self.inflight_bytes -= size
+            self.delivered += size
+            self.delivered_ns = now_ns
+            self.frames_acked += 1
+
+            sample = (now_ns - sent_ns) / 1e9
+            self.rtt_samples.append(sample)
+            self.rtt = sample if self.rtt is None else 0.8 * self.rtt + 0.2 * sample
+            self.min_rtt = sample if self.min_rtt is None else min(self.min_rtt, sample)
+
+            elapsed = (now_ns - delivered_ns_before) / 1e9
+            if elapsed > 0:
+                self.rate_samples.append((now_ns, (self.delivered - delivered_before) / elapsed))
+            horizon = now_ns - int(RATE_WINDOW * 1e9)
+            while self.rate_samples and self.rate_samples[0][0] < horizon:
+                self.rate_samples.popleft()
+            self.throughput = max(rate for _, rate in self.rate_samples) if self.rate_samples else None
+
+    def on_encode(self, seconds):
+        self.encode_seconds += seconds
+        self.encoded_frames += 1
+
+    def queue_delay(self):
+        """Seconds the bytes in flight need to drain at the measured rate."""
+        if not self.throughput:
+            return 0.0
+        return self.inflight_bytes / self.throughput
+
+    def oldest_inflight_age(self):
+        with self.lock:
+            if not self.inflight:
+                return 0.0
+            sent_ns = next(iter(self.inflight.values()))[0]
+        return (time.monotonic_ns() - sent_ns) / 1e9
+
+    def latency(self):
+        """Estimated capture-to-ack latency of a frame sent now."""
+        return max((self.min_rtt or 0.0) + self.queue_delay(), self.oldest_inflight_age())
+
+    def should_send(self):
+        """Return False if this frame should be skipped to let the link drain."""
+        if self.inflight and self.latency() > self.target_latency:
+            self.frames_skipped += 1
+            return False
+        return True
+
+    def frame_interval(self):
+        return 1.0 / self.fps
+
+    def adjust(self, now=None):
+        """Revisit frame rate and compression level if the interval has passed."""
+        now = now or time.monotonic()
+        if now < self.next_adjust:
+            return
+        self.next_adjust = now + self.adjust_interval
+
+        encode_time = self.encode_seconds / self.encoded_frames if self.encoded_frames else 0.0
+        cpu_busy = encode_time * self.fps  # Fraction of each second spent encoding
+        self.encode_seconds = 0.0
+        self.encoded_frames = 0
+        latency = max(self.rtt or 0.0, self.latency())
+
+        if cpu_busy > 0.8:
+            # The encoder cannot keep up: fewer, cheaper frames
+            self.fps = max(self.min_fps, self.fps * 0.75)
+            self.level = max(self.min_level, self.level - 1)
+            self.last_decision = "cpu_bound"
+        elif latency > self.target_latency:
+            # The link is the bottleneck: fewer, smaller frames
+            self.fps = max(self.min_fps, self.fps * 0.7)
+            self.level = min(self.max_level, self.level + 2)
+            self.last_decision = "congested"
+        elif latency < self.target_latency / 2:
+            self.fps = min(self.max_fps, self.fps + 1)
+            if cpu_busy < 0.3:
+                self.level = max(self.min_level, self.level - 1)
+            self.last_decision = "probe_up"
+        else:
+            self.last_decision = "hold"
+
+    def metrics(self):
+        ordered = sorted(self.rtt_samples)
+        p95 = ordered[int(0.95 * (len(ordered) - 1))] if ordered else 0.0
+        return {
+            "fps": round(self.fps, 2),
+            "level": self.level,
+            "rtt_ms": (self.rtt or 0.0) * 1000,
+            "rtt_p95_ms": p95 * 1000,
+            "min_rtt_ms": (self.min_rtt or 0.0) * 1000,
+            "throughput_kbps": (self.throughput or 0.0) * 8 / 1000,
+            "inflight_bytes": self.inflight_bytes,
+            "queue_delay_ms": self.queue_delay() * 1000,
+            "frames_sent": self.frames_sent,
+            "frames_acked": self.frames_acked,
+            "frames_skipped": self.frames_skipped,
+            "bytes_sent": self.bytes_sent,
+            "decision": self.last_decision,
+        }
@@ -0,0 +1,175 @@
+import random
+import threading
+import time
+from collections import OrderedDict
+
+
+DIGITS = "0123456789"
+
+
+class CodeSpaceExhausted(RuntimeError):
+    """Raised when every code in the configured space is taken."""
+
+
+class CodeAllocator:
+    """Hands out unique client codes in constant time.
+
+    Codes are `length` characters from `alphabet`. Unless `leading_zero` is
+    set the first character is never alphabet[0], so the defaults give the
+    familiar 1000-9999 range; a longer length or alphabet grows the space.
+
+    Free codes are kept as a lazily shuffled array of indices: only
+    positions that were swapped are stored, so allocating and releasing are
+    O(1) and memory grows with the number of codes handed out, not with the
+    size of the space. `owners` is the code->ip reverse index, and
+    `last_seen` orders IPs by activity so idle codes can be reclaimed.
+    """
+
+    def __init__(self, length=4, alphabet=DIGITS, leading_zero=False, rng=None):
+        if length < 1 or len(alphabet) < 2 or len(set(alphabet)) != len(alphabet):
+            raise ValueError("Code length must be positive and the alphabet at least two distinct characters")
+        self.length = length
+        self.alphabet = alphabet
+        self.digit_values = {char: i for i, char in enumerate(alphabet)}
+        base = len(alphabet)
+        self.offset = 0 if leading_zero else base ** (length - 1)
+        self.size = base ** length - self.offset
+        self.rng = rng or random.SystemRandom()
+
+        self.free_count = self.size
+        self.swaps = {}  # {position: index} for shuffled positions
+        self.where = {}  # {index: position}, inverse of swaps
+        self.owners = {}  # {code: ip}
+        self.last_seen = OrderedDict()  # {ip: (monotonic time, code)}, least recent first
+        self.lock = threading.Lock()
+
+    def encode(self, index):
+        """Turn an index in the code space into its code string."""
+        value = index + self.offset
+        base = len(self.alphabet)
+        chars = []
+        for _ in range(self.length):
+            value, digit = divmod(value, base)
+            chars.append(self.alphabet[digit])
+        return "".join(reversed(chars))
+
+    def decode(self, code):
+        """Turn a code back into its index, or None if it is outside the space."""
+        if len(code) != self.length:
+            return None
+        base = len(self.alphabet)
+        value = 0
+        for char in code:
+            digit = self.digit_values.get(char)
+            if digit is None:
+                return None
+            value = value * base + digit
+        index = value - self.offset
+        return index if 0 <= index < self.size else None
+
+    def _value_at(self, position):
+        return self.swaps.get(position, position)
+
+    def _place(self, position, index):
+        if position == index:
+            self.swaps.pop(position, None)
+            self.where.pop(index, None)
+        else:
+            self.swaps[position] = index
+            self.where[index] = position
+
+    def _take(self, position):
+        """Remove the free index at `position` by moving the last free index into it."""
+        index = self._value_at(position)
+        last = self.free_count - 1
+        self._place(position, self._value_at(last))
+        self.swaps.pop(last, None)
+        self.where.pop(index, None)
+        self.free_count = last
+        return index
+
+    def _free_position(self, index):
+        position = self.where.get(index, index)
+        if position < self.free_count and self._value_at(position) == index:
+            return position
+        return None
+
+    def allocate(self, ip):
+        """Pick a random free code for `ip`."""
+        with self.lock:
+            if self.free_count == 0:
+                raise CodeSpaceExhausted(f"All {self.size} codes are in use")
+            index = self._take(self.rng.randrange(self.free_count))
+            code = self.encode(index)
+            self.owners[code] = ip
+            self._touch(ip, code)
+            return code
+
+    def reserve(self, code, ip):
+        """Mark a code loaded from the registry as taken by `ip`.
+
+        Codes outside the configured space (e.g. after shrinking it) are
+        still indexed so lookups keep working; they just never come back
+        to the free list.
+        """
+        with self.lock:
+            index = self.decode(code)
+            if index is not None:
+                position = self._free_position(index)
+                if position is not None:
+                    self._take(position)
+            self.owners[code] = ip
+            self._touch(ip, code)
+
+    def release(self, code):
+        """Return a code to the free list."""
+        with self.lock:
+            ip = self.owners.pop(code, None)
+            if ip is not None:
+                self.last_seen.pop(ip, None)
+            index = self.decode(code)
+            if index is not None and self._free_position(index) is None:
+                self._place(self.free_count, index)
+                self.free_count += 1
+
+    def owner(self, code):
+        """Return the IP holding `code`, or None."""
+        return self.owners.get(code)
+
+    def touch(self, ip):
+        """Record activity for `ip` so its code is not reclaimed."""
+        with self.lock:
+            entry = self.last_seen.get(ip)
+            if entry is not None:
+                self._touch(ip, entry[1])
+
+    def _touch(self, ip, code):
+        self.last_seen[ip] = (time.monotonic(), code)
+        self.last_seen.move_to_end(ip)
+
+    def reclaim_idle(self, ttl, keep=None):
+        """Free the codes of IPs not seen for `ttl` seconds.
+
+        `keep(ip, code)` can veto reclaiming an entry (e.g. while the
+        client is connected); vetoed entries count as seen now. Returns the
+        reclaimed (ip, code) pairs so the caller can drop them from the
+        registry. Only the expired head of `last_seen` is visited.
+        """
+        deadline = time.monotonic() - ttl
+        reclaimed = []
+        with self.lock:
+            while self.last_seen:
+                ip, (seen_at, code) = next(iter(self.last_seen.items()))
+                if seen_at > deadline:
+                    break
+                if keep is not None and keep(ip, code):
+                    self._touch(ip, code)
+                    continue
+                del self.last_seen[ip]
+                reclaimed.append((ip, code))
+        for ip, code in reclaimed:
+            self.release(code)
+        return reclaimed
+
+    def __len__(self):
+        return len(self.owners)
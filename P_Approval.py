@@ -0,0 +1,139 @@
+import fnmatch
+import threading
+
+
+# An approval policy answers "may this code control my screen?" through
+# decide(requesting_code) -> bool. Policies with `blocking = True` may wait
+# for a person, so the client asks them off its network thread.
+
+
+class FixedPolicy:
+    """Always gives the same answer (headless agents, load tests)."""
+
+    blocking = False
+
+    def __init__(self, approve=False):
+        self.approve = approve
+
+    def decide(self, requesting_code):
+        return self.approve
+
+
+class CallbackPolicy:
+    """Asks `callback(requesting_code)`, which returns True to approve."""
+
+    blocking = True
+
+    def __init__(self, callback):
+        self.callback = callback
+
+    def decide(self, requesting_code):
+        return bool(self.callback(requesting_code))
+
+
+class RulePolicy:
+    """Decides by the first matching rule, or asks `fallback` when none match.
+
+    `rules` is a sequence of (pattern, approve) pairs; patterns are
+    shell-style, so "12*" matches every code starting with 12. With no
+    fallback, unmatched codes are rejected.
+    """
+
+    def __init__(self, rules, fallback=None):
+        self.rules = list(rules)
+        self.fallback = fallback or FixedPolicy(False)
+        self.blocking = self.fallback.blocking
+
+    def decide(self, requesting_code):
+        for pattern, approve in self.rules:
+            if fnmatch.fnmatchcase(requesting_code, pattern):
+                return approve
+        return self.fallback.decide(requesting_code)
+
+
+class AllowlistPolicy:
+    """Approves the listed codes; others are rejected or asked of `fallback`."""
+
+    def __init__(self, codes, fallback=None):
+        self.codes = set(codes)
+        self.fallback = fallback or FixedPolicy(False)
+        self.blocking = self.fallback.blocking
+
+    def decide(self, requesting_code):
+        if requesting_code in self.codes:
+            return True
+        return self.fallback.decide(requesting_code)
+
+
+class TkApprovalPolicy:
+    """Asks the user with a Tk yes/no dialog on the application's window.
+
+    The dialog is opened on `root`'s event loop and the calling thread
+    waits for the answer. After `timeout` seconds the dialog is closed and
+    the request rejected, so a late click cannot approve it. tkinter is
+    only imported here, so headless clients never load it.
+    """
+
+    blocking = True
+
+    def __init__(self, root, timeout=None):
+        if root is None:
+            raise ValueError("TkApprovalPolicy needs the application's Tk root window")
+        import tkinter
+
+        self.tk = tkinter
+        self.root = root
+        self.timeout = timeout  # Seconds before an unanswered dialog counts as a rejection
+
+    def show_dialog(self, requesting_code, answer):
+        """Open the dialog; runs on the Tk thread. The first of a click, closing it or the timeout wins."""
+        if answer.answered.is_set():
+            return None  # Rejected before the Tk loop got to it
+        window = self.tk.Toplevel(self.root)
+        window.title("Connection Request")
+        window.resizable(False, False)
+
+        def settle(approve):
+            answer.settle(approve)
+            window.destroy()
+
+        self.tk.Label(window, text=f"Client {requesting_code} wants to connect. Approve?",
+                      padx=20, pady=10).pack()
+        buttons = self.tk.Frame(window)
+        buttons.pack(pady=(0, 10))
+        self.tk.Button(buttons, text="Yes", width=8, command=lambda: settle(True)).pack(side="left", padx=5)
+        self.tk.Button(buttons, text="No", width=8, command=lambda: settle(False)).pack(side="left", padx=5)
+        window.protocol("WM_DELETE_WINDOW", lambda: settle(False))
+        if self.timeout is not None:
+            window.after(int(self.timeout * 1000), lambda: settle(False))
+        window.lift()
+        window.focus_force()
+        return window
+
+    def decide(self, requesting_code):
+        answer = Answer()
+        if threading.current_thread() is threading.main_thread():
+            # Already on the Tk thread: run the event loop until the dialog closes
+            self.root.wait_window(self.show_dialog(requesting_code, answer))
+        else:
+            self.root.after(0, lambda: self.show_dialog(requesting_code, answer))
+            # The dialog times itself out; this only guards against a Tk loop that has stopped
+            answer.answered.wait(self.timeout + 1 if self.timeout is not None else None)
+        return answer.settle(False)
+
+
+class Answer:
+    """A yes/no that can be given once, from any thread; later answers are ignored."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.answered = threading.Event()
+        self.value = None
+
+    def settle(self, approve):
+        """Give `approve` unless an answer was given already. Returns the answer that stands."""
+        with self.lock:
+            if self.value is None:
+                self.value = approve
+                self.answered.set()
+            return self.value
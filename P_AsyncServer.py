@@ -0,0 +1,213 @@
+import asyncio
+import logging
+import socket
+
+from P_Protocol import FrameDecoder, ProtocolError, enable_keepalive, encode_message
+
+try:
+    import resource
+except ImportError:  # Not available on Windows
+    resource = None
+
+log = logging.getLogger(__name__)
+
+
+class ClientProtocol(asyncio.Protocol):
+    """One connected client, served from the event loop.
+
+    A protocol object costs far less than a thread or a stream task, which
+    keeps memory flat with tens of thousands of idle clients. It exposes
+    the same `send_message` and `close` as P_Protocol.Connection.
+    """
+
+    __slots__ = ("server", "transport", "addr", "code", "version", "decoder", "binary", "capture", "capture_id")
+
+    def __init__(self, server):
+        self.server = server
+        self.transport = None
+        self.addr = None
+        self.code = None
+        self.version = 0  # Until the client's HELLO, as in Connection
+        self.decoder = FrameDecoder()
+        self.binary = False
+        self.capture = None  # Set by the server's CaptureWriter, like Connection.capture
+        self.capture_id = 0
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.addr = transport.get_extra_info("peername")
+        enable_keepalive(transport.get_extra_info("socket"))
+        if self.server.code_lookup_blocks(self.addr[0]):
+            # The code comes from another process; ask from a worker thread so
+            # the loop keeps serving everyone else, and hold this client's input
+            transport.pause_reading()
+            lookup = asyncio.get_running_loop().run_in_executor(None, self.server.generate_code, self.addr[0])
+            lookup.add_done_callback(self.code_looked_up)
+            return
+        self.code = self.server.register_client(self, self.addr)
+
+    def code_looked_up(self, lookup):
+        if lookup.cancelled() or self.transport.is_closing():
+            return
+        error = lookup.exception()
+        self.code = self.server.register_client(self, self.addr, None if error else lookup.result(), error)
+        if self.code is not None:
+            self.transport.resume_reading()
+
+    def data_received(self, data):
+        if self.code is None or not self.server.running:
+            return
+        try:
+            messages = self.decoder.feed(data)
+            if self.decoder.binary:
+                self.binary = True
+            for command, payload in messages:
+                self.server.process_message(self.code, self.addr, self, command, payload)
+        except ProtocolError as e:
+            log.warning("Protocol error from %s: %s", self.addr, e)
+            self.server.errors_total.inc()
+            self.transport.close()
+        except Exception as e:
+            log.warning("Error handling client %s: %s", self.addr, e)
+            self.server.errors_total.inc()
+            self.transport.close()
+
+    def connection_lost(self, exc):
+        if self.code is not None:
+            self.server.remove_client(self.code, self)
+
+    def send_message(self, command, payload=""):
+        """Buffer a message on the transport, applying the slow-consumer policy.
+
+        The event loop never blocks on a write; the transport's buffer is
+        this client's queue, bounded by the server's `max_queue_bytes`.
+        """
+        if self.transport.is_closing():
+            return False
+        data = encode_message(command, payload, self.binary)
+        if self.transport.get_write_buffer_size() + len(data) > self.server.max_queue_bytes:
+            disconnect = self.server.slow_policy == "disconnect"
+            self.server.record_overflow(self, disconnect)
+            if disconnect:
+                self.transport.abort()
+            return False
+        self.transport.write(data)
+        if self.capture is not None:
+            self.capture.sent(self, command, payload)
+        return True
+
+    def queue_depth(self):
+        return self.transport.get_write_buffer_size()
+
+    def close(self):
+        self.transport.close()
+
+
+class AsyncEngine:
+    """Run a P_Server on a single asyncio event loop instead of a thread per client."""
+
+    def __init__(self, server, backlog=socket.SOMAXCONN):
+        self.server = server
+        self.backlog = backlog
+        self.loop = None
+        self.stopped = None
+        self.reclaim_handle = None
+        self.timer_handle = None
+
+    def run(self):
+        """Serve until `stop` is called. Blocks the calling thread."""
+        raise_fd_limit()
+        asyncio.run(self.serve())
+
+    async def serve(self):
+        self.loop = asyncio.get_running_loop()
+        self.stopped = asyncio.Event()
+
+        # The threaded engine keeps a short backlog and an accept timeout;
+        # neither makes sense for a non-blocking listener
+        sock = self.server.server_socket
+        sock.settimeout(None)
+        sock.listen(self.backlog)
+
+        if self.server.accept_limiter is None and self.server.ip_limiter is None:
+            listener = await self.loop.create_server(lambda: ClientProtocol(self.server), sock=sock)
+        else:
+            # create_server accepts as fast as connections arrive and builds a
+            # transport for each; pace them and shed abusers first instead
+            sock.setblocking(False)
+            listener = RateLimitedListener(self.loop.create_task(self.accept_limited(sock)), sock)
+        log.info("Server is running and waiting for connections (asyncio engine)...")
+        self.reclaim_handle = self.loop.call_later(self.server.reclaim_interval, self.reclaim_codes)
+        self.timer_handle = self.loop.call_later(self.server.timers.tick, self.advance_timers)
+        async with listener:
+            await self.stopped.wait()
+            self.reclaim_handle.cancel()
+            self.timer_handle.cancel()
+            for code in self.server.clients.codes():
+                self.server.remove_client(code)
+
+    async def accept_limited(self, sock):
+        """Accept loop that applies the server's accept limits.
+
+        Takes one token from the accept limiter per connection, if there is
+        one, and closes connections the server does not `admit` before a
+        transport or protocol is created for them.
+        """
+        limiter = self.server.accept_limiter
+        while True:
+            if limiter is not None and not limiter.take():
+                await asyncio.sleep(limiter.delay())
+                continue
+            try:
+                conn, addr = await self.loop.sock_accept(sock)
+                if not self.server.admit(addr):
+                    conn.close()
+                    continue
+                await self.loop.connect_accepted_socket(lambda: ClientProtocol(self.server), conn)
+            except OSError as e:
+                log.warning("Error accepting connection: %s", e)
+                await asyncio.sleep(1)  # Wait before trying again
+
+    def reclaim_codes(self):
+        self.server.reclaim_codes()
+        self.reclaim_handle = self.loop.call_later(self.server.reclaim_interval, self.reclaim_codes)
+
+    def advance_timers(self):
+        """Expire request timeouts on the loop, which owns the client protocols."""
+        self.server.timers.advance()
+        self.timer_handle = self.loop.call_later(self.server.timers.tick, self.advance_timers)
+
+    def stop(self):
+        """Stop serving. Safe to call from any thread."""
+        if self.loop is not None and not self.loop.is_closed():
+            try:
+                self.loop.call_soon_threadsafe(self.stopped.set)
+            except RuntimeError:
+                pass  # Loop already shut down
+
+
+class RateLimitedListener:
+    """Async context manager that stops an accept task and closes its socket, like asyncio's Server."""
+
+    def __init__(self, task, sock):
+        self.task = task
+        self.sock = sock
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        self.task.cancel()
+        self.sock.close()
+
+
+def raise_fd_limit():
+    """Raise the open file limit to the hard limit so many clients can connect."""
+    if resource is None:
+        return
+    try:
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        if hard == resource.RLIM_INFINITY or soft < hard:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    except (ValueError, OSError) as e:
+        log.warning("Could not raise open file limit: %s", e)
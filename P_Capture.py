@@ -0,0 +1,169 @@
+import hmac
+import itertools
+import logging
+import mmap
+import secrets
+import struct
+import threading
+import time
+
+from P_Direct import format_endpoint
+from P_Protocol import COMMANDS, OPCODES
+
+log = logging.getLogger(__name__)
+
+
+# A capture file is a header, then one record per event: nanoseconds since
+# the capture started, the connection's capture id, the kind of event, the
+# message's opcode (0 for none or invalid) and the payload length, then the
+# payload. The file is preallocated and written through a shared mapping,
+# so the unused tail is zeros; a zero kind marks the end of the records.
+FILE_MAGIC = b"PCAP"
+FILE_VERSION = 1
+FILE_HEADER = struct.Struct("!4sBd")  # Magic, version, wall-clock start time
+RECORD = struct.Struct("!QIBBI")
+OPEN = 1  # Payload is the client's "ip:port"
+INBOUND = 2
+OUTBOUND = 3
+CLOSE = 4
+KINDS = {OPEN: "open", INBOUND: "in", OUTBOUND: "out", CLOSE: "close"}
+CHUNK_SIZE = 16 * 1024 * 1024  # The file grows by this much at a time
+MAX_CAPTURE_BYTES = 1024 * 1024 * 1024  # Past this, records are dropped and counted
+# Where each command carries a credential: the index of the comma-separated
+# field, or None when the whole payload is one (see redact)
+SECRET_FIELDS = {"HELLO": 1, "RESUME": None, "SESSION": 0, "PATH": 0}
+
+
+class CaptureWriter:
+    """Appends control-channel events to a capture file.
+
+    Records are packed straight into a memory-mapped file under one lock:
+    no system call and no extra copy per message, only a remap every
+    CHUNK_SIZE bytes. The kernel writes the pages back in the background,
+    and they survive a crash of the process, so a capture can be left on
+    in production. Once `max_bytes` is reached new records are dropped and
+    counted in `dropped`. Resume and session tokens are redacted before
+    they are written.
+    """
+
+    def __init__(self, path, chunk_size=CHUNK_SIZE, max_bytes=MAX_CAPTURE_BYTES):
+        self.path = path
+        self.chunk_size = chunk_size
+        self.max_bytes = max(max_bytes, FILE_HEADER.size + RECORD.size)
+        self.lock = threading.Lock()
+        self.ids = itertools.count(1)
+        self.redact_key = secrets.token_bytes(32)  # Never written out
+        self.records = 0
+        self.dropped = 0
+        self.file = open(path, "w+b")
+        self.file.truncate(min(chunk_size, self.max_bytes))
+        self.map = mmap.mmap(self.file.fileno(), 0)
+        FILE_HEADER.pack_into(self.map, 0, FILE_MAGIC, FILE_VERSION, time.time())
+        self.offset = FILE_HEADER.size
+        self.started = time.monotonic_ns()
+
+    def connection_opened(self, conn, addr):
+        """Give `conn` a capture id and record its arrival; its sends are captured from now on."""
+        conn.capture_id = next(self.ids)
+        conn.capture = self
+        self.record(conn.capture_id, OPEN, None, format_endpoint(addr))
+
+    def connection_closed(self, conn):
+        if conn.capture is self:
+            self.record(conn.capture_id, CLOSE, None, "")
+
+    def received(self, conn, command, payload):
+        self.record(conn.capture_id, INBOUND, command, self.redact(command, payload))
+
+    def sent(self, conn, command, payload):
+        self.record(conn.capture_id, OUTBOUND, command, self.redact(command, payload))
+
+    def redact(self, command, payload):
+        """Replace the token fields of `payload` with a keyed hash.
+
+        The key lives only as long as the writer, so the capture cannot be
+        used to resume a client or join a session, but within one capture a
+        token always hashes the same, and a replay can still tell which
+        PATH belongs to which SESSION.
+        """
+        if command not in SECRET_FIELDS or not isinstance(payload, str):
+            return payload
+        index = SECRET_FIELDS[command]
+        if index is None:
+            return self.hash_token(payload) if payload else payload
+        fields = payload.split(",")
+        if len(fields) > index and fields[index]:
+            fields[index] = self.hash_token(fields[index])
+        return ",".join(fields)
+
+    def hash_token(self, token):
+        return "redacted-" + hmac.new(self.redact_key, token.encode(), "sha256").hexdigest()[:32]
+
+    def record(self, conn_id, kind, command, payload):
+        """Append one event. `payload` may be text or bytes."""
+        body = payload.encode() if isinstance(payload, str) else payload
+        with self.lock:
+            if self.map is None:
+                return
+            end = self.offset + RECORD.size + len(body)
+            if end > len(self.map) and not self.grow(end):
+                self.dropped += 1
+                return
+            RECORD.pack_into(self.map, self.offset, time.monotonic_ns() - self.started, conn_id, kind,
+                             OPCODES.get(command, 0), len(body))
+            self.map[self.offset + RECORD.size:end] = body
+            self.offset = end
+            self.records += 1
+
+    def grow(self, needed):
+        """Extend the file and mapping to fit `needed` bytes. Called with the lock held."""
+        if needed > self.max_bytes:
+            if not self.dropped:
+                log.warning("Capture %s reached %s bytes; dropping further records", self.path, self.max_bytes)
+            return False
+        size = min(self.max_bytes, max(needed, len(self.map) + self.chunk_size))
+        self.map.close()
+        self.file.truncate(size)
+        self.map = mmap.mmap(self.file.fileno(), 0)
+        return True
+
+    @property
+    def size(self):
+        return self.offset
+
+    def close(self):
+        """Flush the mapping and trim the file to the records written."""
+        with self.lock:
+            if self.map is None:
+                return
+            self.map.flush()
+            self.map.close()
+            self.map = None
+            self.file.truncate(self.offset)
+            self.file.close()
+        log.info("Capture %s closed: %s records, %s dropped", self.path, self.records, self.dropped)
+
+
+def read_capture(path):
+    """Yield (ns since start, connection id, kind, command, payload) for each record of a capture.
+
+    `command` is None for OPEN and CLOSE records and for invalid messages;
+    payloads are text. Stops at the end of the records, including the
+    zeroed tail of a capture whose writer never closed it.
+    """
+    with open(path, "rb") as file:
+        with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            if len(data) < FILE_HEADER.size:
+                raise ValueError(f"{path} is not a capture file")
+            magic, version, _ = FILE_HEADER.unpack_from(data, 0)
+            if magic != FILE_MAGIC or version != FILE_VERSION:
+                raise ValueError(f"{path} is not a version {FILE_VERSION} capture file")
+            offset = FILE_HEADER.size
+            while offset + RECORD.size <= len(data):
+                elapsed, conn_id, kind, opcode, length = RECORD.unpack_from(data, offset)
+                start = offset + RECORD.size
+                if kind not in KINDS or start + length > len(data):
+                    return
+                payload = data[start:start + length].decode(errors="replace")
+                yield elapsed, conn_id, kind, COMMANDS.get(opcode), payload
+                offset = start + length
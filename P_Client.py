@@ -1,138 +1,426 @@
+import itertools
+import logging
+import random
 import socket
 import threading
-import tkinter as tk
-from tkinter import messagebox
+import time
+from concurrent.futures import Future
+
+from P_Approval import FixedPolicy
+from P_Codec import CODECS, LINK_MBPS, NONE, CodecProbe, get_codec
+from P_Direct import connect_direct, parse_endpoint, share_port
+from P_Protocol import Connection, ProtocolError, enable_keepalive
+from P_Timers import TimerWheel
+
+log = logging.getLogger(__name__)
+
+
+# 2: sends heartbeats, 3: resumes with a token after reconnecting, 4: tries direct sessions,
+# 5: negotiates a session codec
+PROTOCOL_VERSION = "5"
+REQUEST_TIMEOUT = 60  # Seconds to wait for the target's decision
+HEARTBEAT_INTERVAL = 5  # Seconds between PINGs; the server gives up after a few missed ones
+MISSED_HEARTBEATS = 3  # Silent intervals before the server is considered gone
+RECONNECT_BASE_DELAY = 1.0  # Seconds; the backoff doubles per failed attempt...
+RECONNECT_MAX_DELAY = 60.0  # ...up to this
+
+shared_wheel = None
+shared_wheel_lock = threading.Lock()
+
+
+class RequestFailed(Exception):
+    """A connection request was refused by the server, timed out, or lost with the connection."""
+
+
+def shared_timers():
+    """The TimerWheel clients use unless given their own.
+
+    One daemon thread drives it for every client in the process, so
+    heartbeats and request timeouts of hundreds of clients cost one thread
+    and one wheel instead of one each.
+    """
+    global shared_wheel
+    with shared_wheel_lock:
+        if shared_wheel is None:
+            shared_wheel = TimerWheel()
+            threading.Thread(target=shared_wheel.run, args=(lambda: True,), daemon=True).start()
+        return shared_wheel
 
 
 class P_Client:
-    def __init__(self, server_host, server_port):
+    """Protocol client without any GUI.
+
+    Incoming connection requests are answered by `approval`, a policy from
+    P_Approval; the default rejects them all. Pass a TkApprovalPolicy to
+    ask the user. `timers` is a TimerWheel the caller drives; by default
+    the process-wide one from shared_timers() is used.
+    """
+
+    def __init__(self, server_host, server_port, heartbeat_interval=HEARTBEAT_INTERVAL, reconnect=True,
+                 source_address=None, approval=None, timers=None, direct=True, link_mbps=LINK_MBPS):
         self.server_host = server_host
         self.server_port = server_port
-        self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.server_socket.settimeout(10)  # Add timeout for connection attempts
+        self.source_address = source_address  # Local (host, port) to connect from, if not the default
+        self.open_socket()
         self.client_code = None
-        self.approval_event = threading.Event()
-        self.approval_result = None
+        self.resume_token = None  # From the server; gets our code back after a reconnect
+        self.reconnect = reconnect
+        self.closed = False  # Set by disconnect(); stops reconnecting
+        self.generation = 0  # Counts connections, so timers of an old one stop
+        # Random start: ids must not repeat for as long as the code lives, and a
+        # restarted client gets its old code back but would count from 1 again
+        self.request_ids = itertools.count(random.randrange(1, 1 << 48))
+        self.pending_requests = {}  # {request id: (target code, Future, Timer, REQUEST payload)}
+        self.pending_lock = threading.Lock()
+        self.timers = timers or shared_timers()  # Times out pending requests and sends heartbeats
+        self.approval = approval or FixedPolicy(False)
+        self.sessions = {}  # {peer code: (token, relay port, peer endpoint or None, active)}
+        self.direct = direct  # Try a direct connection to the peer before the relay
+        self.session_paths = {}  # {peer code: "direct" or "relay"} for the latest session with each peer
+        self.session_codecs = {}  # {peer code: codec name} negotiated with the latest request
+        self.link_mbps = link_mbps  # Link speed assumed when choosing a codec
+        self.local_address = None  # (ip, port) of the control connection
+        self.session_ready = threading.Condition()
+        self.on_session = None  # Called with (peer code, token) when the server opens a relay session
+        self.heartbeat_interval = heartbeat_interval
+        self.last_received = 0.0  # Monotonic time of the last data from the server
+        self.rtt = None  # Seconds, from the last PONG
         self.connected = False
 
+    def open_socket(self):
+        self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.server_socket.settimeout(10)  # Add timeout for connection attempts
+        # Direct sessions leave from this same port, where the peer expects them
+        share_port(self.server_socket)
+        if self.source_address is not None:
+            self.server_socket.bind(self.source_address)
+        self.connection = Connection(self.server_socket, binary=True)
+
     def connect_to_server(self):
         """Connect to the server and start listening for messages."""
         try:
+            if self.server_socket.getsockname()[1] == 0:
+                self.server_socket.bind(("", 0))  # Bind explicitly so the port can be shared
             self.server_socket.connect((self.server_host, self.server_port))
+            enable_keepalive(self.server_socket)
+            self.local_address = self.server_socket.getsockname()
+            hello = f"{PROTOCOL_VERSION},{self.resume_token}" if self.resume_token else PROTOCOL_VERSION
+            self.connection.send_message("HELLO", hello)  # Switch the server to binary framing
             self.connected = True
+            self.last_received = time.monotonic()
+            self.generation += 1
             threading.Thread(target=self.listen_to_server, daemon=True).start()
+            CodecProbe.warm()  # Measure now, not on the UI thread at the first request
+            self.timers.schedule(self.heartbeat_interval, self.heartbeat, self.generation)
+            if self.resume_token:
+                self.resend_pending_requests()
             return True
         except socket.error as e:
-            print(f"Connection failed: {e}")
+            log.info("Connection failed: %s", e)
             return False
 
-    def send_request(self, target_code):
-        """Send a connection request to another client."""
+    def reconnect_loop(self):
+        """Reconnect with exponential backoff and full jitter until it works or disconnect() is called.
+
+        The random delay spreads a fleet of clients that lost the same
+        server over the whole backoff window instead of having them all
+        arrive at once.
+        """
+        attempt = 0
+        while not self.closed:
+            delay = random.uniform(0, min(RECONNECT_MAX_DELAY, RECONNECT_BASE_DELAY * 2 ** attempt))
+            log.debug("Reconnecting in %.1fs", delay)
+            time.sleep(delay)
+            if self.closed:
+                return
+            self.open_socket()
+            if self.connect_to_server():
+                log.info("Reconnected to server")
+                return
+            attempt += 1
+
+    def resend_pending_requests(self):
+        """Re-send requests still waiting for an answer; the server ignores ones it still tracks."""
+        with self.pending_lock:
+            pending = [entry[3] for entry in self.pending_requests.values()]
+        for payload in pending:
+            try:
+                self.connection.send_message("REQUEST", payload)
+            except socket.error as e:
+                log.warning("Error re-sending request: %s", e)
+                return
+
+    def send_request(self, target_code, timeout=REQUEST_TIMEOUT):
+        """Send a connection request to another client.
+
+        Returns a concurrent.futures.Future that resolves to the target's
+        decision ("yes" or "no") or fails with RequestFailed, or None if the
+        request could not be sent. Any number of requests can be in flight;
+        each carries its own id, so replies cannot be mixed up.
+        """
         if not self.connected:
-            print("Not connected to server")
-            return False
+            log.warning("Not connected to server")
+            return None
 
         if target_code == self.client_code:
-            print("ERROR: Cannot send a request to your own code.")
-            return False
+            log.warning("Cannot send a request to your own code")
+            return None
 
+        request_id = str(next(self.request_ids))
+        # The codecs we can run and how fast; the target picks the session's codec
+        payload = f"{target_code},{request_id},{CodecProbe.get().offer()}"
+        future = Future()
+        with self.pending_lock:
+            timer = self.timers.schedule(timeout, self.expire_request, request_id)
+            self.pending_requests[request_id] = (target_code, future, timer, payload)
         try:
-            self.server_socket.send(f"REQUEST:{target_code}".encode())
-            self.approval_event.clear()
-            return True
+            self.connection.send_message("REQUEST", payload)
+            return future
         except socket.error as e:
-            print(f"Error sending request: {e}")
+            log.warning("Error sending request: %s", e)
+            self.settle_request(request_id, error=RequestFailed(str(e)))
+            return None
+
+    async def request(self, target_code, timeout=REQUEST_TIMEOUT):
+        """Awaitable form of `send_request`. Returns the decision or raises RequestFailed."""
+        import asyncio  # Already loaded by whoever awaits this; plain clients skip the import
+
+        future = self.send_request(target_code, timeout)
+        if future is None:
+            raise RequestFailed(f"Could not send a request to {target_code}")
+        return await asyncio.wrap_future(future)
+
+    def settle_request(self, request_id, result=None, error=None):
+        """Resolve a pending request. Returns False if it was already settled."""
+        with self.pending_lock:
+            entry = self.pending_requests.pop(request_id, None)
+        if entry is None:
             return False
+        _, future, timer, _ = entry
+        self.timers.cancel(timer)
+        if error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(result)
+        return True
 
-    def send_approval(self, requesting_code, decision):
-        """Send approval or rejection to the server."""
+    def expire_request(self, request_id):
+        self.settle_request(request_id, error=RequestFailed("Request timed out."))
+
+    def fail_pending_requests(self, reason):
+        with self.pending_lock:
+            request_ids = list(self.pending_requests)
+        for request_id in request_ids:
+            self.settle_request(request_id, error=RequestFailed(reason))
+
+    def heartbeat(self, generation):
+        """Timer callback: PING the server, or drop the connection if it has gone quiet."""
+        if not self.connected or generation != self.generation:
+            return
+        silent = time.monotonic() - self.last_received
+        if silent > self.heartbeat_interval * MISSED_HEARTBEATS:
+            log.warning("Server silent for %.1fs, closing the connection", silent)
+            self.connected = False
+            self.connection.close()  # Wakes listen_to_server
+            return
+        try:
+            # Never block here: this runs on the timer thread shared by every client
+            if not self.connection.try_send_message("PING", str(time.monotonic_ns())):
+                log.debug("Connection busy, skipping heartbeat")
+        except socket.error as e:
+            log.warning("Error sending heartbeat: %s", e)
+        self.timers.schedule(self.heartbeat_interval, self.heartbeat, generation)
+
+    def send_approval(self, requesting_code, decision, request_id=None, codec=None):
+        """Send approval or rejection to the server, with the chosen codec if any."""
         if not self.connected:
-            print("Not connected to server")
+            log.warning("Not connected to server")
             return False
 
         try:
-            self.server_socket.send(f"APPROVAL:{requesting_code},{decision}".encode())
+            if request_id:
+                payload = f"{requesting_code},{request_id},{decision}"
+                if codec:
+                    payload += f",{codec}"
+            else:
+                payload = f"{requesting_code},{decision}"
+            self.connection.send_message("APPROVAL", payload)
             return True
         except socket.error as e:
-            print(f"Error sending approval: {e}")
+            log.warning("Error sending approval: %s", e)
             return False
 
     def listen_to_server(self):
         """Listen for messages from the server."""
         while self.connected:
             try:
-                data = self.server_socket.recv(1024).decode()
-                if not data:
-                    print("Server connection closed")
+                messages = self.connection.recv_messages()
+                if messages is None:
+                    log.info("Server connection closed")
                     self.connected = False
                     break
 
-                if data.startswith("CODE:"):
-                    self.client_code = data.split(":")[1]
-                    print(f"Your permanent code is: {self.client_code}")
-
-                elif data.startswith("APPROVE:"):
-                    requesting_code = data.split(":")[1]
-                    decision = self.show_approval_dialog(requesting_code)
-                    self.send_approval(requesting_code, "yes" if decision else "no")
-
-                elif data.startswith("RESPONSE:"):
-                    self.approval_result = data.split(":")[1]
-                    self.approval_event.set()
-
-                elif data.startswith("ERROR:"):
-                    error_message = data.split(':', 1)[1]
-                    print(f"Server Error: {error_message}")
-                    # If this is a response to a connection request, set the approval event
-                    if "not found" in error_message or "yourself" in error_message:
-                        self.approval_result = "error"
-                        self.approval_event.set()
+                self.last_received = time.monotonic()
+                for command, payload in messages:
+                    self.handle_message(command, payload)
 
             except socket.timeout:
-                print("Socket timeout while listening")
+                log.debug("Socket timeout while listening")
                 continue
+            except ProtocolError as e:
+                log.warning("Protocol error from server: %s", e)
+                self.connected = False
+                break
             except ConnectionResetError:
-                print("Connection was reset by the server")
+                log.warning("Connection was reset by the server")
                 self.connected = False
                 break
             except ConnectionAbortedError:
-                print("Connection was aborted")
+                log.warning("Connection was aborted")
                 self.connected = False
                 break
             except Exception as e:
-                print(f"Error receiving data: {e}")
+                if self.connected:  # Not a close from heartbeat() or disconnect()
+                    log.warning("Error receiving data: %s", e)
                 self.connected = False
                 break
 
-        print("Disconnected from server")
+        log.info("Disconnected from server")
+        if self.reconnect and not self.closed:
+            threading.Thread(target=self.reconnect_loop, daemon=True).start()
+        else:
+            self.fail_pending_requests("Disconnected from server")
 
-    def show_approval_dialog(self, requesting_code):
-        """Show a dialog asking for approval of a connection request."""
-        # Create a new root window for the dialog
-        result = [False]  # Use a list to store the result
+    def handle_message(self, command, payload):
+        """Handle one message received from the server."""
+        if command == "CODE":
+            self.client_code = payload
+            log.info("Your permanent code is: %s", self.client_code)
 
-        def show_dialog():
-            root = tk.Tk()
-            root.withdraw()
-            decision = messagebox.askyesno("Connection Request",
-                                           f"Client {requesting_code} wants to connect. Approve?")
-            result[0] = decision
-            root.destroy()
+        elif command == "APPROVE":
+            # "<requester>[,<request id>[,<codec offer>]]"
+            requesting_code, request_id, offer = (payload.split(",", 2) + ["", ""])[:3]
+            if self.approval.blocking:
+                # Do not hold up heartbeats and other replies while someone decides
+                threading.Thread(target=self.answer_request, args=(requesting_code, request_id, offer),
+                                 daemon=True).start()
+            else:
+                self.answer_request(requesting_code, request_id, offer)
 
-        # Run the dialog in the main thread
-        if threading.current_thread() is threading.main_thread():
-            show_dialog()
-        else:
-            # Schedule the dialog to run on the main thread
-            tk.CallWrapper(show_dialog)
+        elif command == "RESPONSE":
+            # "<decision>[,<request id>[,<codec>]]"
+            decision, _, request_id = payload.partition(",")
+            request_id, _, codec = request_id.partition(",")
+            with self.pending_lock:
+                if not request_id:
+                    # A server that predates request ids; settle the oldest request
+                    request_id = min(self.pending_requests, key=int, default=None)
+                entry = self.pending_requests.get(request_id)
+            if entry is not None:
+                # Always overwrite, before settling so the requester finds it: a
+                # codec left from an earlier request must not be used for this one
+                if codec and codec not in CODECS:
+                    log.warning("Peer chose codec %s, which is not available here", codec)
+                self.session_codecs[entry[0]] = codec if codec in CODECS else NONE.name
+            if not self.settle_request(request_id, result=decision):
+                log.debug("Ignoring stale response %s", payload)
+
+        elif command == "SESSION":
+            # "<token>,<relay port>,<peer code>[,<peer ip:port>,active|passive]"
+            fields = payload.split(",")
+            try:
+                token, relay_port, peer_code = fields[:3]
+                endpoint = parse_endpoint(fields[3]) if len(fields) == 5 else None
+                with self.session_ready:
+                    self.sessions[peer_code] = (token, int(relay_port), endpoint, fields[-1] == "active")
+                    self.session_ready.notify_all()
+            except ValueError:
+                log.warning("Invalid session format from server: %s", payload)
+                return
+            log.info("Session ready with %s", peer_code)
+            if self.on_session is not None:
+                self.on_session(peer_code, token)
 
-        return result[0]
+        elif command == "RESUME":
+            self.resume_token = payload
+
+        elif command == "PONG":
+            try:
+                self.rtt = (time.monotonic_ns() - int(payload)) / 1e9
+            except ValueError:
+                pass
+
+        elif command == "ERROR":
+            error_message, tagged, request_id = payload.strip().rpartition(",")
+            if not tagged or not request_id.isdigit():
+                error_message, request_id = payload.strip(), None
+            log.warning("Server Error: %s", error_message)
+            if request_id is not None:
+                # Errors about a request end with its id
+                self.settle_request(request_id, error=RequestFailed(error_message))
+
+    def open_session(self, peer_code, timeout=10):
+        """Connect to the peer of the session with `peer_code`, directly if possible.
+
+        Waits up to `timeout` seconds for the server's SESSION message, which
+        follows the approval. If the server sent the peer's address, tries a
+        direct connection first and falls back to the relay. The path taken
+        is kept in `session_paths` and reported to the server. Returns a
+        connected socket carrying the session's traffic, or None if no
+        session with that peer arrives.
+        """
+        with self.session_ready:
+            if not self.session_ready.wait_for(lambda: peer_code in self.sessions, timeout):
+                return None
+            session = self.sessions.pop(peer_code)
+        token, relay_port, endpoint, active = session
+        sock = None
+        if endpoint is not None and self.direct:
+            try:
+                sock = connect_direct(self.local_address, endpoint, token, active)
+            except OSError as e:
+                log.debug("Direct connection to %s failed: %s", peer_code, e)
+        path = "direct"
+        if sock is None:
+            path = "relay"
+            sock = socket.create_connection((self.server_host, relay_port), timeout=timeout)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            sock.sendall(token.encode())
+            sock.settimeout(None)
+        self.session_paths[peer_code] = path
+        log.info("Session with %s connected via %s", peer_code, path)
+        try:
+            self.connection.send_message("PATH", f"{token},{path}")
+        except socket.error as e:
+            log.debug("Error reporting session path: %s", e)
+        return sock
+
+    def answer_request(self, requesting_code, request_id, offer=""):
+        """Ask the approval policy about a connection request and send its answer.
+
+        An approval picks the session codec from the requester's `offer`.
+        """
+        try:
+            approved = self.approval.decide(requesting_code)
+        except Exception as e:
+            log.warning("Approval policy failed for %s: %s", requesting_code, e)
+            approved = False
+        codec = None
+        if approved and offer and request_id:
+            codec = CodecProbe.get().choose(offer, self.link_mbps)
+        self.session_codecs[requesting_code] = codec or NONE.name
+        self.send_approval(requesting_code, "yes" if approved else "no", request_id, codec)
+
+    def session_codec(self, peer_code):
+        """The Codec for a SessionChannel with `peer_code`, as negotiated for the latest request."""
+        return get_codec(self.session_codecs.get(peer_code))
 
     def disconnect(self):
-        """Disconnect from the server."""
+        """Disconnect from the server and stop reconnecting."""
+        self.closed = True
         if self.connected:
+            self.connected = False
             try:
-                self.server_socket.close()
+                self.connection.close()  # Also wakes listen_to_server
             except:
-                pass
-            self.connected = False
\ No newline at end of file
+                pass
\ No newline at end of file
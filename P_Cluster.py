@@ -0,0 +1,471 @@
+import logging
+import multiprocessing
+import os
+import signal
+import socket
+import tempfile
+import threading
+import time
+from collections import OrderedDict, deque
+
+from P_Allocator import DIGITS, CodeAllocator, CodeSpaceExhausted
+from P_Log import setup_logging
+from P_Registry import JOURNAL_PATH, CodeRegistry, load_secret
+from P_Server import MAX_SESSION_RECORDS, P_Server, with_request_id
+
+log = logging.getLogger(__name__)
+
+
+# Messages between processes are tab-separated UTF-8 datagrams on Unix
+# domain sockets:
+#   ADD code worker        a worker now holds the client with `code`
+#   DEL code worker        ...and no longer does
+#   SYNC worker            a (re)started worker asks peers to re-announce
+#   DROP worker            the supervisor saw a worker die
+#   FWD sent_ns target command payload
+#                          deliver a message to a client on the receiving worker;
+#                          the payload is last and may itself contain tabs
+#   PATH code token path   a client's PATH report for a session the receiving worker relays
+#   CODE ip                worker -> supervisor: get or allocate the code for `ip`
+ROUTE_BUDGET = 0.001  # Seconds a cross-worker forward may take before it counts as over budget
+RPC_TIMEOUT = 2
+LATENCY_SAMPLES = 4096
+
+
+def worker_path(socket_dir, port, worker_id):
+    return os.path.join(socket_dir, f"pserver-{port}-w{worker_id}.sock")
+
+
+def rpc_path(socket_dir, port, worker_id):
+    return os.path.join(socket_dir, f"pserver-{port}-w{worker_id}.rpc.sock")
+
+
+def supervisor_path(socket_dir, port):
+    return os.path.join(socket_dir, f"pserver-{port}-supervisor.sock")
+
+
+def bind_datagram(path, rcvbuf=4 * 1024 * 1024):
+    if os.path.exists(path):
+        os.unlink(path)
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, rcvbuf)
+    sock.bind(path)
+    return sock
+
+
+class RouteLatency:
+    """Latency of cross-worker forwards against a budget.
+
+    Keeps the most recent samples for percentiles plus running totals.
+    """
+
+    def __init__(self, budget=ROUTE_BUDGET, samples=LATENCY_SAMPLES):
+        self.budget = budget
+        self.samples = deque(maxlen=samples)
+        self.count = 0
+        self.over_budget = 0
+        self.max = 0.0
+
+    def record(self, seconds):
+        self.samples.append(seconds)
+        self.count += 1
+        if seconds > self.budget:
+            self.over_budget += 1
+        if seconds > self.max:
+            self.max = seconds
+
+    def stats(self):
+        ordered = sorted(self.samples)
+
+        def percentile(p):
+            if not ordered:
+                return 0.0
+            return ordered[min(len(ordered) - 1, int(p * len(ordered)))]
+
+        return {
+            "count": self.count,
+            "p50_ms": percentile(0.50) * 1000,
+            "p99_ms": percentile(0.99) * 1000,
+            "max_ms": self.max * 1000,
+            "budget_ms": self.budget * 1000,
+            "over_budget": self.over_budget,
+        }
+
+
+class ClusterLink:
+    """A worker's channels to its peers and to the supervisor."""
+
+    def __init__(self, socket_dir, port, worker_id, worker_count):
+        self.worker_id = worker_id
+        self.paths = [worker_path(socket_dir, port, i) for i in range(worker_count)]
+        self.supervisor = supervisor_path(socket_dir, port)
+        self.sock = bind_datagram(self.paths[worker_id])
+        self.sock.settimeout(1)
+        # Sends never block: a peer whose queue is full loses the datagram
+        self.out = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.out.setblocking(False)
+        self.rpc = bind_datagram(rpc_path(socket_dir, port, worker_id), rcvbuf=65536)
+        self.rpc.settimeout(RPC_TIMEOUT)
+        self.rpc_lock = threading.Lock()
+        self.send_failures = 0
+
+    def send(self, worker, *fields):
+        try:
+            self.out.sendto("\t".join(fields).encode(), self.paths[worker])
+            return True
+        except OSError:
+            self.send_failures += 1
+            return False
+
+    def broadcast(self, *fields):
+        for worker in range(len(self.paths)):
+            if worker != self.worker_id:
+                self.send(worker, *fields)
+
+    def recv(self):
+        """Wait up to a second for the next message. Returns its fields, or None."""
+        try:
+            data = self.sock.recv(65536)
+        except socket.timeout:
+            return None
+        text = data.decode()
+        return text.split("\t", 4) if text.startswith("FWD\t") else text.split("\t")
+
+    def request_code(self, ip):
+        """Ask the supervisor for the code of `ip`. Raises OSError on timeout."""
+        with self.rpc_lock:
+            self.rpc.sendto(f"CODE\t{ip}".encode(), self.supervisor)
+            while True:
+                fields = self.rpc.recv(1024).decode().split("\t")
+                if fields[0] == "CODE" and fields[1] == ip:
+                    return fields[2]
+                if fields[0] == "FULL" and fields[1] == ip:
+                    raise CodeSpaceExhausted(fields[2])
+
+    def close(self):
+        paths = (self.paths[self.worker_id], self.rpc.getsockname())
+        for sock in (self.sock, self.out, self.rpc):
+            sock.close()
+        for path in paths:
+            try:
+                os.unlink(path)
+            except (OSError, TypeError):
+                pass
+
+
+class WorkerServer(P_Server):
+    """One process of a multi-process server sharing a port with SO_REUSEPORT.
+
+    Codes held by other workers are tracked in `directory` (code -> worker),
+    a replica every worker keeps up to date from its peers' ADD/DEL
+    broadcasts, so routing a REQUEST costs one local lookup and one
+    datagram to the owning worker. New codes come from the supervisor,
+    which owns the registry file; workers only mirror it.
+    """
+
+    def __init__(self, host, port, worker_id, worker_count, socket_dir, route_budget=ROUTE_BUDGET,
+                 relay_port=None, **options):
+        self.worker_id = worker_id
+        self.directory = {}  # {code: worker id} for clients on other workers
+        self.remote_sessions = OrderedDict()  # {session token: worker id} for sessions another worker relays
+        self.route_latency = RouteLatency(route_budget)
+        self.link = ClusterLink(socket_dir, port, worker_id, worker_count)
+        # Both peers of a session must reach the same worker's relay, so each
+        # worker relays on its own port instead of sharing one
+        relay_port = (relay_port or port + 1) + worker_id
+        if options.get("metrics_port") is not None:
+            options["metrics_port"] += worker_id  # Likewise one metrics endpoint per worker
+        if options.get("capture_path"):
+            options["capture_path"] += f".{worker_id}"  # And one capture file
+        super().__init__(host, port, reuse_port=True, relay_port=relay_port, **options)
+        self.metrics.sampled("pserver_route_p99_seconds", "p99 latency of forwards from other workers",
+                             lambda: self.route_latency.stats()["p99_ms"] / 1000, worker=str(worker_id))
+
+    def open_registry(self, path):
+        return CodeRegistry(path, readonly=True)
+
+    def generate_code(self, ip):
+        code = self.codes.get(ip)
+        if code is None:
+            # Not under code_lock: clients whose code is known need not wait for the supervisor
+            code = self.link.request_code(ip)
+            with self.code_lock:
+                self.codes[ip] = code  # Memory only; the supervisor journals it
+        return code
+
+    def code_lookup_blocks(self, ip):
+        return self.codes.get(ip) is None
+
+    def reclaim_codes(self):
+        # Codes are owned by the supervisor
+        self.next_reclaim = time.monotonic() + self.reclaim_interval
+
+    def code_owner(self, code):
+        # A cluster never reclaims codes (no code_ttl), so a code keeps its
+        # owner for good; a worker need not know which IP that is
+        return "cluster"
+
+    def register_client(self, conn, addr, code=None, error=None):
+        code = super().register_client(conn, addr, code, error)
+        if code is not None:
+            self.directory.pop(code, None)
+            self.link.broadcast("ADD", code, str(self.worker_id))
+        return code
+
+    def remove_client(self, code, owner=None, keep_requests=False):
+        removed = super().remove_client(code, owner, keep_requests)
+        if removed:
+            self.link.broadcast("DEL", code, str(self.worker_id))
+        return removed
+
+    def resume_client(self, code, conn, addr, token):
+        resumed = super().resume_client(code, conn, addr, token)
+        if resumed != code:
+            self.directory.pop(resumed, None)
+            self.link.broadcast("DEL", code, str(self.worker_id))
+            self.link.broadcast("ADD", resumed, str(self.worker_id))
+        return resumed
+
+    def is_routable(self, code):
+        return code in self.clients or code in self.directory
+
+    def forward(self, target_code, command, payload):
+        if target_code in self.clients:
+            return super().forward(target_code, command, payload)
+        worker = self.directory.get(target_code)
+        if worker is None:
+            return False
+        return self.link.send(worker, "FWD", str(time.monotonic_ns()), target_code, command, payload)
+
+    def record_session_path(self, code, token, path):
+        # The report belongs to the worker whose relay carries the session
+        with self.stats_lock:
+            worker = self.remote_sessions.get(token)
+        if worker is None:
+            return super().record_session_path(code, token, path)
+        return self.link.send(worker, "PATH", code, token, path)
+
+    def complete_request(self, requesting_code, request_id, target_code=None):
+        if requesting_code in self.clients:
+            return super().complete_request(requesting_code, request_id, target_code)
+        return True  # The requester's worker settles it when the RESPONSE arrives
+
+    def deliver(self, target_code, command, payload):
+        """Forward a message that arrived from another worker to a local client."""
+        if command == "RESPONSE":
+            # "<decision>,<request id>[,<codec>]" for a request this worker tracks
+            fields = payload.split(",")
+            if len(fields) > 1:
+                super().complete_request(target_code, fields[1])
+        elif command == "ERROR":
+            # Error replies end with the request id; the message itself may contain commas
+            _, tagged, request_id = payload.rpartition(",")
+            if tagged:
+                super().complete_request(target_code, request_id)
+        elif command == "SESSION":
+            # "<token>,<relay port>,<peer code>,...": the session lives on the peer's worker
+            fields = payload.split(",", 3)
+            worker = self.directory.get(fields[2]) if len(fields) > 2 else None
+            if worker is not None:
+                with self.stats_lock:
+                    self.remote_sessions[fields[0]] = worker
+                    if len(self.remote_sessions) > MAX_SESSION_RECORDS:
+                        self.remote_sessions.popitem(last=False)
+        if super().forward(target_code, command, payload):
+            return
+        if command == "APPROVE":
+            # Tell the requester (payload) that its target went away
+            requesting_code, request_id = (payload.split(",", 2) + [""])[:2]
+            self.forward(requesting_code, "ERROR", with_request_id("Target client is not responding.", request_id))
+
+    def listen_to_cluster(self):
+        """Apply directory updates and deliver forwards from other workers."""
+        while self.running:
+            try:
+                fields = self.link.recv()
+            except OSError:
+                break
+            if fields is None:
+                continue
+            kind = fields[0]
+
+            if kind == "FWD" and len(fields) == 5:
+                sent_ns, target_code, command, payload = fields[1:]
+                self.route_latency.record((time.monotonic_ns() - int(sent_ns)) / 1e9)
+                if self.async_engine is not None:
+                    # Client protocols may only be touched from the event loop
+                    self.async_engine.loop.call_soon_threadsafe(self.deliver, target_code, command, payload)
+                else:
+                    self.deliver(target_code, command, payload)
+
+            elif kind == "PATH" and len(fields) == 4:
+                if self.async_engine is not None:
+                    self.async_engine.loop.call_soon_threadsafe(self.record_session_path, *fields[1:])
+                else:
+                    self.record_session_path(*fields[1:])
+
+            elif kind == "ADD" and len(fields) == 3:
+                if fields[1] in self.clients:
+                    # The client resumed on that worker; our connection is stale
+                    if self.async_engine is not None:
+                        self.async_engine.loop.call_soon_threadsafe(self.remove_client, fields[1])
+                    else:
+                        self.remove_client(fields[1])
+                self.directory[fields[1]] = int(fields[2])
+
+            elif kind == "DEL" and len(fields) == 3:
+                # Ignore a late DEL from a worker the client already left
+                if self.directory.get(fields[1]) == int(fields[2]):
+                    del self.directory[fields[1]]
+
+            elif kind == "SYNC" and len(fields) == 2:
+                peer = int(fields[1])
+                for code in self.clients.codes():
+                    self.link.send(peer, "ADD", code, str(self.worker_id))
+
+            elif kind == "DROP" and len(fields) == 2:
+                dead = int(fields[1])
+                for code, worker in list(self.directory.items()):
+                    if worker == dead:
+                        self.directory.pop(code, None)
+
+            else:
+                log.warning("Ignoring malformed cluster message %s with %d fields", kind, len(fields))
+
+    def start(self):
+        threading.Thread(target=self.listen_to_cluster, daemon=True).start()
+        self.link.broadcast("SYNC", str(self.worker_id))
+        super().start()
+
+    def route_stats(self):
+        """Latency of forwards this worker received from other workers."""
+        return self.route_latency.stats()
+
+    def stop(self):
+        super().stop()
+        log.info("Worker %s cross-worker routing: %s", self.worker_id, self.route_stats())
+        self.link.close()
+
+
+def run_worker(host, port, worker_id, worker_count, socket_dir, options):
+    setup_logging()
+    server = WorkerServer(host, port, worker_id, worker_count, socket_dir, **options)
+    # The supervisor stops workers with SIGTERM; shut down cleanly so the
+    # routing stats are reported and the sockets unlinked
+    signal.signal(signal.SIGTERM, lambda signum, frame: server.stop())
+    signal.signal(signal.SIGINT, signal.SIG_IGN)  # Ctrl+C is handled by the supervisor
+    server.start()
+
+
+class ClusterSupervisor:
+    """Start N WorkerServer processes on one port and serve them codes.
+
+    The supervisor is the only writer of the code registry; workers ask it
+    for codes of IPs they have not seen. It restarts workers that die and
+    tells the others to forget the dead worker's clients.
+    """
+
+    def __init__(self, host, port, workers=None, engine="asyncio", registry_path=JOURNAL_PATH,
+                 socket_dir=None, code_length=4, code_alphabet=DIGITS, **options):
+        if not hasattr(socket, "AF_UNIX") or not hasattr(socket, "SO_REUSEPORT"):
+            raise OSError("Cluster mode needs Unix domain sockets and SO_REUSEPORT")
+        if options.get("code_ttl") is not None:
+            # Reclaiming needs to know which codes are connected on any worker; only workers know that
+            raise ValueError("code_ttl is not supported in cluster mode")
+        self.host = host
+        self.port = port
+        self.worker_count = workers or os.cpu_count() or 1
+        self.socket_dir = socket_dir or tempfile.mkdtemp(prefix="pserver-")
+        self.codes = CodeRegistry(registry_path, start=False)  # The writer thread starts after the workers fork
+        load_secret(registry_path)  # Create the resume key before the workers read it
+        self.allocator = CodeAllocator(code_length, code_alphabet)
+        for ip, code in self.codes.items():
+            self.allocator.reserve(code, ip)
+        self.options = dict(options, engine=engine, registry_path=registry_path,
+                            code_length=code_length, code_alphabet=code_alphabet)
+        self.context = multiprocessing.get_context("fork")
+        self.processes = {}
+        self.running = True
+
+    def spawn(self, worker_id):
+        process = self.context.Process(
+            target=run_worker,
+            args=(self.host, self.port, worker_id, self.worker_count, self.socket_dir, self.options),
+            daemon=True,
+        )
+        process.start()
+        self.processes[worker_id] = process
+
+    def assign_code(self, ip):
+        code = self.codes.get(ip)
+        if code is None:
+            code = self.allocator.allocate(ip)
+            self.codes[ip] = code
+        return code
+
+    def run(self):
+        """Serve code requests and watch the workers until `stop` is called."""
+        sock = bind_datagram(supervisor_path(self.socket_dir, self.port))
+        sock.settimeout(1)
+        out = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        out.setblocking(False)
+        for worker_id in range(self.worker_count):
+            self.spawn(worker_id)
+        self.codes.start()
+        log.info("Cluster of %s workers serving %s:%s", self.worker_count, self.host, self.port)
+
+        try:
+            while self.running:
+                try:
+                    data, reply_to = sock.recvfrom(1024)
+                    fields = data.decode().split("\t")
+                    if fields[0] == "CODE" and len(fields) == 2:
+                        try:
+                            reply = f"CODE\t{fields[1]}\t{self.assign_code(fields[1])}"
+                        except CodeSpaceExhausted as e:
+                            reply = f"FULL\t{fields[1]}\t{e}"
+                        sock.sendto(reply.encode(), reply_to)
+                except socket.timeout:
+                    pass
+                except OSError as e:
+                    log.warning("Cluster supervisor error: %s", e)
+
+                for worker_id, process in list(self.processes.items()):
+                    if not process.is_alive() and self.running:
+                        log.warning("Worker %s exited with %s, restarting", worker_id, process.exitcode)
+                        for peer in range(self.worker_count):
+                            if peer != worker_id:
+                                try:
+                                    out.sendto(f"DROP\t{worker_id}".encode(), worker_path(self.socket_dir, self.port, peer))
+                                except OSError:
+                                    pass
+                        self.spawn(worker_id)
+        finally:
+            sock.close()
+            out.close()
+            self.shutdown()
+
+    def stop(self):
+        self.running = False
+
+    def shutdown(self):
+        for process in self.processes.values():
+            process.terminate()
+        for process in self.processes.values():
+            process.join(5)
+        self.codes.close()
+        log.info("Cluster stopped")
+
+
+if __name__ == "__main__":
+    import sys
+
+    workers = int(sys.argv[1]) if len(sys.argv) > 1 else None
+    engine = sys.argv[2] if len(sys.argv) > 2 else "asyncio"
+    setup_logging()
+    supervisor = ClusterSupervisor("0.0.0.0", 12345, workers=workers, engine=engine)
+    try:
+        supervisor.run()
+    except KeyboardInterrupt:
+        log.info("Cluster stopping...")
+        supervisor.stop()
@@ -0,0 +1,303 @@
+import random
+import threading
+import time
+import zlib
+
+try:
+    import lz4.frame as lz4_frame
+except ImportError:  # Optional; pip install lz4
+    lz4_frame = None
+
+try:
+    import zstandard
+except ImportError:  # Optional; pip install zstandard
+    zstandard = None
+
+
+PROBE_BYTES = 256 * 1024  # Size of the sample each side compresses to rate its codecs
+LINK_MBPS = 100  # Assumed link speed (megabits/s) when weighing CPU time against bytes on the wire
+DECOMPRESS_CHUNK = 64 * 1024  # Output is produced and size-checked this much at a time
+
+
+class ZlibCompressor:
+    """Deflate stream shared by all messages of a channel.
+
+    Each message is flushed with Z_SYNC_FLUSH, so it can be decoded as
+    soon as it arrives while later messages still back-reference the
+    earlier ones. `set_level` ends the stream with the next message and
+    starts a new one at the new level; the decompressor follows.
+    """
+
+    def __init__(self, level):
+        self.level = level
+        self.stream = zlib.compressobj(level)
+        self.pending = b""  # The end of a finished stream, sent with the next message
+
+    def set_level(self, level):
+        if level != self.level:
+            self.pending += self.stream.flush(zlib.Z_FINISH)
+            self.stream = zlib.compressobj(level)
+            self.level = level
+
+    def compress(self, data):
+        out = self.pending + self.stream.compress(data) + self.stream.flush(zlib.Z_SYNC_FLUSH)
+        self.pending = b""
+        return out
+
+
+class ZlibDecompressor:
+    def __init__(self):
+        self.stream = zlib.decompressobj()
+
+    def decompress(self, data, max_size):
+        parts = []
+        remaining = max_size
+        while True:
+            try:
+                out = self.stream.decompress(data, remaining + 1)  # One byte over means too big
+            except zlib.error as e:
+                raise ValueError(str(e))
+            if len(out) > remaining:
+                raise ValueError(f"Message expands beyond {max_size} bytes")
+            parts.append(out)
+            remaining -= len(out)
+            if not self.stream.eof:
+                return b"".join(parts)
+            # The sender changed level: a new stream follows the end of this one
+            data = self.stream.unused_data
+            self.stream = zlib.decompressobj()
+
+
+class ZstdCompressor:
+    """One zstd frame per level, like ZlibCompressor; a decompressor reads concatenated frames."""
+
+    def __init__(self, level):
+        self.level = level
+        self.stream = zstandard.ZstdCompressor(level=level).compressobj()
+        self.pending = b""
+
+    def set_level(self, level):
+        if level != self.level:
+            self.pending += self.stream.flush(zstandard.COMPRESSOBJ_FLUSH_FINISH)
+            self.stream = zstandard.ZstdCompressor(level=level).compressobj()
+            self.level = level
+
+    def compress(self, data):
+        out = self.pending + self.stream.compress(data) + self.stream.flush(zstandard.COMPRESSOBJ_FLUSH_BLOCK)
+        self.pending = b""
+        return out
+
+
+class BoundedSink:
+    """File-like target for a zstd stream writer that refuses output past `limit` bytes."""
+
+    def __init__(self):
+        self.chunks = []
+        self.size = 0
+        self.limit = 0
+
+    def write(self, data):
+        self.size += len(data)
+        if self.size > self.limit:
+            raise ValueError(f"Message expands beyond {self.limit} bytes")
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def take(self):
+        out = b"".join(self.chunks)
+        self.chunks.clear()
+        self.size = 0
+        return out
+
+
+class ZstdDecompressor:
+    """Streams output through a BoundedSink in DECOMPRESS_CHUNK pieces, so a
+    message that expands too far fails before it is all in memory."""
+
+    def __init__(self):
+        self.sink = BoundedSink()
+        self.stream = zstandard.ZstdDecompressor().stream_writer(self.sink, write_size=DECOMPRESS_CHUNK)
+
+    def decompress(self, data, max_size):
+        self.sink.limit = max_size
+        try:
+            self.stream.write(data)
+        except zstandard.ZstdError as e:
+            raise ValueError(str(e))
+        finally:
+            out = self.sink.take()  # Also drops a partial message after an error
+        return out
+
+
+class Lz4Compressor:
+    """One LZ4 frame per message; LZ4 frames do not carry context across messages."""
+
+    def __init__(self, level=0):
+        self.level = level
+
+    def set_level(self, level):
+        self.level = level
+
+    def compress(self, data):
+        return lz4_frame.compress(data, compression_level=self.level)
+
+
+class Lz4Decompressor:
+    def decompress(self, data, max_size):
+        stream = lz4_frame.LZ4FrameDecompressor()
+        try:
+            out = stream.decompress(data, max_length=max_size)
+        except RuntimeError as e:
+            raise ValueError(str(e))
+        if not stream.eof:
+            if stream.needs_input:
+                raise ValueError("Truncated LZ4 frame")
+            raise ValueError(f"Message expands beyond {max_size} bytes")
+        return out
+
+
+class Identity:
+    level = 0
+
+    def set_level(self, level):
+        pass
+
+    def compress(self, data):
+        return data
+
+    def decompress(self, data, max_size):
+        return data
+
+
+class Codec:
+    """A way to compress session traffic. Each channel direction gets its own stream.
+
+    Compressors turn one message into bytes the peer can decode at once,
+    and `set_level` changes their level from the next message on without
+    the peer being told; decompressors raise ValueError for corrupt input or for output larger
+    than `max_size`.
+    """
+
+    def __init__(self, name, compressor, decompressor):
+        self.name = name
+        self.make_compressor = compressor
+        self.make_decompressor = decompressor
+
+    def compressor(self):
+        return self.make_compressor()
+
+    def decompressor(self):
+        return self.make_decompressor()
+
+    def __repr__(self):
+        return f"Codec({self.name})"
+
+
+NONE = Codec("none", Identity, Identity)
+
+
+def available_codecs():
+    """The codecs this machine can run, cheapest first."""
+    codecs = [NONE]
+    if lz4_frame is not None:
+        codecs.append(Codec("lz4", Lz4Compressor, Lz4Decompressor))
+    if zstandard is not None:
+        codecs.append(Codec("zstd-1", lambda: ZstdCompressor(1), ZstdDecompressor))
+        codecs.append(Codec("zstd-3", lambda: ZstdCompressor(3), ZstdDecompressor))
+    for level in (1, 6, 9):
+        codecs.append(Codec(f"zlib-{level}", lambda level=level: ZlibCompressor(level), ZlibDecompressor))
+    return codecs
+
+
+CODECS = {codec.name: codec for codec in available_codecs()}
+
+
+def get_codec(name):
+    """Look up a codec by name; None or "" means no compression."""
+    if not name:
+        return NONE
+    codec = CODECS.get(name)
+    if codec is None:
+        raise ValueError(f"Unsupported codec: {name}")
+    return codec
+
+
+def probe_sample(size=PROBE_BYTES):
+    """Deterministic screen-like bytes: mostly smooth gradient rows, some noisy ones.
+
+    Both peers build the same sample, so compression ratios measured on
+    either side agree.
+    """
+    rng = random.Random(0)
+    row = bytes(i * 255 // 191 for i in range(192))  # One 64-pixel RGB row of a gradient
+    chunks = []
+    for _ in range(size // len(row)):
+        chunks.append(rng.randbytes(len(row)) if rng.random() < 0.1 else row)
+    return b"".join(chunks)
+
+
+class CodecProbe:
+    """Measured speed and ratio of each available codec on this machine.
+
+    Speed is raw megabytes per second through compress plus decompress,
+    ratio is compressed size over raw size. The probe takes a few tens of
+    milliseconds and runs once per process, on first use; `warm` starts it
+    in the background so that first use need not wait.
+    """
+
+    result = None
+    lock = threading.Lock()
+
+    def __init__(self, sample=None):
+        sample = sample if sample is not None else probe_sample()
+        self.speeds = {}
+        self.ratios = {}
+        for codec in available_codecs():
+            started = time.perf_counter()
+            compressed = codec.compressor().compress(sample)
+            codec.decompressor().decompress(compressed, len(sample))
+            elapsed = max(time.perf_counter() - started, 1e-6)
+            self.speeds[codec.name] = len(sample) / elapsed / 1e6
+            self.ratios[codec.name] = len(compressed) / len(sample)
+
+    @classmethod
+    def get(cls):
+        with cls.lock:
+            if cls.result is None:
+                cls.result = cls()
+        return cls.result
+
+    @classmethod
+    def warm(cls):
+        if cls.result is None:
+            threading.Thread(target=cls.get, daemon=True).start()
+
+    def offer(self):
+        """What a peer advertises: "name:MB/s" for every codec, joined by ";"."""
+        return ";".join(f"{name}:{speed:.0f}" for name, speed in self.speeds.items())
+
+    def choose(self, offer, link_mbps=LINK_MBPS):
+        """Pick the codec from a peer's `offer` that moves screen data fastest.
+
+        A codec costs the time the slower side needs to compress and
+        decompress a megabyte, plus the time the compressed megabyte takes
+        on a `link_mbps` link. Only codecs both sides have are considered;
+        with nothing in common, or a malformed offer, this is "none".
+        """
+        remote = {}
+        for item in offer.split(";"):
+            name, _, speed = item.partition(":")
+            try:
+                remote[name] = float(speed)
+            except ValueError:
+                continue
+        link_bytes = link_mbps * 1e6 / 8
+        best, best_cost = NONE.name, 1e6 / link_bytes
+        for name, speed in self.speeds.items():
+            if name == NONE.name or remote.get(name, 0) <= 0:
+                continue
+            slowest = min(speed, remote[name]) * 1e6
+            cost = 1e6 / slowest + 1e6 * self.ratios[name] / link_bytes
+            if cost < best_cost:
+                best, best_cost = name, cost
+        return best
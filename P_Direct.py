@@ -0,0 +1,146 @@
+import hmac
+import select
+import socket
+import time
+
+
+DIRECT_TIMEOUT = 3.0  # Seconds to try a direct connection before using the relay
+ATTEMPT_TIMEOUT = 0.5  # Seconds one connect attempt may take; a NAT dropping our SYN makes it hang
+RETRY_INTERVAL = 0.05
+TOKEN_TIMEOUT = 2.0  # Seconds to wait for the peer's proof once connected
+ROLES = ("active", "passive")
+
+
+def share_port(sock):
+    """Let other sockets bind the same local port as `sock`.
+
+    Must be called before `sock` is bound. The control connection is
+    opened this way so a direct connection can later leave from the port
+    the server (and any NAT on the way) saw.
+    """
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if hasattr(socket, "SO_REUSEPORT"):
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+
+
+def parse_endpoint(text):
+    """"ip:port" -> (ip, port)."""
+    host, _, port = text.rpartition(":")
+    return host, int(port)
+
+
+def format_endpoint(addr):
+    return f"{addr[0]}:{addr[1]}"
+
+
+def proof(token, role):
+    """What the `role` side of a session sends to show it knows the session token."""
+    return hmac.new(token.encode(), role.encode(), "sha256").digest()
+
+
+def recv_exact(sock, size):
+    received = b""
+    while len(received) < size:
+        chunk = sock.recv(size - len(received))
+        if not chunk:
+            return None
+        received += chunk
+    return received
+
+
+def exchange_proofs(sock, token, active):
+    """Check the peer knows the session token without ever sending the token itself.
+
+    Each side proves its own role, so a proof reflected back, or one the
+    passive side received, never passes for the other side's. The active
+    side proves itself first; the passive side answers only once that
+    proof checks out, so a stranger reaching its port learns nothing.
+    """
+    mine, theirs = ROLES if active else ROLES[::-1]
+    sock.settimeout(TOKEN_TIMEOUT)
+    if active:
+        sock.sendall(proof(token, mine))
+    expected = proof(token, theirs)
+    received = recv_exact(sock, len(expected))
+    if received is None or not hmac.compare_digest(received, expected):
+        return False
+    if not active:
+        sock.sendall(proof(token, mine))
+    return True
+
+
+def bound_socket(local_addr):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    share_port(sock)
+    sock.bind(local_addr)
+    return sock
+
+
+def connect_direct(local_addr, peer_addr, token, active, timeout=DIRECT_TIMEOUT):
+    """Open a TCP connection straight to a peer, or return None.
+
+    Both peers call this at once, from the local address of their control
+    connection to the address the server observed for the other one. The
+    active side (the server picks exactly one) keeps connecting. The
+    passive side listens on its port and keeps connecting too: those
+    outgoing SYNs open its NAT mapping, and if they cross the active
+    side's SYNs the two attempts merge into one connection (TCP
+    simultaneous open). Without a NAT in between, the active side simply
+    reaches the listener. Either way exactly one connection results, and
+    both sides check it with role-bound proofs of the session token (see
+    exchange_proofs). The listener drops connections from anywhere but
+    `peer_addr`.
+    """
+    deadline = time.monotonic() + timeout
+    listener = None
+    try:
+        if not active:
+            listener = bound_socket(local_addr)
+            listener.listen(1)
+            listener.setblocking(False)
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return None
+
+            if listener is not None:
+                readable, _, _ = select.select([listener], [], [], min(remaining, RETRY_INTERVAL))
+                if readable:
+                    try:
+                        sock, addr = listener.accept()
+                    except OSError:
+                        continue
+                    if addr[:2] != tuple(peer_addr):
+                        sock.close()  # Someone else found the port
+                        continue
+                    sock.setblocking(True)
+                    return verified(sock, token, active)
+
+            sock = None
+            try:
+                sock = bound_socket(local_addr)
+                sock.settimeout(max(0.01, min(deadline - time.monotonic(), ATTEMPT_TIMEOUT)))
+                sock.connect(peer_addr)
+            except OSError:
+                if sock is not None:
+                    sock.close()
+                if listener is None:
+                    time.sleep(RETRY_INTERVAL)
+                continue
+            return verified(sock, token, active)
+    finally:
+        if listener is not None:
+            listener.close()
+
+
+def verified(sock, token, active):
+    """Return `sock` ready for session traffic if the peer knows `token`, else close it."""
+    try:
+        if exchange_proofs(sock, token, active):
+            sock.settimeout(None)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            return sock
+    except OSError:
+        pass
+    sock.close()
+    return None
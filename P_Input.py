@@ -0,0 +1,244 @@
+import collections
+import struct
+import threading
+import time
+
+
+# One event is 8 bytes: kind, detail (button number), milliseconds since
+# the batch started, and a 32-bit value. Pointer events pack x and y into
+# the value; keys carry the keysym; the wheel carries a signed delta.
+EVENT = struct.Struct("!BBHI")
+MOVE = 1
+BUTTON_DOWN = 2
+BUTTON_UP = 3
+WHEEL = 4
+KEY_DOWN = 5
+KEY_UP = 6
+FLUSH_INTERVAL = 1 / 60  # Seconds events may wait to share a write
+RECENT_EVENTS = 1000  # NullInjector keeps only this many events
+UNICODE_KEYSYM = 0x01000000  # X11 keysyms from here on are this plus a code point
+# X11 keysyms of keys without a character, by pynput.keyboard.Key name
+SPECIAL_KEYSYMS = {
+    0xFF08: "backspace", 0xFF09: "tab", 0xFF0D: "enter", 0xFF13: "pause", 0xFF14: "scroll_lock",
+    0xFF1B: "esc", 0xFF50: "home", 0xFF51: "left", 0xFF52: "up", 0xFF53: "right", 0xFF54: "down",
+    0xFF55: "page_up", 0xFF56: "page_down", 0xFF57: "end", 0xFF61: "print_screen", 0xFF63: "insert",
+    0xFF67: "menu", 0xFF7F: "num_lock", 0xFFE1: "shift_l", 0xFFE2: "shift_r", 0xFFE3: "ctrl_l",
+    0xFFE4: "ctrl_r", 0xFFE5: "caps_lock", 0xFFE9: "alt_l", 0xFFEA: "alt_r", 0xFFEB: "cmd",
+    0xFFEC: "cmd_r", 0xFFFF: "delete",
+    **{0xFFBE + n: f"f{n + 1}" for n in range(12)},
+}
+
+
+def pack_point(x, y):
+    return (max(0, min(int(x), 0xFFFF)) << 16) | max(0, min(int(y), 0xFFFF))
+
+
+def unpack_point(value):
+    return value >> 16, value & 0xFFFF
+
+
+class InputBatcher:
+    """Viewer side: collects input events and sends them in batches.
+
+    Events are queued and written as one INPUT message at most every
+    `interval` seconds. A pointer move directly after another move
+    replaces it, since only the latest position matters; anything else
+    (clicks, keys) keeps its place so the order of events is preserved.
+    """
+
+    def __init__(self, channel, interval=FLUSH_INTERVAL):
+        self.channel = channel
+        self.interval = interval
+        self.pending = []  # [kind, detail, ms, value] lists, so a move can be updated in place
+        self.batch_started = None
+        self.cond = threading.Condition()
+        self.running = True
+        self.events_in = 0
+        self.events_sent = 0
+        self.moves_coalesced = 0
+        self.batches_sent = 0
+        threading.Thread(target=self.flush_loop, daemon=True).start()
+
+    def add(self, kind, detail=0, value=0):
+        with self.cond:
+            now = time.monotonic()
+            if not self.pending:
+                self.batch_started = now
+                self.cond.notify()
+            ms = min(int((now - self.batch_started) * 1000), 0xFFFF)
+            self.events_in += 1
+            if kind == MOVE and self.pending and self.pending[-1][0] == MOVE:
+                self.pending[-1][2:] = [ms, value]
+                self.moves_coalesced += 1
+            else:
+                self.pending.append([kind, detail, ms, value])
+
+    def move(self, x, y):
+        self.add(MOVE, 0, pack_point(x, y))
+
+    def button(self, pressed, button, x, y):
+        self.add(BUTTON_DOWN if pressed else BUTTON_UP, button, pack_point(x, y))
+
+    def wheel(self, delta):
+        self.add(WHEEL, 0, delta & 0xFFFFFFFF)
+
+    def key(self, pressed, keysym):
+        self.add(KEY_DOWN if pressed else KEY_UP, 0, keysym & 0xFFFFFFFF)
+
+    def flush_loop(self):
+        while True:
+            with self.cond:
+                while self.running and not self.pending:
+                    self.cond.wait()
+                if not self.running:
+                    return
+                wait = self.batch_started + self.interval - time.monotonic()
+            if wait > 0:
+                time.sleep(wait)
+            if not self.flush():
+                return
+
+    def flush(self):
+        """Send everything pending in one write. Returns False if the channel is gone."""
+        with self.cond:
+            events, self.pending = self.pending, []
+        if not events:
+            return True
+        payload = b"".join(EVENT.pack(*event) for event in events)
+        try:
+            self.channel.send("INPUT", payload)
+        except OSError:
+            self.running = False
+            return False
+        self.events_sent += len(events)
+        self.batches_sent += 1
+        return True
+
+    def close(self):
+        with self.cond:
+            self.running = False
+            self.cond.notify()
+
+    def stats(self):
+        return {
+            "events_in": self.events_in,
+            "events_sent": self.events_sent,
+            "moves_coalesced": self.moves_coalesced,
+            "batches_sent": self.batches_sent,
+        }
+
+
+def decode_events(payload):
+    """Yield (kind, detail, ms, value) for each event in an INPUT payload."""
+    return EVENT.iter_unpack(payload)
+
+
+class InputReplayer:
+    """Controlled side: applies received input batches in order through an injector.
+
+    The injector needs move(x, y), button(pressed, button, x, y),
+    wheel(delta) and key(pressed, keysym). `default_injector()` picks one
+    for this machine.
+    """
+
+    def __init__(self, injector=None):
+        self.injector = injector or default_injector()
+        self.events_applied = 0
+
+    def apply(self, payload):
+        injector = self.injector
+        for kind, detail, _, value in decode_events(payload):
+            if kind == MOVE:
+                injector.move(*unpack_point(value))
+            elif kind in (BUTTON_DOWN, BUTTON_UP):
+                injector.button(kind == BUTTON_DOWN, detail, *unpack_point(value))
+            elif kind == WHEEL:
+                injector.wheel(value - (1 << 32) if value & 0x80000000 else value)
+            elif kind in (KEY_DOWN, KEY_UP):
+                injector.key(kind == KEY_DOWN, value)
+            else:
+                continue
+            self.events_applied += 1
+
+
+class NullInjector:
+    """Counts events without touching the local machine (tests, headless agents).
+
+    `counts` has the number of events of each kind; `events` keeps only the
+    last RECENT_EVENTS, so a long session does not grow it without bound.
+    """
+
+    def __init__(self, recent=RECENT_EVENTS):
+        self.counts = collections.Counter()
+        self.events = collections.deque(maxlen=recent)
+
+    def add(self, event):
+        self.counts[event[0]] += 1
+        self.events.append(event)
+
+    def move(self, x, y):
+        self.add(("move", x, y))
+
+    def button(self, pressed, button, x, y):
+        self.add(("button", pressed, button, x, y))
+
+    def wheel(self, delta):
+        self.add(("wheel", delta))
+
+    def key(self, pressed, keysym):
+        self.add(("key", pressed, keysym))
+
+
+class PynputInjector:
+    """Drives the real mouse and keyboard with pynput."""
+
+    BUTTONS = {1: "left", 2: "middle", 3: "right"}
+
+    def __init__(self):
+        from pynput import keyboard, mouse
+
+        self.keyboard_module = keyboard
+        self.mouse = mouse.Controller()
+        self.keyboard = keyboard.Controller()
+        self.buttons = {number: getattr(mouse.Button, name) for number, name in self.BUTTONS.items()}
+        # Some keys exist only on some platforms (no insert or menu key on macOS)
+        self.special_keys = {keysym: getattr(keyboard.Key, name) for keysym, name in SPECIAL_KEYSYMS.items()
+                             if hasattr(keyboard.Key, name)}
+
+    def move(self, x, y):
+        self.mouse.position = (x, y)
+
+    def button(self, pressed, button, x, y):
+        target = self.buttons.get(button)
+        if target is None:
+            return
+        self.mouse.position = (x, y)
+        if pressed:
+            self.mouse.press(target)
+        else:
+            self.mouse.release(target)
+
+    def wheel(self, delta):
+        self.mouse.scroll(0, delta)
+
+    def key(self, pressed, keysym):
+        if keysym < 0x100:  # Latin-1 keysyms are the character itself
+            key = self.keyboard_module.KeyCode.from_char(chr(keysym))
+        elif UNICODE_KEYSYM <= keysym <= UNICODE_KEYSYM + 0x10FFFF:
+            key = self.keyboard_module.KeyCode.from_char(chr(keysym - UNICODE_KEYSYM))
+        else:
+            key = self.special_keys.get(keysym)
+        if key is None:
+            return
+        if pressed:
+            self.keyboard.press(key)
+        else:
+            self.keyboard.release(key)
+
+
+def default_injector():
+    """Use pynput when it is installed, otherwise just record the events."""
+    try:
+        return PynputInjector()
+    except Exception:
+        return NullInjector()
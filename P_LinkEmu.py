@@ -0,0 +1,95 @@
+import socket
+import threading
+import time
+from collections import deque
+
+
+CHUNK_SIZE = 16 * 1024
+
+
+class LinkEmulator:
+    """Local TCP proxy that emulates a slow link, for testing sessions.
+
+    Connections to `port` are forwarded to (target_host, target_port).
+    Each direction adds `delay` seconds of one-way latency and, if
+    `bandwidth` (bytes per second) is set, serializes data at that rate
+    behind an unbounded queue, the way a bufferbloated uplink behaves.
+    """
+
+    def __init__(self, target_host, target_port, delay=0.05, bandwidth=None, host="127.0.0.1", port=0):
+        self.target = (target_host, target_port)
+        self.delay = delay
+        self.bandwidth = bandwidth
+        self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.server_socket.bind((host, port))
+        self.server_socket.listen(16)
+        self.server_socket.settimeout(1)
+        self.port = self.server_socket.getsockname()[1]
+        self.running = False
+
+    def start(self):
+        self.running = True
+        threading.Thread(target=self.accept_loop, daemon=True).start()
+        return self
+
+    def accept_loop(self):
+        while self.running:
+            try:
+                client, _ = self.server_socket.accept()
+            except socket.timeout:
+                continue
+            except OSError:
+                break
+            upstream = socket.create_connection(self.target)
+            for sock in (client, upstream):
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            self.pipe(client, upstream)
+            self.pipe(upstream, client)
+
+    def pipe(self, src, dst):
+        """Forward one direction through a delay line."""
+        queue = deque()  # (deliver_at, chunk)
+        ready = threading.Condition()
+        link_free = [0.0]  # When the emulated link finishes sending what it has
+
+        def read():
+            while True:
+                try:
+                    chunk = src.recv(CHUNK_SIZE)
+                except OSError:
+                    chunk = b""
+                now = time.monotonic()
+                done = now
+                if chunk and self.bandwidth:
+                    done = max(now, link_free[0]) + len(chunk) / self.bandwidth
+                    link_free[0] = done
+                with ready:
+                    queue.append((done + self.delay, chunk))
+                    ready.notify()
+                if not chunk:
+                    return
+
+        def write():
+            while True:
+                with ready:
+                    while not queue:
+                        ready.wait()
+                    deliver_at, chunk = queue.popleft()
+                wait = deliver_at - time.monotonic()
+                if wait > 0:
+                    time.sleep(wait)
+                try:
+                    if not chunk:
+                        dst.shutdown(socket.SHUT_WR)
+                        return
+                    dst.sendall(chunk)
+                except OSError:
+                    return
+
+        threading.Thread(target=read, daemon=True).start()
+        threading.Thread(target=write, daemon=True).start()
+
+    def stop(self):
+        self.running = False
+        self.server_socket.close()
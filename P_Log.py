@@ -0,0 +1,108 @@
+import collections
+import logging
+import logging.handlers
+import queue
+import sys
+
+
+LOG_FORMAT = "%(asctime)s %(levelname)s %(name)s: %(message)s"
+QUEUE_SIZE = 10000  # Records waiting for the background thread before new ones are dropped
+RING_CAPACITY = 1000  # Recent records kept for the GUI
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """Hands records to a bounded queue without ever blocking the caller.
+
+    The stock QueueHandler formats each record in the logging thread; this
+    one passes it on untouched so the message is built on the background
+    thread. When the queue is full the record is dropped and counted.
+    """
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class RingBufferHandler(logging.Handler):
+    """Keeps the last `capacity` records, each numbered.
+
+    Readers remember the last number they saw and ask for what came after
+    it with `records_since()`, so nobody has to re-read the whole buffer.
+    """
+
+    def __init__(self, capacity=RING_CAPACITY):
+        super().__init__()
+        self.records = collections.deque(maxlen=capacity)
+        self.sequence = 0
+
+    def emit(self, record):
+        # Handler.handle() holds self.lock around emit()
+        self.sequence += 1
+        self.records.append((self.sequence, record))
+
+    def records_since(self, sequence):
+        """Returns (latest number, records numbered after `sequence`)."""
+        with self.lock:
+            latest = self.sequence
+            new = []
+            for number, record in reversed(self.records):
+                if number <= sequence:
+                    break
+                new.append(record)
+        new.reverse()
+        return latest, new
+
+
+class LogPipeline:
+    """Root logging through a bounded queue drained by one background thread.
+
+    Callers only pay for a level check and a queue put; formatting and
+    output happen on the listener thread, which writes to the console
+    (optionally) and to a ring buffer that a GUI can poll.
+    """
+
+    def __init__(self, level=logging.INFO, console=True, capacity=RING_CAPACITY, queue_size=QUEUE_SIZE):
+        self.level = level
+        self.ring = RingBufferHandler(capacity)
+        handlers = [self.ring]
+        if console:
+            stream = logging.StreamHandler(sys.stdout)
+            stream.setFormatter(logging.Formatter(LOG_FORMAT))
+            handlers.append(stream)
+        self.handler = DroppingQueueHandler(queue.Queue(queue_size))
+        self.listener = logging.handlers.QueueListener(self.handler.queue, *handlers, respect_handler_level=True)
+
+    @property
+    def dropped(self):
+        return self.handler.dropped
+
+    def start(self):
+        root = logging.getLogger()
+        for handler in list(root.handlers):
+            # A forked child inherits its parent's queue handler, but not the
+            # thread draining that queue
+            if isinstance(handler, DroppingQueueHandler):
+                root.removeHandler(handler)
+        root.setLevel(self.level)
+        root.addHandler(self.handler)
+        self.listener.start()
+        return self
+
+    def stop(self):
+        """Flush what is queued and detach from the root logger."""
+        logging.getLogger().removeHandler(self.handler)
+        self.listener.stop()
+
+
+def setup_logging(level=logging.INFO, console=True, capacity=RING_CAPACITY):
+    """Start a LogPipeline on the root logger and return it."""
+    return LogPipeline(level, console, capacity).start()
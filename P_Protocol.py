@@ -0,0 +1,389 @@
+import logging
+import re
+import select
+import socket
+import struct
+import threading
+from collections import deque
+
+log = logging.getLogger(__name__)
+
+
+# Binary frame: magic byte, opcode, payload length, then the UTF-8 payload.
+# The magic byte is a UTF-8 continuation byte, so it never starts a
+# character: a reader can tell a binary frame from the legacy
+# "COMMAND:payload" text before it on the same stream, as long as it only
+# looks for one between characters.
+MAGIC = 0xA5
+HEADER = struct.Struct("!BBI")
+MAX_FRAME = 64 * 1024  # Largest payload accepted on the control channel
+RECV_BUFFER_SIZE = 4096
+MAX_QUEUE_BYTES = 256 * 1024  # Outbound bytes buffered per client before the slow-consumer policy applies
+SLOW_POLICIES = ("drop", "disconnect")
+CLOSE_TIMEOUT = 2  # Seconds a closing connection may spend sending what is still queued
+# TCP keepalive: probe after this many idle seconds, then every interval,
+# and give up after count unanswered probes
+KEEPALIVE_IDLE = 30
+KEEPALIVE_INTERVAL = 5
+KEEPALIVE_COUNT = 3
+
+OPCODES = {
+    "HELLO": 1,
+    "CODE": 2,
+    "REQUEST": 3,
+    "APPROVE": 4,
+    "APPROVAL": 5,
+    "RESPONSE": 6,
+    "ERROR": 7,
+    "SESSION": 8,
+    "PING": 9,
+    "PONG": 10,
+    "RESUME": 11,
+    "PATH": 12,
+    # Session channel (peer to peer, through the relay); payloads are binary
+    "FRAME": 16,
+    "ACK": 17,
+    "INPUT": 18,
+}
+COMMANDS = {opcode: command for command, opcode in OPCODES.items()}
+
+# Splits coalesced legacy messages such as "APPROVE:1234RESPONSE:yes".
+# APPROVAL is listed before APPROVE so the longer name wins.
+LEGACY_COMMANDS = ("CODE", "REQUEST", "APPROVAL", "APPROVE", "RESPONSE", "ERROR", "SESSION")
+LEGACY_SPLIT = re.compile(r"(?=(?:%s):)" % "|".join(LEGACY_COMMANDS))
+
+
+class ProtocolError(ValueError):
+    """Raised when a peer sends a frame that cannot be parsed."""
+
+
+def encode_frame(command, payload=""):
+    """Encode one binary frame. `payload` may be text or bytes."""
+    body = payload.encode() if isinstance(payload, str) else payload
+    return HEADER.pack(MAGIC, OPCODES[command], len(body)) + body
+
+
+def encode_legacy(command, payload=""):
+    """Encode one message in the legacy text format."""
+    return f"{command}:{payload}".encode()
+
+
+def encode_message(command, payload="", binary=True):
+    """Encode a message in whichever format the peer speaks."""
+    if binary:
+        return encode_frame(command, payload)
+    return encode_legacy(command, payload)
+
+
+class FrameDecoder:
+    """Incremental parser for a stream of frames.
+
+    Feed it whatever the socket returned; it returns every complete message
+    as a (command, payload) tuple and keeps partial frames for the next
+    call. Legacy text is accepted too; text without a known command is
+    returned as (None, text) so the caller can report it.
+
+    The first byte decides: a stream that starts with a frame is binary
+    for good, and text after it is an error. A stream that starts as text
+    stays legacy until a frame begins between two characters (a server
+    sends CODE as text before it has seen the client's HELLO), and is
+    binary from then on; 0xA5 inside a character such as "¥" is text.
+    Legacy messages have no terminator, so each one runs to the next
+    command or to the end of what has arrived; a last message that ends
+    in a partial character or is only part of a "COMMAND:" is kept until
+    more data comes.
+
+    With `text=False` payloads are returned as bytes and anything that is
+    not a binary frame is an error; session channels use this.
+    """
+
+    def __init__(self, max_frame=MAX_FRAME, text=True):
+        self.max_frame = max_frame
+        self.text = text
+        self.buffer = bytearray()
+        self.pos = 0
+        self.binary = False  # True once the peer has sent a binary frame
+
+    def feed(self, data):
+        self.buffer += data
+        messages = []
+        buffer = self.buffer
+        end = len(buffer)
+
+        while self.pos < end:
+            if buffer[self.pos] == MAGIC:
+                if end - self.pos < HEADER.size:
+                    break
+                _, opcode, length = HEADER.unpack_from(buffer, self.pos)
+                if length > self.max_frame:
+                    raise ProtocolError(f"Frame of {length} bytes exceeds limit of {self.max_frame}")
+                command = COMMANDS.get(opcode)
+                if command is None:
+                    raise ProtocolError(f"Unknown opcode {opcode}")
+                start = self.pos + HEADER.size
+                if end - start < length:
+                    break
+                payload = bytes(buffer[start:start + length])
+                messages.append((command, payload.decode() if self.text else payload))
+                self.pos = start + length
+                self.binary = True
+            elif not self.text or self.binary:
+                raise ProtocolError(f"Expected a binary frame, got byte {buffer[self.pos]:#x}")
+            else:
+                text_end = legacy_end(buffer, self.pos, end)
+                parsed = parse_legacy(buffer[self.pos:text_end].decode(errors="replace"))
+                # Keep the last message for the next read if it stops inside a
+                # character or looks like only the start of a message
+                split_char = text_end < end and buffer[text_end] != MAGIC
+                if parsed and (split_char or (text_end == end and partial_command(*parsed[-1]))):
+                    command, payload = parsed.pop()
+                    held = f"{command}:{payload}" if command else payload
+                    text_end = max(self.pos, text_end - len(held.encode()))
+                if text_end == self.pos:
+                    break  # Only a partial character or command so far
+                self.pos = text_end
+                messages.extend(parsed)
+
+        # Drop consumed bytes so the buffer does not grow without bound
+        if self.pos == end:
+            buffer.clear()
+            self.pos = 0
+        elif self.pos > len(buffer) // 2:
+            del buffer[:self.pos]
+            self.pos = 0
+        return messages
+
+
+def enable_keepalive(sock, idle=KEEPALIVE_IDLE, interval=KEEPALIVE_INTERVAL, count=KEEPALIVE_COUNT):
+    """Turn on TCP keepalive with short timers so the kernel notices dead peers.
+
+    The platform defaults wait two hours before the first probe. Options a
+    platform lacks are skipped; `sock` may be a socket or an asyncio
+    transport's socket.
+    """
+    try:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        # TCP_KEEPIDLE on Linux, TCP_KEEPALIVE on macOS
+        idle_option = getattr(socket, "TCP_KEEPIDLE", getattr(socket, "TCP_KEEPALIVE", None))
+        for option, value in ((idle_option, idle),
+                              (getattr(socket, "TCP_KEEPINTVL", None), interval),
+                              (getattr(socket, "TCP_KEEPCNT", None), count)):
+            if option is not None:
+                sock.setsockopt(socket.IPPROTO_TCP, option, value)
+        if hasattr(socket, "TCP_USER_TIMEOUT"):
+            # Also bound how long sent data may go unacknowledged (milliseconds)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_USER_TIMEOUT, (idle + interval * count) * 1000)
+    except OSError as e:
+        log.warning("Could not enable TCP keepalive: %s", e)
+
+
+def legacy_end(buffer, start, end):
+    """Where the legacy text at `start` ends: at the first binary frame that starts
+    between characters, or before a partial character at `end`."""
+    pos = start
+    while pos < end:
+        byte = buffer[pos]
+        if byte == MAGIC:
+            return pos  # A continuation byte where a character should start
+        # The lead byte gives the length of a UTF-8 character; a stray
+        # continuation byte or invalid lead counts as one
+        length = 2 if 0xC0 <= byte < 0xE0 else 3 if 0xE0 <= byte < 0xF0 else 4 if 0xF0 <= byte < 0xF8 else 1
+        if pos + length > end:
+            return pos
+        pos += length
+    return end
+
+
+def partial_command(command, payload):
+    """True if a parsed legacy message may be the start of one split across reads:
+    part of a command name, or a command whose payload has not arrived."""
+    if command is None:
+        return any(name.startswith(payload) for name in LEGACY_COMMANDS)
+    return not payload
+
+
+def parse_legacy(text):
+    """Split legacy text into (command, payload) messages."""
+    messages = []
+    for part in LEGACY_SPLIT.split(text):
+        if not part:
+            continue
+        if ":" not in part:
+            messages.append((None, part))
+            continue
+        command, payload = part.split(":", 1)
+        messages.append((command, payload))
+    return messages
+
+
+class Connection:
+    """A socket carrying framed messages.
+
+    Receives go through one preallocated buffer and an incremental decoder.
+    Sends use the binary format once the peer has shown it understands it
+    (or when created with `binary=True`), and the legacy text otherwise.
+    """
+
+    capture = None  # P_Capture.CaptureWriter recording this connection's sends, set by the server
+    capture_id = 0
+
+    def __init__(self, sock, binary=False, buffer_size=RECV_BUFFER_SIZE):
+        self.sock = sock
+        self.binary = binary
+        self.decoder = FrameDecoder()
+        self.recv_view = memoryview(bytearray(buffer_size))
+        self.send_lock = threading.Lock()
+        self.code = None  # Set by the server while a client holds a code on this connection
+        self.version = 0  # Protocol version from the client's HELLO; 0 for a legacy text client
+
+    def send_message(self, command, payload=""):
+        data = encode_message(command, payload, self.binary)
+        with self.send_lock:
+            self.sock.sendall(data)
+        return True
+
+    def try_send_message(self, command, payload=""):
+        """Send a small message only if that cannot block.
+
+        Returns False, sending nothing, while another thread is sending or
+        the socket's send buffer has no room.
+        """
+        data = encode_message(command, payload, self.binary)
+        if not self.send_lock.acquire(blocking=False):
+            return False
+        try:
+            if not select.select([], [self.sock], [], 0)[1]:
+                return False
+            self.sock.sendall(data)
+        finally:
+            self.send_lock.release()
+        return True
+
+    def recv_messages(self):
+        """Block for the next read. Returns a list of messages, or None on EOF."""
+        n = self.sock.recv_into(self.recv_view)
+        if not n:
+            return None
+        messages = self.decoder.feed(self.recv_view[:n])
+        if self.decoder.binary:
+            self.binary = True
+        return messages
+
+    def settimeout(self, timeout):
+        self.sock.settimeout(timeout)
+
+    def close(self):
+        # shutdown() wakes a thread blocked in recv on this socket; close() alone does not
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.sock.close()
+
+
+class QueuedConnection(Connection):
+    """A Connection whose sends never block the caller.
+
+    Messages go into a per-connection queue drained by this connection's
+    own writer thread, which also makes it the only thread writing to the
+    socket. At most `max_queue_bytes` may be waiting; past that the
+    `slow_policy` either drops the new message ("drop") or closes the
+    connection ("disconnect"), and `on_overflow(conn, disconnected)` is
+    called so the owner can count it. `send_message` returns False when
+    the message was not queued. `close` still sends what is queued, so an
+    ERROR followed by close reaches the client; `abort` discards it.
+    """
+
+    def __init__(self, sock, binary=False, max_queue_bytes=MAX_QUEUE_BYTES, slow_policy="drop", on_overflow=None):
+        if slow_policy not in SLOW_POLICIES:
+            raise ValueError(f"Unknown slow consumer policy: {slow_policy}")
+        super().__init__(sock, binary)
+        self.max_queue_bytes = max_queue_bytes
+        self.slow_policy = slow_policy
+        self.on_overflow = on_overflow
+        self.queue = deque()
+        self.queued_bytes = 0
+        self.peak_queued_bytes = 0
+        self.dropped = 0
+        self.closed = False
+        self.cond = threading.Condition()
+        self.writer = threading.Thread(target=self.write_loop, daemon=True)
+        self.writer.start()
+
+    def send_message(self, command, payload=""):
+        data = encode_message(command, payload, self.binary)
+        with self.cond:
+            if self.closed:
+                return False
+            if self.queued_bytes + len(data) > self.max_queue_bytes:
+                self.dropped += 1
+                disconnect = self.slow_policy == "disconnect"
+            else:
+                self.queue.append(data)
+                self.queued_bytes += len(data)
+                if self.queued_bytes > self.peak_queued_bytes:
+                    self.peak_queued_bytes = self.queued_bytes
+                self.cond.notify()
+                if self.capture is not None:
+                    self.capture.sent(self, command, payload)  # Under the lock, so records keep the send order
+                return True
+
+        if self.on_overflow is not None:
+            self.on_overflow(self, disconnect)
+        if disconnect:
+            self.abort()  # The queue is full; flushing it first is what the policy avoids
+        return False
+
+    def queue_depth(self):
+        return self.queued_bytes
+
+    def write_loop(self):
+        """Writer thread: send everything queued in one sendall per wakeup.
+
+        Legacy text has no delimiters, so until the peer speaks the binary
+        framing each message gets its own sendall instead. After `close`,
+        it sends what is left and then closes the socket.
+        """
+        while True:
+            with self.cond:
+                while not self.queue and not self.closed:
+                    self.cond.wait()
+                if not self.queue:
+                    break  # Closed and drained
+                if self.binary:
+                    batch = b"".join(self.queue)
+                    self.queue.clear()
+                else:
+                    batch = self.queue.popleft()
+
+            try:
+                self.sock.sendall(batch)
+            except OSError:
+                self.abort()
+                return
+
+            with self.cond:
+                self.queued_bytes = max(0, self.queued_bytes - len(batch))  # abort() may have zeroed it
+        super().close()
+
+    def close(self):
+        """Stop taking messages; the writer sends what is queued, then closes the socket."""
+        with self.cond:
+            if self.closed:
+                return
+            self.closed = True
+            self.cond.notify()
+        try:
+            self.sock.settimeout(CLOSE_TIMEOUT)  # A stalled peer cannot keep the writer flushing forever
+            self.sock.shutdown(socket.SHUT_RD)  # Wakes a thread blocked in recv on this socket
+        except OSError:
+            pass
+
+    def abort(self):
+        """Close at once, discarding anything still queued."""
+        with self.cond:
+            self.closed = True
+            self.queue.clear()
+            self.queued_bytes = 0
+            self.cond.notify()
+        super().close()
@@ -0,0 +1,90 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+MAX_KEYS = 100000  # Buckets a KeyedLimiter keeps before forgetting the least recently used
+
+
+class TokenBucket:
+    """Allows `rate` events per second on average and bursts of up to `burst`.
+
+    Tokens refill continuously; `take()` spends one if available. The
+    bucket is thread-safe and does no work between calls.
+    """
+
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.burst = burst if burst is not None else max(1, rate)
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def take(self, count=1):
+        """Spend `count` tokens. Returns False, spending nothing, if there are not enough."""
+        with self.lock:
+            self.refill(time.monotonic())
+            if self.tokens < count:
+                return False
+            self.tokens -= count
+            return True
+
+    def delay(self, count=1):
+        """Seconds until `count` tokens will be available."""
+        with self.lock:
+            self.refill(time.monotonic())
+            return max(0.0, (count - self.tokens) / self.rate)
+
+
+class KeyedLimiter:
+    """A token bucket per key, e.g. per source IP or per (source IP, target code).
+
+    Buckets live in one LRU-ordered dict under one lock; a bucket is two
+    numbers, so a flood of distinct keys costs little memory. A bucket
+    left alone for burst / rate seconds has refilled completely and is no
+    different from a new one, so each `take()` drops such buckets from the
+    old end of the dict; past `max_keys` the least recently used go too.
+    """
+
+    def __init__(self, rate, burst=None, max_keys=MAX_KEYS):
+        self.rate = rate
+        self.burst = burst if burst is not None else max(1, rate)
+        self.idle = self.burst / rate  # Seconds after which a bucket is full again
+        self.max_keys = max_keys
+        self.buckets = OrderedDict()  # {key: [tokens, last update]}, least recently used first
+        self.lock = threading.Lock()
+
+    def take(self, key, count=1):
+        """Spend `count` tokens from `key`'s bucket. Returns False, spending nothing, if there are not enough."""
+        now = time.monotonic()
+        with self.lock:
+            bucket = self.buckets.get(key)
+            if bucket is None:
+                bucket = self.buckets[key] = [self.burst, now]
+                if len(self.buckets) > self.max_keys:
+                    self.buckets.popitem(last=False)
+            else:
+                bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+                bucket[1] = now
+                self.buckets.move_to_end(key)
+            self.expire(now)
+            if bucket[0] < count:
+                return False
+            bucket[0] -= count
+            return True
+
+    def expire(self, now):
+        """Forget buckets that have refilled; called with the lock held."""
+        buckets = self.buckets
+        while buckets:
+            key = next(iter(buckets))
+            if now - buckets[key][1] < self.idle:
+                return
+            del buckets[key]
+
+    def __len__(self):
+        return len(self.buckets)
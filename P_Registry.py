@@ -0,0 +1,219 @@
+import json
+import logging
+import os
+import secrets
+import threading
+
+log = logging.getLogger(__name__)
+
+
+JOURNAL_PATH = "client_codes.journal"
+LEGACY_PATH = "client_codes.json"  # Whole-file JSON format used before the journal
+SECRET_SUFFIX = ".secret"  # Next to the journal: key for the server's resume tokens
+
+
+def load_secret(registry_path):
+    """Return the server's secret key, creating it on first use.
+
+    Kept beside the registry so resume tokens stay valid across restarts
+    and are shared by every worker of a cluster.
+    """
+    path = registry_path + SECRET_SUFFIX
+    try:
+        with open(path, "rb") as f:
+            secret = f.read()
+        if len(secret) >= 16:
+            return secret
+    except FileNotFoundError:
+        pass
+    secret = secrets.token_bytes(32)
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, "wb") as f:
+        f.write(secret)
+    return secret
+
+
+class CodeRegistry:
+    """Persistent {ip: code} map backed by an append-only journal.
+
+    Updates are applied in memory at once and handed to a writer thread,
+    which appends everything queued since its last write in one go and
+    fsyncs it (group commit), so the accept path never waits on disk.
+    When the journal holds many more records than live entries it is
+    rewritten as a snapshot and atomically swapped in.
+
+    A `readonly` registry loads the journal and then only changes in
+    memory; it is how processes that do not own the file mirror it.
+
+    Journal lines are "S<TAB>ip<TAB>code" for a set and "D<TAB>ip" for a
+    delete. A torn last line left by a crash is ignored on load.
+    """
+
+    def __init__(self, path=JOURNAL_PATH, legacy_path=LEGACY_PATH, compact_ratio=4, compact_min=1024, fsync=True,
+                 readonly=False, start=True):
+        self.path = path
+        self.compact_ratio = compact_ratio
+        self.compact_min = compact_min
+        self.fsync = fsync
+        self.codes = {}
+        self.pending = []  # Journal lines waiting for the writer
+        self.records = 0  # Records currently in the journal file
+        self.written = 0  # Total lines made durable, for flush()
+        self.queued = 0  # Total lines ever queued
+        self.cond = threading.Condition()
+        self.readonly = readonly
+        self.closed = False
+
+        if os.path.exists(self.path):
+            self.load()
+        elif legacy_path and os.path.exists(legacy_path):
+            self.import_legacy(legacy_path)
+
+        if readonly:
+            self.file = self.writer = None
+            return
+
+        self.file = open(self.path, "ab")
+        if self.records == 0 and self.codes:
+            self.compact()
+
+        self.writer = None
+        if start:
+            self.start()
+
+    def start(self):
+        """Start the writer thread. Deferred with start=False by a process that forks first."""
+        if self.writer is None and not self.readonly:
+            self.writer = threading.Thread(target=self.write_loop, daemon=True)
+            self.writer.start()
+
+    def load(self):
+        """Replay the journal into memory."""
+        try:
+            with open(self.path, "rb") as file:
+                data = file.read()
+        except OSError as e:
+            log.warning("Error loading codes: %s", e)
+            return
+
+        lines = data.split(b"\n")
+        if lines[-1] and not self.readonly:
+            # Cut the torn record off so new appends start on a clean line
+            log.debug("Ignoring incomplete journal record in %s", self.path)
+            with open(self.path, "r+b") as file:
+                file.truncate(len(data) - len(lines[-1]))
+        codes = self.codes
+        for line in lines[:-1]:
+            fields = line.decode(errors="replace").split("\t")
+            if fields[0] == "S" and len(fields) == 3:
+                codes[fields[1]] = fields[2]
+            elif fields[0] == "D" and len(fields) == 2:
+                codes.pop(fields[1], None)
+            else:
+                log.warning("Skipping corrupt journal record: %r", line)
+        self.records = len(lines) - 1
+
+    def import_legacy(self, legacy_path):
+        """Load codes saved by the old JSON format; they are re-written as a journal."""
+        try:
+            with open(legacy_path, "r") as file:
+                self.codes.update(json.load(file))
+            log.info("Imported %s codes from %s", len(self.codes), legacy_path)
+        except Exception as e:
+            log.warning("Error loading codes: %s", e)
+
+    def __contains__(self, ip):
+        return ip in self.codes
+
+    def __getitem__(self, ip):
+        return self.codes[ip]
+
+    def __len__(self):
+        return len(self.codes)
+
+    def get(self, ip, default=None):
+        return self.codes.get(ip, default)
+
+    def items(self):
+        return self.codes.items()
+
+    def values(self):
+        return self.codes.values()
+
+    def __setitem__(self, ip, code):
+        self.codes[ip] = code
+        self.append(f"S\t{ip}\t{code}\n")
+
+    def __delitem__(self, ip):
+        del self.codes[ip]
+        self.append(f"D\t{ip}\n")
+
+    def append(self, line):
+        if self.readonly:
+            return
+        with self.cond:
+            self.pending.append(line)
+            self.queued += 1
+            self.cond.notify_all()
+
+    def write_loop(self):
+        """Writer thread: group-commit queued records and compact when due."""
+        while True:
+            with self.cond:
+                while not self.pending and not self.closed:
+                    self.cond.wait()
+                if not self.pending and self.closed:
+                    return
+                batch, self.pending = self.pending, []
+
+            try:
+                self.file.write("".join(batch).encode())
+                self.file.flush()
+                if self.fsync:
+                    os.fsync(self.file.fileno())
+                self.records += len(batch)
+                if self.records > self.compact_min and self.records > self.compact_ratio * len(self.codes):
+                    self.compact()
+            except Exception as e:
+                log.warning("Error saving codes: %s", e)
+
+            with self.cond:
+                self.written += len(batch)
+                self.cond.notify_all()
+
+    def compact(self):
+        """Rewrite the journal as one record per live entry."""
+        snapshot = self.codes.copy()  # Atomic under the GIL, unlike iterating the live dict
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "wb") as file:
+            file.write("".join(f"S\t{ip}\t{code}\n" for ip, code in snapshot.items()).encode())
+            file.flush()
+            if self.fsync:
+                os.fsync(file.fileno())
+        os.replace(tmp_path, self.path)
+        self.file.close()
+        self.file = open(self.path, "ab")
+        self.records = len(snapshot)
+
+    def flush(self, timeout=None):
+        """Block until everything queued so far is on disk."""
+        if self.readonly:
+            return True
+        with self.cond:
+            target = self.queued
+            return self.cond.wait_for(lambda: self.written >= target, timeout)
+
+    def close(self):
+        """Write out pending records and stop the writer thread."""
+        if self.readonly:
+            return
+        with self.cond:
+            if self.closed:
+                return
+            self.closed = True
+            self.cond.notify_all()
+        if self.writer is None:
+            self.write_loop()  # Never started; write out what was queued here
+        else:
+            self.writer.join()
+        self.file.close()
@@ -0,0 +1,260 @@
+import logging
+import os
+import secrets
+import socket
+import threading
+import time
+
+try:
+    import fcntl
+except ImportError:  # Not available on Windows
+    fcntl = None
+
+log = logging.getLogger(__name__)
+
+
+TOKEN_LENGTH = 32  # Hex characters a peer sends first to join its session
+BUFFER_SIZE = 256 * 1024
+PIPE_SIZE = 1024 * 1024
+JOIN_TIMEOUT = 30  # Seconds a session waits for both peers
+F_SETPIPE_SZ = getattr(fcntl, "F_SETPIPE_SZ", 1031)
+SPLICE_FLAGS = getattr(os, "SPLICE_F_MOVE", 0) | getattr(os, "SPLICE_F_MORE", 0)
+
+
+def splice_supported():
+    return hasattr(os, "splice")
+
+
+class RelaySession:
+    """A pair of peers whose traffic the relay forwards.
+
+    `bytes_sent[i]` counts bytes forwarded from peer i to the other peer;
+    each counter has a single writer (that direction's thread).
+    """
+
+    def __init__(self, token, codes):
+        self.token = token
+        self.codes = codes  # (requesting code, approving code)
+        self.created_at = time.monotonic()
+        self.started_at = None
+        self.socks = [None, None]
+        self.bytes_sent = [0, 0]
+        self.finished = 0
+        self.ready = threading.Event()
+        self.lock = threading.Lock()
+
+    def join(self, sock):
+        """Attach a peer socket. Returns its index, or None if the session is full."""
+        with self.lock:
+            for index in (0, 1):
+                if self.socks[index] is None:
+                    self.socks[index] = sock
+                    if index == 1:
+                        self.started_at = time.monotonic()
+                        self.ready.set()
+                    return index
+        return None
+
+    def stats(self):
+        elapsed = time.monotonic() - self.started_at if self.started_at else 0.0
+        total = sum(self.bytes_sent)
+        return {
+            "token": self.token[:8],
+            "codes": self.codes,
+            "bytes": list(self.bytes_sent),
+            "seconds": elapsed,
+            "mbps": total * 8 / elapsed / 1e6 if elapsed else 0.0,
+        }
+
+
+class RelayServer:
+    """Forwards bytes between the two peers of each approved session.
+
+    P_Server creates a session when a request is approved and hands both
+    peers its token. Each peer connects to the relay port and sends the
+    token; once both are there, one thread per direction moves the data.
+    On Linux the bytes go socket -> pipe -> socket with os.splice and never
+    enter Python; elsewhere each thread reuses one preallocated buffer with
+    recv_into, so no chunk is copied into a new object.
+    """
+
+    def __init__(self, host, port, buffer_size=BUFFER_SIZE, use_splice=None):
+        self.buffer_size = buffer_size
+        self.use_splice = splice_supported() if use_splice is None else use_splice
+        self.sessions = {}  # {token: RelaySession}
+        self.lock = threading.Lock()
+        self.running = False
+        self.completed = 0
+        self.bytes_relayed = 0
+
+        self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.server_socket.bind((host, port))
+        self.server_socket.listen(socket.SOMAXCONN)
+        self.server_socket.settimeout(1)
+        self.port = self.server_socket.getsockname()[1]
+
+    def create_session(self, requesting_code, approving_code):
+        """Register a session and return its token."""
+        token = secrets.token_hex(TOKEN_LENGTH // 2)
+        with self.lock:
+            self.sessions[token] = RelaySession(token, (requesting_code, approving_code))
+        return token
+
+    def session_codes(self, token):
+        """The (requesting, approving) codes of a session, or None if there is no such session."""
+        with self.lock:
+            session = self.sessions.get(token)
+        return session.codes if session is not None else None
+
+    def discard_session(self, token):
+        """Drop a session nobody joined, e.g. because its peers connected directly."""
+        with self.lock:
+            session = self.sessions.get(token)
+            if session is None or any(sock is not None for sock in session.socks):
+                return False
+            del self.sessions[token]
+        return True
+
+    def start(self):
+        self.running = True
+        threading.Thread(target=self.accept_loop, daemon=True).start()
+        log.info("Relay listening on port %s (%s)", self.port, "splice" if self.use_splice else "recv_into")
+
+    def accept_loop(self):
+        while self.running:
+            self.expire_sessions()
+            try:
+                sock, addr = self.server_socket.accept()
+            except socket.timeout:
+                continue
+            except OSError:
+                break
+            threading.Thread(target=self.handle_peer, args=(sock, addr), daemon=True).start()
+
+    def expire_sessions(self):
+        """Drop sessions whose peers did not both show up in time."""
+        deadline = time.monotonic() - JOIN_TIMEOUT
+        with self.lock:
+            expired = [s for s in self.sessions.values() if not s.ready.is_set() and s.created_at < deadline]
+            for session in expired:
+                del self.sessions[session.token]
+        for session in expired:
+            for sock in session.socks:
+                if sock is not None:
+                    sock.close()
+
+    def recv_token(self, sock):
+        sock.settimeout(10)
+        token = b""
+        while len(token) < TOKEN_LENGTH:
+            chunk = sock.recv(TOKEN_LENGTH - len(token))
+            if not chunk:
+                return None
+            token += chunk
+        sock.settimeout(None)
+        return token.decode(errors="replace")
+
+    def handle_peer(self, sock, addr):
+        """Join a peer to its session, then pump its bytes to the other peer."""
+        try:
+            token = self.recv_token(sock)
+        except OSError:
+            token = None
+        with self.lock:
+            session = self.sessions.get(token)
+        index = session.join(sock) if session is not None else None
+        if index is None:
+            log.warning("Relay rejected peer %s: unknown or full session", addr)
+            sock.close()
+            return
+
+        if not session.ready.wait(JOIN_TIMEOUT):
+            return  # expire_sessions closes the socket
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        src, dst = session.socks[index], session.socks[1 - index]
+        try:
+            if self.use_splice:
+                self.pump_splice(session, index, src, dst)
+            else:
+                self.pump_buffer(session, index, src, dst)
+            dst.shutdown(socket.SHUT_WR)  # Pass the half-close on
+        except OSError:
+            # One side reset; wake the other direction too
+            for peer in session.socks:
+                try:
+                    peer.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+        self.finish(session)
+
+    def pump_buffer(self, session, index, src, dst):
+        view = memoryview(bytearray(self.buffer_size))
+        sent = session.bytes_sent
+        while True:
+            n = src.recv_into(view)
+            if not n:
+                return
+            dst.sendall(view[:n])
+            sent[index] += n
+
+    def pump_splice(self, session, index, src, dst):
+        read_fd, write_fd = os.pipe()
+        try:
+            if fcntl is not None:
+                try:
+                    fcntl.fcntl(write_fd, F_SETPIPE_SZ, PIPE_SIZE)
+                except OSError:
+                    pass  # Keep the default pipe size
+            src_fd, dst_fd = src.fileno(), dst.fileno()
+            sent = session.bytes_sent
+            while True:
+                n = os.splice(src_fd, write_fd, PIPE_SIZE, flags=SPLICE_FLAGS)
+                if not n:
+                    return
+                remaining = n
+                while remaining:
+                    remaining -= os.splice(read_fd, dst_fd, remaining, flags=SPLICE_FLAGS)
+                sent[index] += n
+        finally:
+            os.close(read_fd)
+            os.close(write_fd)
+
+    def finish(self, session):
+        """Called by each direction when it ends; the second one closes the session."""
+        with session.lock:
+            session.finished += 1
+            if session.finished < 2:
+                return
+        with self.lock:
+            self.sessions.pop(session.token, None)
+            self.completed += 1
+            self.bytes_relayed += sum(session.bytes_sent)
+        for sock in session.socks:
+            sock.close()
+        stats = session.stats()
+        log.info("Relay session %s<->%s closed: %s bytes in %.2fs (%.1f Mbps)", stats["codes"][0], stats["codes"][1],
+                 sum(stats["bytes"]), stats["seconds"], stats["mbps"])
+
+    def session_stats(self):
+        """Per-session throughput for the sessions currently open."""
+        with self.lock:
+            sessions = list(self.sessions.values())
+        return [session.stats() for session in sessions if session.ready.is_set()]
+
+    def stop(self):
+        self.running = False
+        try:
+            self.server_socket.close()
+        except OSError:
+            pass
+        with self.lock:
+            sessions = list(self.sessions.values())
+            self.sessions.clear()
+        for session in sessions:
+            for sock in session.socks:
+                if sock is not None:
+                    try:
+                        sock.shutdown(socket.SHUT_RDWR)
+                    except OSError:
+                        pass
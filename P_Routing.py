@@ -0,0 +1,90 @@
+import threading
+
+
+SHARDS = 16  # Lock stripes; a power of two
+
+
+class Route:
+    """Where to send messages for one code."""
+
+    __slots__ = ("code", "conn", "addr")
+
+    def __init__(self, code, conn, addr):
+        self.code = code
+        self.conn = conn
+        self.addr = addr
+
+
+class RoutingTable:
+    """Thread-safe {code: Route} map, split into lock-striped shards.
+
+    Writers (register, evict, replace) take only the lock of the shard the
+    code hashes to, so connects and disconnects on different shards do not
+    wait for each other, and each write is atomic: an evict that names the
+    connection it expects can never remove a newer registration. Lookups
+    take no lock at all; a dict read is atomic and the table never mutates
+    a Route in place, so readers scale with the number of handler threads.
+    """
+
+    def __init__(self, shards=SHARDS):
+        if shards & (shards - 1):
+            raise ValueError(f"Shard count must be a power of two, got {shards}")
+        self.mask = shards - 1
+        self.shards = [{} for _ in range(shards)]
+        self.locks = [threading.Lock() for _ in range(shards)]
+
+    def index(self, code):
+        return hash(code) & self.mask
+
+    def register(self, code, conn, addr):
+        """Route `code` to `conn`. Returns the Route it replaced, or None."""
+        i = self.index(code)
+        with self.locks[i]:
+            previous = self.shards[i].get(code)
+            self.shards[i][code] = Route(code, conn, addr)
+        return previous
+
+    def lookup(self, code):
+        """Return the Route for `code`, or None."""
+        return self.shards[hash(code) & self.mask].get(code)
+
+    def evict(self, code, conn=None):
+        """Remove `code`, only while it still routes to `conn` if that is given.
+
+        Returns the removed Route, or None if nothing was removed; when
+        several threads evict the same code, exactly one gets the Route.
+        """
+        i = self.index(code)
+        with self.locks[i]:
+            route = self.shards[i].get(code)
+            if route is None or (conn is not None and route.conn is not conn):
+                return None
+            del self.shards[i][code]
+        return route
+
+    def owns(self, code, conn):
+        """True while `code` routes to `conn`."""
+        route = self.lookup(code)
+        return route is not None and route.conn is conn
+
+    def codes(self):
+        """Snapshot of the registered codes."""
+        codes = []
+        for lock, shard in zip(self.locks, self.shards):
+            with lock:
+                codes.extend(shard)
+        return codes
+
+    def routes(self):
+        """Snapshot of the registered Routes."""
+        routes = []
+        for lock, shard in zip(self.locks, self.shards):
+            with lock:
+                routes.extend(shard.values())
+        return routes
+
+    def __contains__(self, code):
+        return code in self.shards[hash(code) & self.mask]
+
+    def __len__(self):
+        return sum(len(shard) for shard in self.shards)
@@ -1,146 +1,773 @@
+import hmac
+import logging
+import secrets
 import socket
 import threading
-import random
-import json
-import os
 import time
+from collections import OrderedDict
+
+from P_Allocator import DIGITS, CodeAllocator, CodeSpaceExhausted
+from P_Capture import CaptureWriter
+from P_Direct import format_endpoint
+from P_Log import setup_logging
+from P_Metrics import MetricsRegistry, MetricsServer
+from P_Protocol import MAX_QUEUE_BYTES, OPCODES, SLOW_POLICIES, ProtocolError, QueuedConnection, enable_keepalive
+from P_RateLimit import KeyedLimiter, TokenBucket
+from P_Registry import JOURNAL_PATH, CodeRegistry, load_secret
+from P_Relay import RelayServer
+from P_Routing import RoutingTable
+from P_Timers import LivenessTracker, TimerWheel
+
+log = logging.getLogger(__name__)
+
+
+ENGINES = ("thread", "asyncio")
+REQUEST_TIMEOUT = 60  # Seconds a connection request waits for the target's decision
+LIVENESS_TIMEOUT = 15  # Seconds of silence before a heartbeating client is evicted
+SESSION_VERSION = 1  # Clients that send HELLO join relay sessions; legacy text clients cannot parse SESSION
+HEARTBEAT_VERSION = 2  # First client protocol version that sends PINGs
+RESUME_VERSION = 3  # First client protocol version that understands RESUME tokens
+DIRECT_VERSION = 4  # First client protocol version that tries direct sessions and reports PATH
+CODEC_VERSION = 5  # First client protocol version that negotiates a session codec
+RESUME_WINDOW = 30  # Seconds after startup during which requests for known, absent codes are held
+RESUME_TOKEN_TTL = 24 * 3600  # Seconds a resume token stays valid; each HELLO gets a fresh one
+SESSION_PATHS = ("direct", "relay")
+MAX_SESSION_RECORDS = 1000  # Recent sessions whose path is kept in session_paths
+
+
+def with_request_id(payload, request_id):
+    """Append a request id to a reply, for clients that sent one."""
+    return f"{payload},{request_id}" if request_id else payload
 
 
 class P_Server:
-    def __init__(self, host, port):
+    def __init__(self, host, port, engine="thread", registry_path=JOURNAL_PATH,
+                 code_length=4, code_alphabet=DIGITS, code_ttl=None, reclaim_interval=60,
+                 max_queue_bytes=MAX_QUEUE_BYTES, slow_policy="drop", reuse_port=False,
+                 relay=True, relay_port=None, request_timeout=REQUEST_TIMEOUT,
+                 liveness_timeout=LIVENESS_TIMEOUT, accept_rate=None, accept_burst=None,
+                 resume_window=RESUME_WINDOW, metrics_port=None, metrics_host="127.0.0.1",
+                 ip_accept_rate=None, ip_accept_burst=None, target_request_rate=None, target_request_burst=None,
+                 capture_path=None, resume_token_ttl=RESUME_TOKEN_TTL):
+        if engine not in ENGINES:
+            raise ValueError(f"Unknown server engine: {engine}")
+        if slow_policy not in SLOW_POLICIES:
+            raise ValueError(f"Unknown slow consumer policy: {slow_policy}")
         self.host = host
         self.port = port
-        self.clients = {}  # {code: (conn, addr)}
-        self.codes = self.load_codes()  # {ip: code}
+        self.engine = engine
+        self.async_engine = None  # Set while the asyncio engine is serving
+        self.clients = RoutingTable()  # {code: Route}, safe to share between handler threads
+        self.codes = self.open_registry(registry_path)  # {ip: code}, persisted in the background
+        self.code_lock = threading.Lock()
+        self.allocator = CodeAllocator(code_length, code_alphabet)  # {code: ip} and the free codes
+        for ip, code in self.codes.items():
+            self.allocator.reserve(code, ip)
+        self.code_ttl = code_ttl  # Seconds of inactivity before an IP's code is reclaimed
+        self.reclaim_interval = reclaim_interval
+        self.next_reclaim = time.monotonic() + reclaim_interval
+        self.max_queue_bytes = max_queue_bytes  # Per-client outbound buffer limit
+        self.slow_policy = slow_policy  # "drop" or "disconnect" when that limit is hit
+        self.stats_lock = threading.Lock()
+        self.dropped_messages = 0
+        self.slow_disconnects = 0
+        self.request_timeout = request_timeout
+        self.timers = TimerWheel()  # Driven by the engine: a thread, or the event loop
+        self.pending_requests = {}  # {(requesting code, request id): (target code, Timer)}
+        self.pending_lock = threading.Lock()
+        # Clients that heartbeat are evicted once silent for liveness_timeout. Keyed
+        # by connection, so a late eviction cannot hit a reconnect that took the code
+        self.liveness = LivenessTracker(self.timers, liveness_timeout, self.evict_client)
+        self.resume_secret = load_secret(registry_path)
+        self.resume_token_ttl = resume_token_ttl
+        # Connections accepted per second; a fleet reconnecting after a
+        # restart waits in the listen backlog instead of swamping the server
+        self.accept_limiter = TokenBucket(accept_rate, accept_burst) if accept_rate else None
+        # Per source IP connections/s, checked before a connection gets a thread or task,
+        # and REQUESTs/s per (source IP, target code), so nobody can flood a client
+        # with prompts, nor use up the allowance of everyone else who asks it
+        self.ip_limiter = KeyedLimiter(ip_accept_rate, ip_accept_burst) if ip_accept_rate else None
+        self.target_limiter = KeyedLimiter(target_request_rate, target_request_burst) if target_request_rate else None
+        self.started_at = time.monotonic()
+        self.resume_window = resume_window
+        self.held_requests = {}  # {target code: [(requesting code, request id, codec offer)]}, see hold_request
+        self.session_paths = OrderedDict()  # {session token: ((requesting, approving code), path)}, newest last
+        self.session_reports = OrderedDict()  # {session token: (codes, {code: path})} until both peers report
+        self.capture = None
+        self.setup_metrics()
         self.running = True
 
         try:
             self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
             # Allow address reuse
             self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            if reuse_port:
+                # Several worker processes share the port; the kernel spreads connections across them
+                if not hasattr(socket, "SO_REUSEPORT"):
+                    raise OSError("SO_REUSEPORT is not supported on this platform")
+                self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
             self.server_socket.bind((self.host, self.port))
-            self.server_socket.listen(10)  # Allow multiple clients
+            self.server_socket.listen(socket.SOMAXCONN if accept_rate else 10)  # Allow multiple clients
             self.server_socket.settimeout(1)  # Add timeout for accept
-            print(f"Server started on {self.host}:{self.port}")
+            log.info("Server started on %s:%s", self.host, self.port)
         except Exception as e:
-            print(f"Error starting server: {e}")
+            log.error("Error starting server: %s", e)
+            self.codes.close()
             raise
 
-    def load_codes(self):
-        """Load existing codes from a file or initialize an empty dictionary."""
-        try:
-            if os.path.exists("client_codes.json"):
-                with open("client_codes.json", "r") as file:
-                    return json.load(file)
-        except Exception as e:
-            print(f"Error loading codes: {e}")
-        return {}
+        # Data plane for approved sessions, on the next port by default
+        self.relay = None
+        if relay:
+            if relay_port is None:
+                relay_port = self.port + 1 if self.port else 0
+            try:
+                self.relay = RelayServer(self.host, relay_port)
+            except Exception as e:
+                log.warning("Error starting relay: %s", e)
+                self.server_socket.close()
+                self.codes.close()
+                raise
 
-    def save_codes(self):
-        """Save the current codes to a file."""
-        try:
-            with open("client_codes.json", "w") as file:
-                json.dump(self.codes, file)
-        except Exception as e:
-            print(f"Error saving codes: {e}")
+        # Prometheus /metrics and the profiler, on localhost unless told otherwise
+        self.metrics_server = None
+        if metrics_port is not None:
+            try:
+                self.metrics_server = MetricsServer(self.metrics, metrics_host, metrics_port)
+            except OSError as e:
+                log.warning("Error starting metrics endpoint: %s", e)
+                self.server_socket.close()
+                if self.relay is not None:
+                    self.relay.server_socket.close()
+                self.codes.close()
+                raise
+
+        # Every control message in and out, for replaying realistic workloads (benchmarks/bench_replay.py)
+        if capture_path:
+            self.capture = CaptureWriter(capture_path)
+            log.info("Capturing control traffic to %s", capture_path)
+
+    def setup_metrics(self):
+        """Create the server's counters, histograms and sampled gauges."""
+        m = self.metrics = MetricsRegistry()
+        self.connects_total = m.counter("pserver_connects_total", "Clients that were assigned a code")
+        self.rejects_total = m.counter("pserver_rejected_connections_total", "Connections that could not get a code")
+        self.disconnects_total = m.counter("pserver_disconnects_total", "Clients removed")
+        self.messages_total = {
+            command: m.counter("pserver_messages_received_total", "Messages received from clients", command=command)
+            for command in OPCODES
+        }
+        self.invalid_messages_total = m.counter("pserver_messages_received_total", "Messages received from clients",
+                                                command="invalid")
+        self.forwards_total = m.counter("pserver_forwards_total", "Messages queued for another client")
+        self.forward_failures_total = m.counter("pserver_forward_failures_total",
+                                                "Messages for a client that was gone or whose queue was full")
+        self.errors_total = m.counter("pserver_errors_total", "Protocol errors and exceptions in client handlers")
+        self.handler_seconds = m.histogram("pserver_handler_seconds", "Time to handle one client message")
+        self.sessions_total = {
+            path: m.counter("pserver_sessions_total", "Sessions by the path their traffic took", path=path)
+            for path in SESSION_PATHS
+        }
+        self.shed_connections_total = m.counter("pserver_shed_total", "Connections and requests refused by a rate limit",
+                                                kind="connection")
+        self.shed_requests_total = m.counter("pserver_shed_total", "Connections and requests refused by a rate limit",
+                                             kind="request")
+        m.sampled("pserver_clients", "Connected clients", lambda: len(self.clients))
+        m.sampled("pserver_queued_bytes", "Bytes waiting in client send queues",
+                  lambda: self.queue_stats()["queued_bytes"])
+        m.sampled("pserver_pending_requests", "Connection requests waiting for a decision",
+                  lambda: len(self.pending_requests))
+        m.sampled("pserver_dropped_messages_total", "Messages refused by a full send queue",
+                  lambda: self.dropped_messages, kind="counter")
+        m.sampled("pserver_slow_disconnects_total", "Clients disconnected for not reading",
+                  lambda: self.slow_disconnects, kind="counter")
+        m.sampled("pserver_evicted_clients_total", "Clients evicted after missing heartbeats",
+                  lambda: self.liveness.evicted, kind="counter")
+        m.sampled("pserver_relay_sessions", "Relay sessions open or waiting for peers",
+                  lambda: len(self.relay.sessions) if self.relay is not None else 0)
+        m.sampled("pserver_relay_bytes_total", "Bytes relayed by finished sessions",
+                  lambda: self.relay.bytes_relayed if self.relay is not None else 0, kind="counter")
+        m.sampled("pserver_capture_bytes", "Bytes written to the traffic capture",
+                  lambda: self.capture.size if self.capture is not None else 0)
+        m.sampled("pserver_capture_dropped_total", "Capture records dropped because the capture was full",
+                  lambda: self.capture.dropped if self.capture is not None else 0, kind="counter")
+
+    def open_registry(self, path):
+        """Open the persistent {ip: code} registry."""
+        return CodeRegistry(path)
 
     def generate_code(self, ip):
         """Generate or retrieve a permanent code for a unique IP."""
-        if ip not in self.codes:
-            # Generate a code that's not already in use
-            while True:
-                code = f"{random.randint(1000, 9999)}"
-                if code not in self.codes.values():
-                    break
-            self.codes[ip] = code
-            self.save_codes()
-        return self.codes[ip]
+        with self.code_lock:
+            code = self.codes.get(ip)
+            if code is None:
+                code = self.allocator.allocate(ip)  # Raises CodeSpaceExhausted when full
+                self.codes[ip] = code  # Queued for the registry's writer thread
+            else:
+                self.allocator.touch(ip)
+            return code
 
-    def handle_client(self, conn, addr):
-        """Handle communication with a client."""
-        ip = addr[0]
-        code = self.generate_code(ip)
-        self.clients[code] = (conn, addr)
+    def code_lookup_blocks(self, ip):
+        """True if generate_code(ip) may wait on another process."""
+        return False
 
-        try:
-            conn.send(f"CODE:{code}".encode())  # Send permanent code to client
-            print(f"Client connected: {addr}, assigned code: {code}")
-        except Exception as e:
-            print(f"Error sending code to client {addr}: {e}")
-            self.remove_client(code)
+    def reclaim_codes(self):
+        """Give the codes of long-idle IPs back to the allocator.
+
+        Connected clients are never reclaimed. Does nothing unless the
+        server was created with a `code_ttl`.
+        """
+        self.next_reclaim = time.monotonic() + self.reclaim_interval
+        if self.code_ttl is None:
+            return
+        with self.code_lock:
+            reclaimed = self.allocator.reclaim_idle(self.code_ttl, keep=lambda ip, code: code in self.clients)
+            for ip, code in reclaimed:
+                del self.codes[ip]
+        if reclaimed:
+            log.info("Reclaimed %s idle codes", len(reclaimed))
+
+    def handle_client(self, sock, addr):
+        """Handle communication with a client."""
+        enable_keepalive(sock)
+        conn = QueuedConnection(sock, max_queue_bytes=self.max_queue_bytes,
+                                slow_policy=self.slow_policy, on_overflow=self.record_overflow)
+        if self.register_client(conn, addr) is None:
             return
 
-        while code in self.clients and self.running:
+        # conn.code rather than a local: a resume can move the connection to another code
+        while conn.code in self.clients and self.running:
             try:
-                data = conn.recv(1024).decode()
-                if not data:
+                messages = conn.recv_messages()
+                if messages is None:
                     break
 
-                if ":" not in data:
-                    print(f"Invalid data format from {addr}: {data}")
-                    continue
-
-                command, payload = data.split(":", 1)
-
-                if command == "REQUEST":
-                    target_code = payload
-                    if target_code in self.clients and target_code != code:
-                        target_conn, _ = self.clients[target_code]
-                        try:
-                            target_conn.send(f"APPROVE:{code}".encode())
-                            print(f"Forwarded connection request from {code} to {target_code}")
-                        except Exception as e:
-                            print(f"Error forwarding request to {target_code}: {e}")
-                            conn.send(f"ERROR: Target client is not responding.".encode())
-                    elif target_code == code:
-                        conn.send("ERROR: Cannot connect to yourself.".encode())
-                    else:
-                        conn.send("ERROR: Target code not found.".encode())
-
-                elif command == "APPROVAL":
-                    try:
-                        requesting_code, decision = payload.split(",")
-                        if requesting_code in self.clients:
-                            requesting_conn, _ = self.clients[requesting_code]
-                            requesting_conn.send(f"RESPONSE:{decision}".encode())
-                            print(f"Forwarded approval response {decision} from {code} to {requesting_code}")
-                        else:
-                            print(f"Client {requesting_code} not found for approval")
-                    except ValueError:
-                        print(f"Invalid approval format from {addr}: {payload}")
+                for command, payload in messages:
+                    self.process_message(conn.code, addr, conn, command, payload)
 
             except socket.timeout:
                 continue
+            except ProtocolError as e:
+                log.warning("Protocol error from %s: %s", addr, e)
+                self.errors_total.inc()
+                break
             except Exception as e:
-                print(f"Error handling client {addr}: {e}")
+                log.warning("Error handling client %s: %s", addr, e)
+                self.errors_total.inc()
                 break
 
-        self.remove_client(code)
+        self.remove_client(conn.code, conn)
+
+    def register_client(self, conn, addr, code=None, error=None):
+        """Assign a code to a new connection and send it to the client.
 
-    def remove_client(self, code):
-        """Remove a client from the clients dictionary and close the connection."""
-        if code in self.clients:
-            conn, addr = self.clients[code]
+        `code` or `error` is the outcome of a generate_code call the caller
+        already made, e.g. off the event loop (see code_lookup_blocks).
+        Returns the code, or None if the client could not be reached.
+        """
+        if self.capture is not None:
+            self.capture.connection_opened(conn, addr)
+        ip = addr[0]
+        try:
+            if error is not None:
+                raise error
+            if code is None:
+                code = self.generate_code(ip)
+        except (CodeSpaceExhausted, OSError) as e:
+            log.warning("Rejecting client %s: %s", addr, e)
+            self.rejects_total.inc()
+            reason = "No free codes on this server." if isinstance(e, CodeSpaceExhausted) else "Server is busy, try again."
             try:
+                conn.send_message("ERROR", reason)
                 conn.close()
-            except:
+            except Exception:
                 pass
-            del self.clients[code]
-            print(f"Client {addr} disconnected")
+            if self.capture is not None:
+                self.capture.connection_closed(conn)
+            return None
+        self.close_replaced(self.clients.register(code, conn, addr), conn)
+        conn.code = code
+
+        try:
+            conn.send_message("CODE", code)  # Send permanent code to client
+            self.connects_total.inc()
+            log.info("Client connected: %s, assigned code: %s", addr, code)
+        except Exception as e:
+            log.warning("Error sending code to client %s: %s", addr, e)
+            self.remove_client(code, conn)
+            return None
+        self.release_held_requests(code)
+        return code
+
+    def process_message(self, code, addr, conn, command, payload):
+        """Handle one decoded message from the client holding `code`.
+
+        `conn` and the connections stored in `self.clients` only need
+        `send_message(command, payload)` and `close()`, so every server
+        engine shares this. Each message is counted and timed.
+        """
+        started = time.perf_counter()
+        (self.messages_total.get(command) or self.invalid_messages_total).inc()
+        if self.capture is not None:
+            self.capture.received(conn, command, payload)
+        try:
+            self.dispatch_message(code, addr, conn, command, payload)
+        finally:
+            self.handler_seconds.observe(time.perf_counter() - started)
+
+    def dispatch_message(self, code, addr, conn, command, payload):
+        self.liveness.seen(conn)
+        if command is None:
+            log.warning("Invalid data format from %s: %s", addr, payload)
+            return
+
+        if command == "HELLO":
+            # "<version>" or "<version>,<resume token>". The client speaks the
+            # binary framing; Connection already switched. From version 2 on
+            # it also heartbeats, so silence means it is gone.
+            version, _, token = payload.partition(",")
+            version = int(version) if version.isdigit() else 1
+            conn.version = version
+            if version >= HEARTBEAT_VERSION:
+                self.liveness.watch(conn)
+            if version >= RESUME_VERSION:
+                if token:
+                    code = self.resume_client(code, conn, addr, token)
+                conn.send_message("RESUME", self.resume_token(code))
+            return
+
+        if command == "PING":
+            conn.send_message("PONG", payload)
+            return
+
+        if command == "PATH":
+            # "<session token>,<direct|relay>" once the peer's session channel is up
+            token, _, path = payload.partition(",")
+            self.record_session_path(code, token, path)
+            return
+
+        if command == "REQUEST":
+            # "<target>[,<request id>[,<codec offer>]]"; replies carry the id back
+            target_code, _, request_id = payload.partition(",")
+            request_id, _, offer = request_id.partition(",")
+            pending = self.pending_requests.get((code, request_id)) if request_id else None
+            if pending is not None and pending[0] == target_code:
+                return  # Re-sent after a reconnect; the target already has it
+            if target_code == code:
+                conn.send_message("ERROR", with_request_id("Cannot connect to yourself.", request_id))
+            elif self.target_limiter is not None and not self.target_limiter.take((addr[0], target_code)):
+                self.shed_requests_total.inc()
+                conn.send_message("ERROR", with_request_id("Too many requests for this client, try again later.",
+                                                           request_id))
+            elif self.is_routable(target_code):
+                self.track_request(code, request_id, target_code)  # Before forwarding, so a fast reply finds it
+                if self.forward(target_code, "APPROVE", self.approve_payload(code, request_id, offer, target_code)):
+                    log.debug("Forwarded connection request from %s to %s", code, target_code)
+                else:
+                    self.complete_request(code, request_id)
+                    conn.send_message("ERROR", with_request_id("Target client is not responding.", request_id))
+            elif self.hold_request(code, request_id, target_code, offer):
+                log.debug("Holding request from %s until %s reconnects", code, target_code)
+            else:
+                conn.send_message("ERROR", with_request_id("Target code not found.", request_id))
+
+        elif command == "APPROVAL":
+            try:
+                # "<requester>,<decision>" or "<requester>,<request id>,<decision>[,<codec>]"
+                fields = payload.split(",")
+                codec = ""
+                if len(fields) == 4:
+                    requesting_code, request_id, decision, codec = fields
+                elif len(fields) == 3:
+                    requesting_code, request_id, decision = fields
+                else:
+                    (requesting_code, decision), request_id = fields, ""
+                response = with_request_id(decision, request_id)
+                if codec and decision == "yes":
+                    response += f",{codec}"
+                if not self.complete_request(requesting_code, request_id, code):
+                    log.debug("Ignoring approval from %s for expired or unknown request %s#%s",
+                              code, requesting_code, request_id)
+                    return
+                if self.forward(requesting_code, "RESPONSE", response):
+                    log.debug("Forwarded approval response %s from %s to %s", decision, code, requesting_code)
+                    if decision == "yes":
+                        self.open_session(requesting_code, code)
+                else:
+                    log.warning("Client %s not found for approval", requesting_code)
+            except ValueError:
+                log.warning("Invalid approval format from %s: %s", addr, payload)
+
+    def admit(self, addr):
+        """Accept-path check for a new connection, made before anything is allocated for it.
+
+        Returns False if the source IP is over its connection rate; the
+        caller then just closes the socket.
+        """
+        if self.ip_limiter is not None and not self.ip_limiter.take(addr[0]):
+            self.shed_connections_total.inc()
+            log.debug("Shedding connection from %s", addr)
+            return False
+        return True
+
+    def client_version(self, code):
+        """Protocol version of the client connected here as `code`, or 0 if it is not."""
+        route = self.clients.lookup(code)
+        return route.conn.version if route is not None else 0
+
+    def approve_payload(self, requesting_code, request_id, offer, target_code):
+        """APPROVE for `target_code`, with the requester's codec offer if the target can negotiate."""
+        payload = with_request_id(requesting_code, request_id)
+        if offer and request_id and self.client_version(target_code) >= CODEC_VERSION:
+            payload += f",{offer}"
+        return payload
+
+    def track_request(self, requesting_code, request_id, target_code):
+        """Start the timeout of a forwarded request. Requests without an id are not tracked."""
+        if not request_id:
+            return
+        key = (requesting_code, request_id)
+        with self.pending_lock:
+            previous = self.pending_requests.get(key)
+            if previous is not None:
+                self.timers.cancel(previous[1])
+            self.pending_requests[key] = (target_code, self.timers.schedule(
+                self.request_timeout, self.expire_request, requesting_code, request_id))
+
+    def complete_request(self, requesting_code, request_id, target_code=None):
+        """Settle a pending request. Returns False if it already timed out.
+
+        With `target_code`, only a request that was sent to that code is
+        settled, so an answer to an older request with the same id cannot
+        settle a newer one.
+        """
+        if not request_id:
+            return True
+        key = (requesting_code, request_id)
+        with self.pending_lock:
+            pending = self.pending_requests.get(key)
+            if pending is None or (target_code is not None and pending[0] != target_code):
+                return False
+            del self.pending_requests[key]
+        self.timers.cancel(pending[1])
+        return True
+
+    def drop_requests(self, requesting_code):
+        """Forget every request `requesting_code` has pending or held; its client is gone."""
+        with self.pending_lock:
+            keys = [key for key in self.pending_requests if key[0] == requesting_code]
+            timers = [self.pending_requests.pop(key)[1] for key in keys]
+            for target_code, held in list(self.held_requests.items()):
+                held = [entry for entry in held if entry[0] != requesting_code]
+                if held:
+                    self.held_requests[target_code] = held
+                else:
+                    del self.held_requests[target_code]
+        for timer in timers:
+            self.timers.cancel(timer)
+
+    def expire_request(self, requesting_code, request_id):
+        """Timer callback: tell the requester that nobody answered."""
+        with self.pending_lock:
+            if self.pending_requests.pop((requesting_code, request_id), None) is None:
+                return  # Answered in the meantime
+        self.forward(requesting_code, "ERROR", with_request_id("Request timed out.", request_id))
+
+    def hold_request(self, requesting_code, request_id, target_code, offer=""):
+        """Keep a request for a known client that has not reconnected yet.
+
+        Only right after startup: clients come back from a restart over
+        several seconds, and a requester that resumed first re-sends its
+        pending requests. The request keeps its usual timeout. Returns
+        False if the request cannot be held.
+        """
+        if not request_id or time.monotonic() - self.started_at > self.resume_window:
+            return False
+        if self.allocator.owner(target_code) is None:
+            return False
+        self.track_request(requesting_code, request_id, target_code)
+        with self.pending_lock:
+            self.held_requests.setdefault(target_code, []).append((requesting_code, request_id, offer))
+        return True
+
+    def release_held_requests(self, code):
+        """Forward the requests held for `code` now that it is connected."""
+        with self.pending_lock:
+            held = self.held_requests.pop(code, None)
+            if held is None:
+                return
+            held = [entry for entry in held if entry[:2] in self.pending_requests]
+        for requesting_code, request_id, offer in held:
+            self.forward(code, "APPROVE", self.approve_payload(requesting_code, request_id, offer, code))
+            log.debug("Forwarded held connection request from %s to %s", requesting_code, code)
+
+    def resume_token(self, code):
+        """Token a client presents after reconnecting to get `code` back.
+
+        "<code>.<expiry>.<nonce>.<mac>": a random nonce makes every token
+        different, so the one sent after each HELLO (including a resume)
+        replaces the last, and a leaked token stops working once it
+        expires. The expiry is wall-clock time, as tokens survive restarts,
+        and never later than code_ttl. The mac also covers the code's
+        current owner (see code_owner), so once the code is reclaimed and
+        given to someone else the token no longer matches.
+        """
+        ttl = min(self.resume_token_ttl, self.code_ttl) if self.code_ttl else self.resume_token_ttl
+        body = f"{code}.{int(time.time() + ttl)}.{secrets.token_hex(8)}"
+        return f"{body}.{self.resume_mac(body, self.code_owner(code))}"
+
+    def resume_mac(self, body, owner):
+        return hmac.new(self.resume_secret, f"{body}.{owner}".encode(), "sha256").hexdigest()[:32]
+
+    def code_owner(self, code):
+        """The IP the allocator holds `code` for, or None if it is not allocated."""
+        return self.allocator.owner(code)
+
+    def resumed_code(self, token):
+        """The code a resume token was issued for, or None if it is forged, malformed, expired
+        or the code has changed hands since."""
+        body, _, mac = token.rpartition(".")
+        code, _, expires = body.rpartition(".")[0].rpartition(".")
+        if not code or not expires.isdigit() or int(expires) <= time.time():
+            return None
+        owner = self.code_owner(code)
+        if owner is None or not hmac.compare_digest(mac, self.resume_mac(body, owner)):
+            return None
+        return code
+
+    def resume_client(self, code, conn, addr, token):
+        """Move a reconnected client from `code` to the code its token was issued for.
+
+        Needed when the client comes back from another address; from the
+        same address it already got its old code. A stale connection still
+        holding the code (the peer vanished without a FIN) is dropped.
+        Pending requests are keyed by code, so they carry over. Returns the
+        code the connection now holds.
+        """
+        resumed = self.resumed_code(token)
+        if resumed is None or resumed == code:
+            return code
+        if resumed in self.clients:
+            self.remove_client(resumed, keep_requests=True)  # They carry over to this connection
+        # Register the new code before dropping the old one, so the client is never unroutable
+        self.close_replaced(self.clients.register(resumed, conn, addr), conn)
+        conn.code = resumed
+        self.clients.evict(code, conn)
+        conn.send_message("CODE", resumed)
+        log.info("Client %s resumed code %s", addr, resumed)
+        self.release_held_requests(resumed)
+        return resumed
+
+    def evict_client(self, conn, idle):
+        """Liveness callback: drop a connection that stopped heartbeating.
+
+        Only while it still holds its code; a client that has reconnected
+        in the meantime keeps the new connection.
+        """
+        log.warning("Evicting client %s: silent for %.1fs", conn.code, idle)
+        self.remove_client(conn.code, conn)
+
+    def open_session(self, requesting_code, approving_code):
+        """Create a relay session for an approved pair and send both peers its details.
+
+        Each peer gets "SESSION:<token>,<relay port>,<peer code>" and
+        connects to the relay with the token. When both peers speak
+        DIRECT_VERSION, each also gets the address the server sees for the
+        other and its role, "...,<peer ip:port>,active|passive", and first
+        tries to connect to the peer directly (see P_Direct); the relay
+        session stays open as the fallback.
+        """
+        if self.relay is None:
+            return None
+        routes = [self.clients.lookup(code) for code in (requesting_code, approving_code)]
+        if any(route is not None and route.conn.version < SESSION_VERSION for route in routes):
+            log.info("No session between %s and %s: a legacy client cannot join one", requesting_code, approving_code)
+            return None
+        token = self.relay.create_session(requesting_code, approving_code)
+        to_requester = f"{token},{self.relay.port},{approving_code}"
+        to_approver = f"{token},{self.relay.port},{requesting_code}"
+        endpoints = self.direct_endpoints(requesting_code, approving_code)
+        if endpoints is not None:
+            to_requester += f",{endpoints[1]},active"
+            to_approver += f",{endpoints[0]},passive"
+        self.forward(requesting_code, "SESSION", to_requester)
+        self.forward(approving_code, "SESSION", to_approver)
+        log.info("Opened session between %s and %s", requesting_code, approving_code)
+        return token
+
+    def direct_endpoints(self, *codes):
+        """The "ip:port" the server sees for each code, or None unless all can connect directly."""
+        routes = [self.clients.lookup(code) for code in codes]
+        if any(route is None or route.conn.version < DIRECT_VERSION for route in routes):
+            return None
+        return [format_endpoint(route.addr) for route in routes]
+
+    def record_session_path(self, code, token, path):
+        """Take one peer's report of whether its session went direct or through the relay.
+
+        A session's path is recorded once both peers have reported: direct
+        only if both say so, since one side may have given up on the direct
+        connection and be waiting at the relay. Only then is a direct
+        session's relay slot dropped; a peer that never reports leaves it
+        to the relay's own timeout. Returns False if the report was ignored.
+        """
+        if path not in SESSION_PATHS:
+            return False
+        with self.stats_lock:
+            pending = self.session_reports.get(token)
+        # The relay session may already be over when the second report comes in
+        codes = pending[0] if pending is not None else (
+            self.relay.session_codes(token) if self.relay is not None else None)
+        if codes is None or code not in codes:
+            return False
+        with self.stats_lock:
+            if token in self.session_paths:
+                return False
+            _, reports = self.session_reports.setdefault(token, (codes, {}))
+            if code in reports:
+                return False
+            reports[code] = path
+            if len(reports) < len(codes):
+                if len(self.session_reports) > MAX_SESSION_RECORDS:
+                    self.session_reports.popitem(last=False)
+                return True
+            del self.session_reports[token]
+            path = "direct" if all(report == "direct" for report in reports.values()) else "relay"
+            self.session_paths[token] = (codes, path)
+            if len(self.session_paths) > MAX_SESSION_RECORDS:
+                self.session_paths.popitem(last=False)
+        self.sessions_total[path].inc()
+        if path == "direct":
+            self.relay.discard_session(token)
+        log.info("Session between %s and %s connected via %s", codes[0], codes[1], path)
+        return True
+
+    def is_routable(self, code):
+        """Return True if messages can be forwarded to the client holding `code`."""
+        return code in self.clients
+
+    def forward(self, target_code, command, payload):
+        """Queue a message for another client without waiting on its socket.
+
+        Returns False if the client is gone or its send queue is full.
+        """
+        route = self.clients.lookup(target_code)
+        if route is None:
+            self.forward_failures_total.inc()
+            return False
+        if command == "SESSION" and route.conn.version < SESSION_VERSION:
+            return False  # From another worker, for a legacy client that cannot parse it
+        try:
+            queued = route.conn.send_message(command, payload)
+        except Exception as e:
+            log.warning("Error forwarding %s to %s: %s", command, target_code, e)
+            queued = False
+        (self.forwards_total if queued else self.forward_failures_total).inc()
+        return queued
+
+    def record_overflow(self, conn, disconnected):
+        """Count a message refused by a full send queue."""
+        with self.stats_lock:
+            self.dropped_messages += 1
+            if disconnected:
+                self.slow_disconnects += 1
+
+    def queue_stats(self):
+        """Return outbound queue depths and slow-consumer counters."""
+        depths = [route.conn.queue_depth() for route in self.clients.routes()]
+        return {
+            "clients": len(depths),
+            "queued_bytes": sum(depths),
+            "max_queued_bytes": max(depths, default=0),
+            "dropped_messages": self.dropped_messages,
+            "slow_disconnects": self.slow_disconnects,
+            "pending_requests": len(self.pending_requests),
+            "evicted_clients": self.liveness.evicted,
+            "direct_sessions": self.sessions_total["direct"].value,
+            "relayed_sessions": self.sessions_total["relay"].value,
+            "shed_connections": self.shed_connections_total.value,
+            "shed_requests": self.shed_requests_total.value,
+        }
+
+    def remove_client(self, code, owner=None, keep_requests=False):
+        """Remove a client from the routing table and close the connection.
+
+        If `owner` is given, the entry is only removed while it still belongs
+        to that connection, so a reconnect from the same IP is not dropped
+        when the old connection finally goes away. The client's pending
+        requests are dropped unless `keep_requests` (a resume moving the
+        code to another connection); a client that comes back re-sends
+        its own. Returns True if this call removed the client.
+        """
+        # The handler thread, stop() and an eviction may all get here; only one removes it
+        route = self.clients.evict(code, owner)
+        if route is None:
+            return False
+        if not keep_requests:
+            self.drop_requests(code)
+        try:
+            route.conn.close()
+        except:
+            pass
+        if self.capture is not None:
+            self.capture.connection_closed(route.conn)
+        self.liveness.forget(route.conn)
+        self.disconnects_total.inc()
+        log.info("Client %s disconnected", route.addr)
+        return True
+
+    def close_replaced(self, route, conn):
+        """Close the connection `route` held before its code was registered to `conn`.
+
+        A reconnect from the same IP takes over the code while the old
+        connection may still be open; closed, its handler stops acting as
+        that code, and its remove_client no longer owns the entry.
+        """
+        if route is None or route.conn is conn:
+            return
+        self.liveness.forget(route.conn)
+        try:
+            route.conn.close()
+        except:
+            pass
+        if self.capture is not None:
+            self.capture.connection_closed(route.conn)
+        self.disconnects_total.inc()
+        log.info("Client %s replaced by a new connection for %s", route.addr, route.code)
 
     def start(self):
         """Start the server and accept incoming connections."""
-        print("Server is running and waiting for connections...")
+        if self.relay is not None:
+            self.relay.start()
+        if self.metrics_server is not None:
+            self.metrics_server.start()
+
+        if self.engine == "asyncio":
+            from P_AsyncServer import AsyncEngine
+
+            self.async_engine = AsyncEngine(self)
+            self.async_engine.run()
+            return
+
+        threading.Thread(target=self.timers.run, args=(lambda: self.running,), daemon=True).start()
+        log.info("Server is running and waiting for connections...")
         while self.running:
+            if time.monotonic() >= self.next_reclaim:
+                self.reclaim_codes()
+            if self.accept_limiter is not None and not self.accept_limiter.take():
+                time.sleep(min(self.accept_limiter.delay(), 1))
+                continue
             try:
                 conn, addr = self.server_socket.accept()
+                if not self.admit(addr):
+                    conn.close()
+                    continue
                 client_thread = threading.Thread(target=self.handle_client, args=(conn, addr))
                 client_thread.daemon = True
                 client_thread.start()
             except socket.timeout:
                 continue
             except Exception as e:
-                print(f"Error accepting connection: {e}")
+                log.warning("Error accepting connection: %s", e)
                 if not self.running:
                     break
                 time.sleep(1)  # Wait before trying again
@@ -148,9 +775,23 @@ class P_Server:
     def stop(self):
         """Stop the server and close all connections."""
         self.running = False
+        if self.relay is not None:
+            self.relay.stop()
+        if self.metrics_server is not None:
+            self.metrics_server.stop()
+
+        # The asyncio engine owns the sockets while it runs and closes them
+        # from its own loop
+        if self.async_engine is not None:
+            self.async_engine.stop()
+            self.codes.close()
+            if self.capture is not None:
+                self.capture.close()
+            log.info("Server stopped")
+            return
 
         # Close all client connections
-        for code in list(self.clients.keys()):
+        for code in self.clients.codes():
             self.remove_client(code)
 
         # Close server socket
@@ -159,13 +800,21 @@ class P_Server:
         except:
             pass
 
-        print("Server stopped")
+        self.codes.close()
+        if self.capture is not None:
+            self.capture.close()
+        log.info("Server stopped")
 
 
 if __name__ == "__main__":
-    server = P_Server("0.0.0.0", 12345)  # Listen for external connections
+    import sys
+
+    engine = sys.argv[1] if len(sys.argv) > 1 else "thread"
+    capture_path = sys.argv[2] if len(sys.argv) > 2 else None  # e.g. "server.capture" to record traffic
+    setup_logging()
+    server = P_Server("0.0.0.0", 12345, engine=engine, capture_path=capture_path)  # Listen for external connections
     try:
         server.start()
     except KeyboardInterrupt:
-        print("Server stopping...")
+        log.info("Server stopping...")
         server.stop()
\ No newline at end of file
@@ -0,0 +1,202 @@
+import logging
+import struct
+import threading
+import time
+
+from P_Adaptive import AdaptiveController
+from P_Codec import NONE
+from P_Protocol import FrameDecoder, ProtocolError, encode_frame
+
+log = logging.getLogger(__name__)
+
+
+MAX_SESSION_FRAME = 32 * 1024 * 1024  # A full uncompressed 4K frame fits
+SESSION_BUFFER_SIZE = 256 * 1024
+FRAME_RATE = 10
+# FRAME payloads start with the sequence number and the sender's
+# monotonic send time; ACK echoes both back
+FRAME_PREFIX = struct.Struct("!IQ")
+ACK = FRAME_PREFIX
+
+
+class SessionChannel:
+    """Binary frames over a session socket (through the relay or direct).
+
+    Uses the control channel's framing with binary payloads; sends from
+    several threads are serialized. With a `codec` (see P_Codec), each
+    direction's payloads form one compression stream, so both peers must
+    use the codec negotiated for the session; its level may change while
+    the session runs (see `set_level`).
+    """
+
+    def __init__(self, sock, codec=None):
+        self.sock = sock
+        self.codec = codec or NONE
+        self.compressor = self.codec.compressor()
+        self.decompressor = self.codec.decompressor()
+        self.decoder = FrameDecoder(max_frame=MAX_SESSION_FRAME, text=False)
+        self.recv_view = memoryview(bytearray(SESSION_BUFFER_SIZE))
+        self.send_lock = threading.Lock()
+        self.closed = False
+
+    def send(self, command, payload=b""):
+        """Send one message. Returns the bytes written, after compression."""
+        with self.send_lock:
+            # Under the lock: the stream must be compressed in the order it is sent
+            data = encode_frame(command, self.compressor.compress(payload))
+            self.sock.sendall(data)
+        return len(data)
+
+    def set_level(self, level):
+        """Compress from the next message on at `level`."""
+        with self.send_lock:
+            self.compressor.set_level(level)
+
+    def recv(self):
+        """Block for the next read. Returns a list of (command, bytes), or None on EOF."""
+        n = self.sock.recv_into(self.recv_view)
+        if not n:
+            return None
+        messages = self.decoder.feed(self.recv_view[:n])
+        if self.codec is NONE:
+            return messages
+        try:
+            return [(command, self.decompressor.decompress(payload, MAX_SESSION_FRAME)) for command, payload in messages]
+        except ValueError as e:
+            raise ProtocolError(f"Could not decompress session data: {e}")
+
+    def close(self):
+        self.closed = True
+        try:
+            self.sock.close()
+        except OSError:
+            pass
+
+
+class ScreenSender:
+    """Controlled side of a session: capture, encode and send frames.
+
+    `source()` returns the current screen as a (height, width, 3) array.
+    An AdaptiveController sets the frame rate and compression level from
+    the viewer's acknowledgements and skips captures while the link is
+    backed up. When the channel compresses, tiles are stored uncompressed
+    and left to the channel's stream, which also sees across tiles and
+    frames, and the controller sets the stream's level instead. Frames with no changed tiles are not sent, except one per
+    second so the viewer knows the session is alive. INPUT batches from
+    the viewer are passed to `on_input(payload)`, e.g. InputReplayer.apply.
+    """
+
+    def __init__(self, channel, source, fps=FRAME_RATE, tile_size=None, controller=None, on_input=None):
+        from P_Screen import TILE_SIZE, TileEncoder
+
+        self.channel = channel
+        self.source = source
+        if controller is None:
+            # Start from the negotiated codec's level, e.g. 6 for "zlib-6"
+            controller = AdaptiveController(fps=fps, level=max(1, channel.compressor.level))
+        self.controller = controller
+        self.on_input = on_input
+        self.encoder = TileEncoder(tile_size or TILE_SIZE, self.controller.level)
+        self.running = False
+        self.seq = 0
+        self.frames_sent = 0
+        self.bytes_sent = 0
+        self.encode_seconds = 0.0
+
+    def run(self):
+        """Send frames until `stop` is called or the peer goes away."""
+        self.running = True
+        threading.Thread(target=self.receive, daemon=True).start()
+        controller = self.controller
+        last_sent = 0.0
+        try:
+            while self.running:
+                started = time.monotonic()
+                if controller.should_send():
+                    frame = self.source()
+                    if self.channel.codec is NONE:
+                        self.encoder.level = controller.level
+                    else:
+                        self.encoder.level = 0
+                        self.channel.set_level(controller.level)
+                    data = self.encoder.encode(frame)
+                    encoded = time.monotonic()
+                    self.encode_seconds += encoded - started
+                    controller.on_encode(encoded - started)
+                    if self.encoder.last_tiles or started - last_sent >= 1.0:
+                        self.seq += 1
+                        sent_ns = time.monotonic_ns()
+                        size = self.channel.send("FRAME", FRAME_PREFIX.pack(self.seq, sent_ns) + data)
+                        controller.on_send(self.seq, size, sent_ns)
+                        self.bytes_sent += size
+                        self.frames_sent += 1
+                        last_sent = started
+                controller.adjust()
+                delay = controller.frame_interval() - (time.monotonic() - started)
+                if delay > 0:
+                    time.sleep(delay)
+        except OSError as e:
+            if self.running:
+                log.info("Screen session ended: %s", e)
+        finally:
+            self.running = False
+            self.channel.close()
+
+    def receive(self):
+        """Read the viewer's messages: acknowledgements feed the controller, input is replayed."""
+        try:
+            while self.running:
+                messages = self.channel.recv()
+                if messages is None:
+                    break
+                for command, payload in messages:
+                    if command == "ACK":
+                        seq, _ = ACK.unpack_from(payload)
+                        self.controller.on_ack(seq)
+                    elif command == "INPUT" and self.on_input is not None:
+                        self.on_input(payload)
+        except (OSError, ProtocolError):
+            pass
+        self.running = False
+
+    def metrics(self):
+        return self.controller.metrics()
+
+    def stop(self):
+        self.running = False
+
+
+class ScreenReceiver:
+    """Viewer side of a session: decode frames and hand them to `on_frame`.
+
+    `on_frame(image, rects)` is called from the receiving thread with the
+    decoded screen and the rectangles that changed. Every frame is
+    acknowledged once decoded, which drives the sender's controller.
+    """
+
+    def __init__(self, channel, on_frame):
+        from P_Screen import TileDecoder
+
+        self.channel = channel
+        self.on_frame = on_frame
+        self.decoder = TileDecoder()
+        self.frames_received = 0
+
+    def run(self):
+        try:
+            while True:
+                messages = self.channel.recv()
+                if messages is None:
+                    break
+                for command, payload in messages:
+                    if command == "FRAME":
+                        image, rects = self.decoder.decode(memoryview(payload)[FRAME_PREFIX.size:])
+                        self.channel.send("ACK", payload[:FRAME_PREFIX.size])
+                        self.frames_received += 1
+                        if rects:
+                            self.on_frame(image, rects)
+        except (OSError, ProtocolError, ValueError) as e:
+            if not self.channel.closed:
+                log.info("Screen session ended: %s", e)
+        finally:
+            self.channel.close()
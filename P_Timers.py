@@ -0,0 +1,153 @@
+import logging
+import threading
+import time
+
+log = logging.getLogger(__name__)
+
+
+TICK = 0.1  # Seconds per wheel slot
+SLOTS = 512  # One turn of the wheel covers SLOTS * TICK seconds
+
+
+class Timer:
+    __slots__ = ("due_tick", "callback", "args", "slot")
+
+    def __init__(self, due_tick, callback, args):
+        self.due_tick = due_tick
+        self.callback = callback
+        self.args = args
+        self.slot = None
+
+
+class TimerWheel:
+    """Hashed timing wheel for many short timeouts.
+
+    Scheduling and cancelling are O(1): a timer goes into the slot of the
+    tick it is due on and is removed from that slot when cancelled.
+    `advance()` visits only the slots between the last tick and now, so
+    expiring entries costs nothing while there are none due, unlike
+    scanning a table. Timers further away than one turn stay in their slot
+    until the wheel comes round to their tick.
+
+    The wheel does not run callbacks by itself: whoever owns the state the
+    callbacks touch calls `advance()`, either `run()` on a thread or an
+    event loop's `call_later`.
+    """
+
+    def __init__(self, tick=TICK, slots=SLOTS):
+        self.tick = tick
+        self.slots = [set() for _ in range(slots)]
+        self.started = time.monotonic()
+        self.current = 0  # Last tick processed
+        self.lock = threading.Lock()
+        self.count = 0
+
+    def schedule(self, delay, callback, *args):
+        """Call `callback(*args)` after about `delay` seconds. Returns the timer."""
+        due = int((time.monotonic() - self.started + delay) / self.tick) + 1
+        timer = Timer(due, callback, args)
+        with self.lock:
+            timer.due_tick = max(due, self.current + 1)
+            timer.slot = self.slots[timer.due_tick % len(self.slots)]
+            timer.slot.add(timer)
+            self.count += 1
+        return timer
+
+    def cancel(self, timer):
+        """Cancel a timer. Returns False if it already fired or was cancelled."""
+        with self.lock:
+            if timer.slot is None:
+                return False
+            timer.slot.discard(timer)
+            timer.slot = None
+            self.count -= 1
+            return True
+
+    def advance(self, now=None):
+        """Run the callbacks of every timer due by `now`. Returns how many ran."""
+        now = time.monotonic() if now is None else now
+        target = int((now - self.started) / self.tick)
+        due = []
+        with self.lock:
+            while self.current < target:
+                self.current += 1
+                slot = self.slots[self.current % len(self.slots)]
+                if not slot:
+                    continue
+                for timer in [t for t in slot if t.due_tick <= self.current]:
+                    slot.discard(timer)
+                    timer.slot = None
+                    due.append(timer)
+            self.count -= len(due)
+        for timer in due:
+            try:
+                timer.callback(*timer.args)
+            except Exception as e:
+                log.error("Error in timer callback: %s", e)
+        return len(due)
+
+    def run(self, running):
+        """Advance every tick while `running()` is true. Blocks the calling thread."""
+        while running():
+            time.sleep(self.tick)
+            self.advance()
+
+    def __len__(self):
+        return self.count
+
+
+class LivenessTracker:
+    """Evicts peers that have gone quiet for longer than `timeout` seconds.
+
+    Every watched peer has one timer in a shared TimerWheel, armed for when
+    it would expire if nothing more arrived. `seen()` only stores a
+    timestamp, so traffic costs no timer work; when the timer fires the
+    peer is either rescheduled from its last activity or handed to
+    `on_dead(key, idle_seconds)`. A dead peer is therefore noticed between
+    `timeout` and `timeout + tick` seconds after it went silent.
+    """
+
+    def __init__(self, timers, timeout, on_dead):
+        self.timers = timers
+        self.timeout = timeout
+        self.on_dead = on_dead
+        self.last_seen = {}  # {key: monotonic time of last activity}
+        self.deadlines = {}  # {key: Timer}
+        self.lock = threading.Lock()
+        self.evicted = 0
+
+    def watch(self, key):
+        with self.lock:
+            self.last_seen[key] = time.monotonic()
+            previous = self.deadlines.get(key)
+            if previous is not None:
+                self.timers.cancel(previous)
+            self.deadlines[key] = self.timers.schedule(self.timeout, self.check, key)
+
+    def seen(self, key):
+        if key in self.last_seen:
+            self.last_seen[key] = time.monotonic()
+
+    def forget(self, key):
+        with self.lock:
+            self.last_seen.pop(key, None)
+            timer = self.deadlines.pop(key, None)
+        if timer is not None:
+            self.timers.cancel(timer)
+
+    def check(self, key):
+        with self.lock:
+            last = self.last_seen.get(key)
+            if last is None:
+                return
+            idle = time.monotonic() - last
+            if idle < self.timeout:
+                self.deadlines[key] = self.timers.schedule(self.timeout - idle, self.check, key)
+                return
+            del self.last_seen[key]
+            del self.deadlines[key]
+            self.evicted += 1
+        self.on_dead(key, idle)
+
+    def __len__(self):
+        return len(self.last_seen)
@@ -0,0 +1,81 @@
+"""Exercise the adaptive screen-session controller over emulated links.
+
+Run from the repository root:
+
+    python -m benchmarks.bench_adaptive [--seconds N] [--codec zlib-1] [--json results.json]
+
+For each link profile a ScreenSender streams a synthetic 1080p desktop
+through a LinkEmulator to a ScreenReceiver, and the controller's final
+metrics are reported: chosen fps and compression level, RTT, measured
+throughput and skipped frames. With --codec the session channel
+compresses with that codec and the controller sets its level, as in a
+session that negotiated one.
+"""
+import argparse
+import json
+import socket
+import threading
+import time
+
+from P_Adaptive import AdaptiveController
+from P_Codec import get_codec
+from P_LinkEmu import LinkEmulator
+from P_Screen import SyntheticScreen
+from P_Session import ScreenReceiver, ScreenSender, SessionChannel
+
+
+PROFILES = {
+    "lan": {"delay": 0.001, "bandwidth": 100e6 / 8},
+    "broadband": {"delay": 0.02, "bandwidth": 20e6 / 8},
+    "dsl": {"delay": 0.04, "bandwidth": 2e6 / 8},
+    "mobile": {"delay": 0.08, "bandwidth": 0.5e6 / 8},
+}
+
+
+def run_profile(profile, seconds, target_latency, codec=None):
+    listener = socket.socket()
+    listener.bind(("127.0.0.1", 0))
+    listener.listen(1)
+    link = LinkEmulator("127.0.0.1", listener.getsockname()[1], **profile).start()
+
+    sender_sock = socket.create_connection(("127.0.0.1", link.port))
+    viewer_sock, _ = listener.accept()
+    receiver = ScreenReceiver(SessionChannel(viewer_sock, codec), lambda image, rects: None)
+    threading.Thread(target=receiver.run, daemon=True).start()
+
+    channel = SessionChannel(sender_sock, codec)
+    controller = AdaptiveController(target_latency=target_latency, level=max(1, channel.compressor.level))
+    sender = ScreenSender(channel, SyntheticScreen(window_every=10), controller=controller)
+    thread = threading.Thread(target=sender.run, daemon=True)
+    thread.start()
+    time.sleep(seconds)
+    sender.stop()
+    thread.join(5)
+    link.stop()
+    listener.close()
+    return controller.metrics()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--seconds", type=float, default=10)
+    parser.add_argument("--target-latency", type=float, default=0.15)
+    parser.add_argument("--codec", help="Session codec, e.g. zlib-1 (default: none, tiles compressed)")
+    parser.add_argument("--json", help="Also write the results to this file")
+    args = parser.parse_args()
+    codec = get_codec(args.codec)
+
+    results = {}
+    for name, profile in PROFILES.items():
+        m = results[name] = run_profile(profile, args.seconds, args.target_latency, codec)
+        print(f"{name:10} fps {m['fps']:5.1f}  level {m['level']}  rtt {m['rtt_ms']:7.1f} ms "
+              f"(p95 {m['rtt_p95_ms']:7.1f})  {m['throughput_kbps']:9.0f} kbps  skipped {m['frames_skipped']}")
+
+    if args.json:
+        with open(args.json, "w") as file:
+            json.dump({"target_latency": args.target_latency, "codec": codec.name, "results": results}, file,
+                      indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,138 @@
+"""Benchmark the session codecs on synthetic screen and input traffic.
+
+Run from the repository root:
+
+    python -m benchmarks.bench_codec [--frames N] [--batches N] [--json results.json]
+
+Streams each kind of traffic through one channel's compressor and
+decompressor per available codec (lz4 and zstd only when installed) and
+reports the bytes saved against the CPU time spent. Screen frames are
+tile-encoded uncompressed, as ScreenSender does when the channel
+compresses; the "tiles" row is the per-tile zlib the encoder uses on an
+uncompressed channel, for comparison. Finally prints the codec the
+handshake probe would pick on a few link speeds.
+"""
+import argparse
+import json
+import random
+import time
+
+from P_Codec import CodecProbe, available_codecs
+from P_Input import EVENT, KEY_DOWN, KEY_UP, MOVE, pack_point
+from P_Screen import SyntheticScreen, TileEncoder
+from P_Session import MAX_SESSION_FRAME
+
+
+WIDTH, HEIGHT = 1920, 1080
+SCREENS = {
+    "cursor": lambda: SyntheticScreen(WIDTH, HEIGHT),
+    "window": lambda: SyntheticScreen(WIDTH, HEIGHT, window_every=5),
+}
+LINK_SPEEDS = (10, 100, 1000)  # Mbit/s
+
+
+def screen_messages(make_source, frames, level):
+    """FRAME payloads for `frames` frames after the first, full one."""
+    source = make_source()
+    encoder = TileEncoder(level=level)
+    messages = [encoder.encode(source())]
+    for _ in range(frames):
+        data = encoder.encode(source())
+        if data:
+            messages.append(data)
+    return messages
+
+
+def input_messages(batches):
+    """INPUT payloads as a viewer sends them: mostly pointer moves, some typing."""
+    rng = random.Random(0)
+    x, y = WIDTH // 2, HEIGHT // 2
+    messages = []
+    for _ in range(batches):
+        events = []
+        for ms in range(0, 16, 4):
+            x = max(0, min(WIDTH - 1, x + rng.randint(-20, 20)))
+            y = max(0, min(HEIGHT - 1, y + rng.randint(-20, 20)))
+            events.append((MOVE, 0, ms, pack_point(x, y)))
+        if rng.random() < 0.3:
+            keysym = rng.randint(0x61, 0x7A)  # a-z
+            events.append((KEY_DOWN, 0, 16, keysym))
+            events.append((KEY_UP, 0, 17, keysym))
+        messages.append(b"".join(EVENT.pack(*event) for event in events))
+    return messages
+
+
+def run_codec(codec, messages):
+    compressor = codec.compressor()
+    decompressor = codec.decompressor()
+    raw_bytes = wire_bytes = 0
+    compress_seconds = decompress_seconds = 0.0
+    for payload in messages:
+        started = time.perf_counter()
+        data = compressor.compress(payload)
+        compress_seconds += time.perf_counter() - started
+        started = time.perf_counter()
+        decompressor.decompress(data, MAX_SESSION_FRAME)
+        decompress_seconds += time.perf_counter() - started
+        raw_bytes += len(payload)
+        wire_bytes += len(data)
+    return {
+        "raw_bytes": raw_bytes,
+        "wire_bytes": wire_bytes,
+        "saved_percent": 100 * (1 - wire_bytes / raw_bytes),
+        "compress_us_per_message": compress_seconds * 1e6 / len(messages),
+        "decompress_us_per_message": decompress_seconds * 1e6 / len(messages),
+        "cpu_ms_per_mb": (compress_seconds + decompress_seconds) * 1000 * 1e6 / raw_bytes,
+    }
+
+
+def report(name, results):
+    print(name)
+    for codec, r in results.items():
+        line = f"  {codec:8} {r['wire_bytes']:>12} B  saved {r['saved_percent']:6.1f}%"
+        if "cpu_ms_per_mb" not in r:
+            print(line + "  (tile encoder's own zlib)")
+            continue
+        print(f"{line}  compress {r['compress_us_per_message']:9.1f} us/msg  "
+              f"decompress {r['decompress_us_per_message']:9.1f} us/msg  {r['cpu_ms_per_mb']:7.2f} ms/MB")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--frames", type=int, default=50)
+    parser.add_argument("--batches", type=int, default=2000)
+    parser.add_argument("--json", help="Also write the results to this file")
+    args = parser.parse_args()
+
+    codecs = available_codecs()
+    results = {}
+    for name, make_source in SCREENS.items():
+        messages = screen_messages(make_source, args.frames, 0)
+        results[f"screen_{name}"] = {codec.name: run_codec(codec, messages) for codec in codecs}
+        tiled = screen_messages(make_source, args.frames, 1)
+        raw = sum(len(m) for m in messages)
+        wire = sum(len(m) for m in tiled)
+        results[f"screen_{name}"]["tiles"] = {
+            "raw_bytes": raw, "wire_bytes": wire, "saved_percent": 100 * (1 - wire / raw),
+        }
+        report(f"screen_{name}", results[f"screen_{name}"])
+
+    messages = input_messages(args.batches)
+    results["input"] = {codec.name: run_codec(codec, messages) for codec in codecs}
+    report("input", results["input"])
+
+    probe = CodecProbe.get()
+    offer = probe.offer()
+    chosen = {str(mbps): probe.choose(offer, mbps) for mbps in LINK_SPEEDS}
+    print("probe offer:", offer)
+    for mbps, name in chosen.items():
+        print(f"  chosen on a {mbps} Mbit/s link: {name}")
+
+    if args.json:
+        with open(args.json, "w") as file:
+            json.dump({"resolution": [WIDTH, HEIGHT], "offer": offer, "chosen": chosen,
+                       "results": results}, file, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,359 @@
+"""Replay a captured control-traffic workload against a local server.
+
+Run from the repository root:
+
+    python -m benchmarks.bench_replay CAPTURE [--speed 1] [--engine asyncio] [--json results.json]
+
+Captures come from a server started with `capture_path` (for example
+`python P_Server.py thread server.capture`, or bench_server --capture).
+The server under test runs in a child process, as in bench_server. Every
+captured connection is opened again and sends its captured messages at
+the captured times, divided by --speed. A message that answered one the
+server sent (an APPROVAL its APPROVE, a PATH its SESSION) also waits for
+that message, and a REQUEST waits until its target has a code, so a
+slower server delays the replay instead of seeing messages out of order.
+Each client IP of the capture connects from its own 127.x.y.z address
+(Linux), so the server hands out codes per IP as it did when recording;
+codes and (redacted) session tokens in the replayed messages are mapped
+to the ones the new server hands out, and resume tokens are left out.
+
+Reports how much later than in the capture each reply arrived
+(p50/p99/max), server CPU time per replayed message, and any change in
+behavior: replies in the capture that the replay did not get even after
+--grace seconds, and replies the replay got that the capture does not
+have, by command.
+"""
+import argparse
+import asyncio
+import bisect
+import json
+import multiprocessing
+import os
+import tempfile
+from collections import Counter, defaultdict
+
+from benchmarks.bench_server import percentile, run_server
+from P_AsyncServer import raise_fd_limit
+from P_Capture import CLOSE, OPEN, OUTBOUND, read_capture
+from P_Protocol import FrameDecoder, encode_frame
+
+
+GRACE = 5.0  # Seconds to wait for outstanding replies after the last replayed message
+DEPENDENCY_TIMEOUT = 5.0  # Seconds a message waits for what triggered it before it is sent anyway
+# Inbound commands that answer an outbound one
+TRIGGERS = {"APPROVAL": "APPROVE", "PATH": "SESSION"}
+
+
+def load(path):
+    """Split a capture into what to send and what to expect back.
+
+    Returns (script, expected). `script` is the OPEN, INBOUND and CLOSE
+    records as (seconds, connection id, kind, command, payload), with
+    seconds counted from the first record; `expected` maps a connection id
+    to its outbound (seconds, command, payload) records.
+    """
+    script = []
+    expected = defaultdict(list)
+    first = None
+    for elapsed, conn_id, kind, command, payload in read_capture(path):
+        if first is None:
+            first = elapsed
+        seconds = (elapsed - first) / 1e9
+        if kind == OUTBOUND:
+            expected[conn_id].append((seconds, command, payload))
+        else:
+            script.append((seconds, conn_id, kind, command, payload))
+    return script, expected
+
+
+def loopback_address(index):
+    index += 1
+    return f"127.{100 + index // 65025}.{(index // 255) % 255}.{index % 255 + 1}"
+
+
+class ReplayClient(asyncio.Protocol):
+    """One replayed connection: records what the server sends it."""
+
+    def __init__(self, replay, conn_id):
+        self.replay = replay
+        self.conn_id = conn_id
+        self.transport = None
+        self.decoder = FrameDecoder()
+        self.received = []  # [(seconds, command, payload)]
+        self.counts = Counter()
+        self.arrived = asyncio.Event()  # Set whenever something is received
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def data_received(self, data):
+        now = self.replay.elapsed()
+        for command, payload in self.decoder.feed(data):
+            self.replay.learn(self, command, payload)
+            self.counts[command] += 1
+            self.received.append((now, command, payload))
+        self.arrived.set()
+
+
+class Replay:
+    def __init__(self, script, expected, port, speed, grace=GRACE):
+        self.script = script
+        self.expected = expected
+        self.port = port
+        self.speed = speed
+        self.grace = grace
+        self.loop = None
+        self.started = 0.0
+        self.clients = {}  # {connection id: ReplayClient}
+        self.sources = {}  # {captured IP: loopback address it is replayed from}
+        self.codes = {}  # {captured code: code the replay server handed out}
+        self.tokens = {}  # {captured session token: replayed one}
+        self.sent = 0
+        self.skipped = 0
+        self.failed_connects = 0
+        self.unmet = 0  # Messages sent after DEPENDENCY_TIMEOUT without what they depend on
+        self.learned = None  # asyncio.Event set whenever a code is mapped
+        # {connection id: {command: [payload]}}, to match replies to captured ones by position
+        self.captured = defaultdict(lambda: defaultdict(list))
+        for conn_id, records in expected.items():
+            for _, command, payload in records:
+                self.captured[conn_id][command].append(payload)
+
+    def elapsed(self):
+        return self.loop.time() - self.started
+
+    def source(self, ip):
+        if ip not in self.sources:
+            self.sources[ip] = loopback_address(len(self.sources))
+        return self.sources[ip]
+
+    def learn(self, client, command, payload):
+        """Map the codes and tokens the server hands out to the captured ones."""
+        if command not in ("CODE", "SESSION"):
+            return
+        captured = self.captured[client.conn_id][command]
+        index = client.counts[command]
+        if index >= len(captured):
+            return
+        if command == "CODE":
+            self.codes[captured[index]] = payload
+            self.learned.set()
+        else:
+            self.tokens[captured[index].partition(",")[0]] = payload.partition(",")[0]
+
+    def rewrite(self, command, payload):
+        """A captured inbound payload, as this replay's client would send it."""
+        if command == "HELLO":
+            return payload.partition(",")[0]  # The resume token was signed by the recording server
+        if command in ("REQUEST", "APPROVAL"):
+            code, sep, rest = payload.partition(",")
+            return self.codes.get(code, code) + sep + rest
+        if command == "PATH":
+            token, sep, rest = payload.partition(",")
+            return self.tokens.get(token, token) + sep + rest
+        return payload
+
+    def triggered_by(self, conn_id, seconds, command):
+        """How many of its trigger's messages the connection had received when it sent `command`."""
+        trigger = TRIGGERS.get(command)
+        if trigger is None:
+            return None, 0
+        times = [at for at, sent, _ in self.expected.get(conn_id, ()) if sent == trigger]
+        return trigger, bisect.bisect_right(times, seconds)
+
+    async def wait_for(self, ready, event, deadline):
+        """Wait until `ready()` or the deadline; returns ready()."""
+        while not ready():
+            remaining = deadline - self.loop.time()
+            if remaining <= 0:
+                return False
+            event.clear()
+            try:
+                await asyncio.wait_for(event.wait(), remaining)
+            except asyncio.TimeoutError:
+                pass
+        return True
+
+    async def depends(self, client, conn_id, seconds, command, payload):
+        """Wait for what a captured inbound message was a reaction to."""
+        deadline = self.loop.time() + DEPENDENCY_TIMEOUT
+        trigger, count = self.triggered_by(conn_id, seconds, command)
+        if trigger is not None:
+            met = await self.wait_for(lambda: client.counts[trigger] >= count, client.arrived, deadline)
+        elif command == "REQUEST":
+            target = payload.partition(",")[0]
+            met = target not in self.all_codes or await self.wait_for(
+                lambda: target in self.codes, self.learned, deadline)
+        else:
+            met = True
+        self.unmet += not met
+
+    def complete(self, client):
+        """True once a connection has had as many replies of each command as in the capture."""
+        return client.transport.is_closing() or all(
+            client.counts[command] >= len(payloads) for command, payloads in self.captured[client.conn_id].items())
+
+    async def run(self):
+        """Play every connection's part of the script at once; returns the seconds it took."""
+        self.loop = asyncio.get_running_loop()
+        self.started = self.loop.time()
+        self.learned = asyncio.Event()
+        self.all_codes = {payload for commands in self.captured.values() for payload in commands.get("CODE", ())}
+        parts = defaultdict(list)
+        for seconds, conn_id, kind, command, payload in self.script:
+            parts[conn_id].append((seconds, kind, command, payload))
+        await asyncio.gather(*(self.play(conn_id, records) for conn_id, records in parts.items()))
+        replay_seconds = self.elapsed()
+        # Late replies count as lag; only those that never come are missing
+        arrived = asyncio.Event()
+        for client in self.clients.values():
+            client.arrived = arrived
+        await self.wait_for(lambda: all(self.complete(client) for client in self.clients.values()),
+                            arrived, self.loop.time() + self.grace)
+        for client in self.clients.values():
+            client.transport.close()
+        return replay_seconds
+
+    async def play(self, conn_id, records):
+        """Replay one connection. Connections run independently, like the clients they stand for."""
+        client = None
+        for seconds, kind, command, payload in records:
+            delay = seconds / self.speed - self.elapsed()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            if kind == OPEN:
+                ip = payload.rpartition(":")[0]
+                try:
+                    _, client = await self.loop.create_connection(
+                        lambda: ReplayClient(self, conn_id), "127.0.0.1", self.port, local_addr=(self.source(ip), 0))
+                except OSError:
+                    self.failed_connects += 1
+                    return
+                self.clients[conn_id] = client
+            elif client is None or client.transport.is_closing():
+                self.skipped += kind != CLOSE
+            elif kind == CLOSE:
+                # Replies the capture had before the close may just be late
+                await self.wait_for(lambda: self.complete(client), client.arrived, self.loop.time() + self.grace)
+                client.transport.close()
+            elif command is None:
+                self.skipped += 1  # Invalid in the capture too; nothing to frame it as
+            else:
+                await self.depends(client, conn_id, seconds, command, payload)
+                if client.transport.is_closing():
+                    self.skipped += 1
+                    continue
+                client.transport.write(encode_frame(command, self.rewrite(command, payload)))
+                self.sent += 1
+
+    def compare(self):
+        """Match each captured reply to the replayed one at the same position, per connection and command."""
+        lags = []
+        matched = 0
+        missing = Counter()
+        extra = Counter()
+        for conn_id in set(self.expected) | set(self.clients):
+            received = defaultdict(list)
+            client = self.clients.get(conn_id)
+            for seconds, command, _ in (client.received if client is not None else ()):
+                received[command].append(seconds)
+            seen = Counter()
+            for seconds, command, _ in self.expected.get(conn_id, ()):
+                index = seen[command]
+                seen[command] += 1
+                if index < len(received[command]):
+                    matched += 1
+                    lags.append(received[command][index] - seconds / self.speed)
+                else:
+                    missing[command] += 1
+            for command, times in received.items():
+                if len(times) > seen[command]:
+                    extra[command] += len(times) - seen[command]
+        return lags, matched, missing, extra
+
+
+async def run(args, script, expected, pipe, port):
+    replay = Replay(script, expected, port, args.speed, args.grace)
+    pipe.send("stats")
+    before = pipe.recv()
+    replay_seconds = await replay.run()
+    pipe.send("stats")
+    after = pipe.recv()
+
+    lags, matched, missing, extra = replay.compare()
+    cpu = after["cpu_seconds"] - before["cpu_seconds"]
+    captured_seconds = script[-1][0] if script else 0.0
+    return {
+        "replay": {
+            "connections": len(replay.clients),
+            "failed_connects": replay.failed_connects,
+            "messages": replay.sent,
+            "skipped": replay.skipped,
+            "unmet_dependencies": replay.unmet,
+            "captured_seconds": captured_seconds,
+            "seconds": replay_seconds,
+            "speed": captured_seconds / replay_seconds if replay_seconds else 0.0,
+        },
+        "lag": {
+            "p50_ms": percentile(lags, 0.50) * 1000,
+            "p99_ms": percentile(lags, 0.99) * 1000,
+            "max_ms": max(lags, default=0.0) * 1000,
+        },
+        "behavior": {
+            "matched": matched,
+            "missing": dict(missing),
+            "extra": dict(extra),
+        },
+        "cpu": {
+            "server_seconds": cpu,
+            "us_per_message": cpu / replay.sent * 1e6 if replay.sent else 0.0,
+        },
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("capture", help="Capture file written by P_Server(capture_path=...)")
+    parser.add_argument("--speed", type=float, default=1.0, help="Replay this many times faster than captured")
+    parser.add_argument("--engine", choices=("thread", "asyncio"), default="asyncio")
+    parser.add_argument("--code-length", type=int, default=4, help="Server code length; match the recording server")
+    parser.add_argument("--grace", type=float, default=GRACE, help="Seconds to wait for late replies")
+    parser.add_argument("--server-output", action="store_true", help="Show the server's log output")
+    parser.add_argument("--json", help="Also write the results to this file")
+    args = parser.parse_args()
+
+    raise_fd_limit()
+    registry_dir = tempfile.mkdtemp(prefix="bench-replay-")
+    script, expected = load(args.capture)
+    # Run a relay only if the recording server had one, i.e. it opened sessions
+    relay = any(command == "SESSION" for records in expected.values() for _, command, _ in records)
+    options = {"engine": args.engine, "code_length": args.code_length, "relay": relay,
+               "registry_path": os.path.join(registry_dir, "codes.journal")}
+    context = multiprocessing.get_context("fork")
+    pipe, child_pipe = context.Pipe()
+    server = context.Process(target=run_server, args=(child_pipe, options, not args.server_output), daemon=True)
+    server.start()
+    port = pipe.recv()
+    try:
+        results = asyncio.run(run(args, script, expected, pipe, port))
+    finally:
+        pipe.send("stop")
+        pipe.recv()
+        server.join(5)
+
+    r, lag, b, cpu = results["replay"], results["lag"], results["behavior"], results["cpu"]
+    print(f"replayed {r['messages']} messages on {r['connections']} connections ({r['failed_connects']} failed, "
+          f"{r['skipped']} skipped, {r['unmet_dependencies']} sent without their trigger) "
+          f"in {r['seconds']:.2f}s = {r['speed']:.1f}x capture speed")
+    print(f"reply lag vs capture: p50 {lag['p50_ms']:.2f} ms  p99 {lag['p99_ms']:.2f} ms  max {lag['max_ms']:.2f} ms")
+    print(f"behavior: {b['matched']} replies matched, missing {b['missing'] or 'none'}, extra {b['extra'] or 'none'}")
+    print(f"cpu: {cpu['us_per_message']:.1f} us per replayed message")
+
+    if args.json:
+        config = {key: value for key, value in vars(args).items() if key != "json"}
+        with open(args.json, "w") as file:
+            json.dump({"config": config, "results": results}, file, indent=2)
+
+
+if __name__ == "__main__":
+    main()
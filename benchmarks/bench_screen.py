@@ -0,0 +1,86 @@
+"""Benchmark the dirty-tile screen encoder at 1080p.
+
+Run from the repository root:
+
+    python -m benchmarks.bench_screen [--frames N] [--json results.json]
+
+Reports encoded bytes/frame and encode/decode ms/frame for a static
+desktop, a moving cursor, a window opening and closing, and a fully
+changing screen.
+"""
+import argparse
+import json
+import time
+
+import numpy as np
+
+from P_Screen import SyntheticScreen, TileDecoder, TileEncoder
+
+
+WIDTH, HEIGHT = 1920, 1080
+
+
+def noise_source(width, height):
+    rng = np.random.default_rng(0)
+
+    def next_frame():
+        return rng.integers(0, 256, size=(height, width, 3), dtype=np.uint8)
+
+    return next_frame
+
+
+SCENARIOS = {
+    "static": lambda: SyntheticScreen(WIDTH, HEIGHT, cursor=False),
+    "cursor": lambda: SyntheticScreen(WIDTH, HEIGHT),
+    "window": lambda: SyntheticScreen(WIDTH, HEIGHT, window_every=5),
+    "full_change": lambda: noise_source(WIDTH, HEIGHT),
+}
+
+
+def run_scenario(source, frames, tile_size, level):
+    encoder = TileEncoder(tile_size, level)
+    decoder = TileDecoder()
+    encoder.encode(source())  # The first frame is always sent in full; measure steady state
+    encoded_bytes = 0
+    encode_seconds = decode_seconds = 0.0
+    for _ in range(frames):
+        frame = source()
+        started = time.perf_counter()
+        data = encoder.encode(frame)
+        encode_seconds += time.perf_counter() - started
+        started = time.perf_counter()
+        decoder.decode(data)
+        decode_seconds += time.perf_counter() - started
+        encoded_bytes += len(data)
+    return {
+        "bytes_per_frame": encoded_bytes / frames,
+        "encode_ms_per_frame": encode_seconds * 1000 / frames,
+        "decode_ms_per_frame": decode_seconds * 1000 / frames,
+        "raw_bytes_per_frame": WIDTH * HEIGHT * 3,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--frames", type=int, default=100)
+    parser.add_argument("--tile-size", type=int, default=64)
+    parser.add_argument("--level", type=int, default=1)
+    parser.add_argument("--json", help="Also write the results to this file")
+    args = parser.parse_args()
+
+    results = {}
+    for name, make_source in SCENARIOS.items():
+        frames = args.frames if name != "full_change" else max(1, args.frames // 10)
+        results[name] = run_scenario(make_source(), frames, args.tile_size, args.level)
+        r = results[name]
+        print(f"{name:12} {r['bytes_per_frame']:>12.0f} B/frame  "
+              f"encode {r['encode_ms_per_frame']:7.2f} ms  decode {r['decode_ms_per_frame']:7.2f} ms")
+
+    if args.json:
+        with open(args.json, "w") as file:
+            json.dump({"resolution": [WIDTH, HEIGHT], "tile_size": args.tile_size,
+                       "level": args.level, "results": results}, file, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,290 @@
+"""Load-test the rendezvous server with thousands of simulated clients.
+
+Run from the repository root:
+
+    python -m benchmarks.bench_server [--engine asyncio] [--clients 2000]
+        [--requests 20] [--in-flight 1] [--capture run.capture] [--json results.json]
+
+The server runs in a child process. The clients are asyncio protocols in
+this process that speak the same binary protocol as P_Client, heartbeats
+included. Each connects from its own 127.x.y.z address, because the server
+hands out one code per IP, so this needs Linux, where all of 127/8 is
+loopback. Half of the clients send connection requests to a partner in the
+other half, which approves (or rejects, see --reject-ratio) after
+--think-ms.
+
+Reports connections/s, request->response latency (p50/p99/max), server
+memory per connection, and server CPU time per message it received. With
+--capture the server records its traffic, which shows the capture's cost
+and gives benchmarks.bench_replay a workload.
+"""
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import random
+import tempfile
+import time
+
+from P_AsyncServer import raise_fd_limit
+from P_Client import HEARTBEAT_INTERVAL, PROTOCOL_VERSION
+from P_Protocol import FrameDecoder, encode_frame
+
+
+def current_rss():
+    """Resident set size of this process in bytes (Linux), or None."""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        return None
+
+
+def run_server(pipe, options, quiet):
+    """Child process: serve, and answer "stats" and "stop" from the parent."""
+    import logging
+    import threading
+
+    from P_Log import setup_logging
+    from P_Server import P_Server
+
+    if quiet:
+        logging.getLogger().setLevel(logging.ERROR)  # Per-client log records would dominate the CPU figures
+    else:
+        setup_logging()
+    raise_fd_limit()
+    server = P_Server("127.0.0.1", 0, **options)
+    thread = threading.Thread(target=server.start, daemon=True)
+    thread.start()
+    pipe.send(server.server_socket.getsockname()[1])
+    while True:
+        command = pipe.recv()
+        if command == "stats":
+            times = os.times()
+            pipe.send({"rss_bytes": current_rss(), "cpu_seconds": times.user + times.system,
+                       "clients": len(server.clients)})
+        elif command == "stop":
+            server.stop()
+            thread.join(5)
+            pipe.send(None)
+            return
+
+
+class SimClient(asyncio.Protocol):
+    """One simulated P_Client: registers, heartbeats, sends and answers requests."""
+
+    def __init__(self, bench):
+        self.bench = bench
+        self.transport = None
+        self.decoder = FrameDecoder()  # CODE arrives as legacy text, before the server has seen HELLO
+        self.code = asyncio.get_running_loop().create_future()
+        self.pending = {}  # {request id: future}
+        self.next_id = 0
+        self.heartbeat = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+        transport.write(encode_frame("HELLO", PROTOCOL_VERSION))
+        self.heartbeat = asyncio.get_running_loop().call_later(HEARTBEAT_INTERVAL, self.ping)
+
+    def ping(self):
+        if not self.transport.is_closing():
+            self.transport.write(encode_frame("PING", str(time.monotonic_ns())))
+            self.heartbeat = asyncio.get_running_loop().call_later(HEARTBEAT_INTERVAL, self.ping)
+
+    def data_received(self, data):
+        for command, payload in self.decoder.feed(data):
+            if command == "CODE" and not self.code.done():
+                self.code.set_result(payload)
+            elif command == "APPROVE":
+                requesting_code, _, request_id = payload.partition(",")
+                decision = "no" if random.random() < self.bench.reject_ratio else "yes"
+                reply = encode_frame("APPROVAL", f"{requesting_code},{request_id},{decision}")
+                if self.bench.think:
+                    asyncio.get_running_loop().call_later(self.bench.think, self.transport.write, reply)
+                else:
+                    self.transport.write(reply)
+            elif command in ("RESPONSE", "ERROR"):
+                result, _, request_id = payload.rpartition(",")
+                future = self.pending.pop(request_id, None)
+                if future is not None and not future.done():
+                    future.set_result(command == "RESPONSE")
+
+    def connection_lost(self, exc):
+        if self.heartbeat is not None:
+            self.heartbeat.cancel()
+        if not self.code.done():
+            self.code.set_exception(ConnectionError(exc or "connection closed"))
+        for future in self.pending.values():
+            if not future.done():
+                future.set_result(False)
+
+    def request(self, target_code):
+        self.next_id += 1
+        request_id = str(self.next_id)
+        future = asyncio.get_running_loop().create_future()
+        self.pending[request_id] = future
+        self.transport.write(encode_frame("REQUEST", f"{target_code},{request_id}"))
+        return future
+
+
+class Bench:
+    def __init__(self, args, port):
+        self.args = args
+        self.port = port
+        self.think = args.think_ms / 1000
+        self.reject_ratio = args.reject_ratio
+
+    def source_address(self, index):
+        index += 1
+        return f"127.{100 + index // 65025}.{(index // 255) % 255}.{index % 255 + 1}"
+
+    async def connect_one(self, index, gate):
+        loop = asyncio.get_running_loop()
+        async with gate:
+            _, client = await loop.create_connection(
+                lambda: SimClient(self), "127.0.0.1", self.port, local_addr=(self.source_address(index), 0))
+            await asyncio.wait_for(client.code, 30)
+        return client
+
+    async def connect_all(self):
+        gate = asyncio.Semaphore(self.args.connect_concurrency)
+        started = time.perf_counter()
+        results = await asyncio.gather(*(self.connect_one(i, gate) for i in range(self.args.clients)),
+                                       return_exceptions=True)
+        elapsed = time.perf_counter() - started
+        clients = [r for r in results if isinstance(r, SimClient)]
+        return clients, elapsed, len(results) - len(clients)
+
+    async def drive(self, requester, target_code, latencies, counts):
+        for _ in range(self.args.requests // self.args.in_flight):
+            started = [time.perf_counter()] * self.args.in_flight
+            futures = [requester.request(target_code) for _ in range(self.args.in_flight)]
+            for began, future in zip(started, futures):
+                try:
+                    ok = await asyncio.wait_for(future, 30)
+                except asyncio.TimeoutError:
+                    ok = False
+                latencies.append(time.perf_counter() - began)
+                counts["ok" if ok else "errors"] += 1
+
+    async def run_workload(self, clients):
+        half = len(clients) // 2
+        latencies = []
+        counts = {"ok": 0, "errors": 0}
+        started = time.perf_counter()
+        await asyncio.gather(*(self.drive(clients[i], clients[half + i].code.result(), latencies, counts)
+                               for i in range(half)))
+        return latencies, counts, time.perf_counter() - started
+
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * p))]
+
+
+async def run(args, pipe, port):
+    bench = Bench(args, port)
+    pipe.send("stats")
+    before = pipe.recv()
+
+    clients, connect_seconds, failed = await bench.connect_all()
+    await asyncio.sleep(0.5)  # Let the server settle before sampling its memory
+    pipe.send("stats")
+    connected = pipe.recv()
+
+    latencies, counts, request_seconds = await bench.run_workload(clients)
+    pipe.send("stats")
+    after = pipe.recv()
+
+    for client in clients:
+        client.transport.close()
+    await asyncio.sleep(0.2)
+
+    requests = counts["ok"] + counts["errors"]
+    messages = 2 * requests  # The server receives a REQUEST and an APPROVAL per request
+    cpu = after["cpu_seconds"] - connected["cpu_seconds"]
+    rss_per_connection = None
+    if before["rss_bytes"] is not None and clients:
+        rss_per_connection = (connected["rss_bytes"] - before["rss_bytes"]) / len(clients)
+    return {
+        "connect": {
+            "clients": len(clients),
+            "failed": failed,
+            "seconds": connect_seconds,
+            "per_second": len(clients) / connect_seconds if connect_seconds else 0.0,
+        },
+        "memory": {
+            "rss_before_bytes": before["rss_bytes"],
+            "rss_connected_bytes": connected["rss_bytes"],
+            "bytes_per_connection": rss_per_connection,
+        },
+        "requests": {
+            "count": requests,
+            "errors": counts["errors"],
+            "seconds": request_seconds,
+            "per_second": requests / request_seconds if request_seconds else 0.0,
+            "p50_ms": percentile(latencies, 0.50) * 1000,
+            "p99_ms": percentile(latencies, 0.99) * 1000,
+            "max_ms": max(latencies, default=0.0) * 1000,
+        },
+        "cpu": {
+            "server_seconds": cpu,
+            "us_per_message": cpu / messages * 1e6 if messages else 0.0,
+        },
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--engine", choices=("thread", "asyncio"), default="asyncio")
+    parser.add_argument("--clients", type=int, default=2000)
+    parser.add_argument("--requests", type=int, default=20, help="Requests sent by each requesting client")
+    parser.add_argument("--in-flight", type=int, default=1, help="Requests each requester keeps outstanding")
+    parser.add_argument("--think-ms", type=float, default=0, help="Delay before an approver answers")
+    parser.add_argument("--reject-ratio", type=float, default=0.0)
+    parser.add_argument("--connect-concurrency", type=int, default=200)
+    parser.add_argument("--code-length", type=int, default=6, help="Server code length; 4 digits fit 9000 clients")
+    parser.add_argument("--relay", action="store_true", help="Also open relay sessions on approval")
+    parser.add_argument("--server-output", action="store_true", help="Show the server's log output")
+    parser.add_argument("--capture", help="Have the server capture its control traffic to this file")
+    parser.add_argument("--json", help="Also write the results to this file")
+    args = parser.parse_args()
+    args.in_flight = max(1, min(args.in_flight, args.requests))
+
+    raise_fd_limit()
+    registry_dir = tempfile.mkdtemp(prefix="bench-server-")
+    options = {"engine": args.engine, "code_length": args.code_length, "relay": args.relay,
+               "registry_path": os.path.join(registry_dir, "codes.journal"), "capture_path": args.capture}
+    context = multiprocessing.get_context("fork")
+    pipe, child_pipe = context.Pipe()
+    server = context.Process(target=run_server, args=(child_pipe, options, not args.server_output), daemon=True)
+    server.start()
+    port = pipe.recv()
+    try:
+        results = asyncio.run(run(args, pipe, port))
+    finally:
+        pipe.send("stop")
+        pipe.recv()
+        server.join(5)
+
+    c, m, r, cpu = results["connect"], results["memory"], results["requests"], results["cpu"]
+    print(f"engine {args.engine}: {c['clients']} clients ({c['failed']} failed) in {c['seconds']:.2f}s "
+          f"= {c['per_second']:.0f} conn/s")
+    if m["bytes_per_connection"] is not None:
+        print(f"memory: {m['bytes_per_connection'] / 1024:.1f} KiB per connection")
+    print(f"requests: {r['count']} ({r['errors']} errors) in {r['seconds']:.2f}s = {r['per_second']:.0f}/s, "
+          f"p50 {r['p50_ms']:.2f} ms  p99 {r['p99_ms']:.2f} ms  max {r['max_ms']:.2f} ms")
+    print(f"cpu: {cpu['us_per_message']:.1f} us per server message")
+
+    if args.json:
+        config = {key: value for key, value in vars(args).items() if key != "json"}
+        with open(args.json, "w") as file:
+            json.dump({"config": config, "results": results}, file, indent=2)
+
+
+if __name__ == "__main__":
+    main()